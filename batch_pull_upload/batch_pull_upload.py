@@ -11,15 +11,22 @@
 
 from urllib.parse import urlparse
 
+import argparse
+import contextlib
+import cProfile
+import io
 import json
+import pstats
 import sys
 import os
 import time
 import threading
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 
+import requests
 import tencentcloud.common.credential
 from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
 from tencentcloud.vod.v20180717 import vod_client, models
@@ -32,6 +39,21 @@ LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 INTERNAL_TIMEOUT = 60  # 内部重试检查超时时间（秒）和 腾讯云SDK单次接口请求默认超时时间保持一致
 EXTERNAL_TIMEOUT = 70  # 线程池强制超时时间（秒），应该略大于内部超时
 
+# 预检配置
+PREFLIGHT_MAX_WORKERS = 20  # 预检并发数
+PREFLIGHT_PER_HOST_CONCURRENCY = 4  # 单个源站的预检并发数
+PREFLIGHT_TIMEOUT = 10  # 单次预检请求超时时间（秒）
+
+# 进度配置
+PROGRESS_INTERVAL = 10  # 进度输出间隔（秒）
+THROUGHPUT_HALF_LIFE = 30  # 吞吐量指数加权平均的半衰期（秒）
+
+# 性能分析配置
+PROFILE_MODES = ("sample", "cprofile")
+PROFILE_OUTPUT = "pull_upload_profile.txt"  # 默认报告路径
+PROFILE_SAMPLE_INTERVAL = 0.01  # 调用栈采样间隔（秒）
+PROFILE_TOP_FUNCTIONS = 40  # 报告中列出的函数数
+
 class PullUploadConfig:
     """配置管理类"""
     def __init__(self, config_file=None):
@@ -100,11 +122,339 @@ class RateLimiter:
             self.request_count += 1
 
 
+class EwmaRate:
+    """按时间加权的指数移动平均速率
+
+    每次采样计算与上次采样之间的平均速率，权重为 1 - 0.5 ** (间隔 / 半衰期)；
+    平均值从0开始累积并按累计权重修正，开始时的突发速率不会长时间影响结果。
+    """
+    def __init__(self, value=0, half_life=THROUGHPUT_HALF_LIFE):
+        self.half_life = half_life
+        self.average = 0.0
+        self.weight = 0.0
+        self.last_time = time.time()
+        self.last_value = value
+
+    @property
+    def rate(self):
+        return self.average / self.weight if self.weight > 0 else None
+
+    def update(self, value, now=None):
+        """value为累计值，返回当前的平均速率，第一次采样前为None"""
+        now = time.time() if now is None else now
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return self.rate
+        decay = 0.5 ** (elapsed / self.half_life)
+        self.average = decay * self.average + (1 - decay) * (value - self.last_value) / elapsed
+        self.weight = decay * self.weight + (1 - decay)
+        self.last_time = now
+        self.last_value = value
+        return self.rate
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Profiler:
+    """性能分析：汇总各代码段（span）的耗时，并收集函数级数据，退出时写入报告
+
+    - sample：后台线程定期采样所有线程的调用栈，开销低，同时输出折叠栈文件（.folded）用于生成火焰图
+    - cprofile：每个线程各自运行cProfile，退出时合并，同时输出.prof文件
+    """
+    def __init__(self, mode="sample", path=PROFILE_OUTPUT):
+        self.mode = mode
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.spans = defaultdict(lambda: [0, 0.0, 0.0])  # [次数, 总耗时, 最大耗时]
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.sample_num = 0
+        self.own_samples = defaultdict(int)
+        self.total_samples = defaultdict(int)
+        self.stacks = defaultdict(int)
+        self.profiles = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self.lock:
+                stats = self.spans[name]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+    def start(self):
+        if self.mode == "sample":
+            self.sampler = threading.Thread(target=self._sample_periodically, daemon=True)
+            self.sampler.start()
+        else:
+            # 之后启动的线程在开始执行前开启各自的cProfile
+            threading.setprofile(self._enable_thread_profile)
+            self._enable_thread_profile()
+
+    def _enable_thread_profile(self, *args):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python 3.12起cProfile基于sys.monitoring，第一个实例已经覆盖所有线程
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def _sample_periodically(self):
+        sampler_id = threading.get_ident()
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == sampler_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    self.sample_num += 1
+                    self.own_samples[stack[0]] += 1
+                    for name in set(stack):
+                        self.total_samples[name] += 1
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """停止收集并写入报告"""
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.mode == "cprofile":
+            threading.setprofile(None)
+            sys.setprofile(None)
+
+        lines = [f"batch pull upload profile, mode: {self.mode}, duration: {time.time() - self.start_time:.1f}s", "",
+                 f"{'span':<24}{'count':>10}{'total(s)':>12}{'avg(ms)':>10}{'max(ms)':>10}"]
+        for name, (count, total, longest) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<24}{count:>10}{total:>12.2f}{total / count * 1000:>10.1f}{longest * 1000:>10.1f}")
+        lines.append("")
+
+        if self.mode == "sample":
+            lines.append(f"top functions by samples ({self.sample_num} thread samples, "
+                         f"interval {PROFILE_SAMPLE_INTERVAL * 1000:.0f}ms)")
+            lines.append(f"{'own%':>8}{'total%':>8}  function")
+            top = sorted(self.total_samples.items(), key=lambda item: -item[1])[:PROFILE_TOP_FUNCTIONS]
+            for name, count in top:
+                lines.append(f"{self.own_samples.get(name, 0) * 100 / self.sample_num:>8.1f}"
+                             f"{count * 100 / self.sample_num:>8.1f}  {name}")
+            with open(self.path + ".folded", "w", encoding="utf-8") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+        elif self.profiles:
+            for profile in self.profiles:
+                profile.disable()
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.path + ".prof")
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            lines.append(f"{len(self.profiles)} thread profiles merged, sorted by cumulative time")
+            lines.append(stream.getvalue())
+
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return self.path
+
+
+PROFILER = None
+
+
+def profile_span(name):
+    """with profile_span(name): ... 统计代码段耗时，未开启--profile时不做任何统计"""
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.span(name)
+
+
+class HostRateLimiter:
+    """源站限流控制类 - 按源站host限制请求速率（含重试请求）"""
+    def __init__(self, max_requests_per_second=0):
+        self.interval = 1.0 / max_requests_per_second if max_requests_per_second > 0 else 0
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        """获取指定源站的请求许可"""
+        if self.interval <= 0:
+            return
+
+        # 在锁内预约时间片，在锁外等待，避免不同源站之间相互阻塞
+        with self.lock:
+            now = time.time()
+            allowed = max(now, self.next_allowed.get(host, 0))
+            self.next_allowed[host] = allowed + self.interval
+
+        wait_time = allowed - now
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class HostScheduler:
+    """源站公平调度类 - 按源站host轮询分发任务，并限制单个源站的在途任务数"""
+    def __init__(self, tasks, max_in_flight_per_host=0):
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.queues = {}
+        self.in_flight = {}
+        self.hosts = deque()
+        for task in tasks:
+            host = get_url_host(task[1])
+            if host not in self.queues:
+                self.queues[host] = deque()
+                self.in_flight.setdefault(host, 0)
+                self.hosts.append(host)
+            self.queues[host].append(task)
+
+    def next_task(self):
+        """按轮询顺序取出下一个可执行的任务；所有源站都已达到在途上限或无任务时返回None"""
+        for _ in range(len(self.hosts)):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if 0 < self.max_in_flight_per_host <= self.in_flight[host]:
+                continue
+            task = self.queues[host].popleft()
+            self.in_flight[host] += 1
+            if not self.queues[host]:
+                del self.queues[host]
+                self.hosts.remove(host)
+            return task
+        return None
+
+    def task_done(self, task):
+        """任务完成，释放源站在途名额"""
+        self.in_flight[get_url_host(task[1])] -= 1
+
+
+def get_url_host(url):
+    """获取URL对应的源站host"""
+    return urlparse(url).netloc.lower()
+
+
+def parse_content_length(value):
+    """解析Content-Length，缺失或格式不正确时返回None（大小未知）"""
+    if value is None:
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        return None
+    return size if size >= 0 else None
+
+
+class UrlProber:
+    """源站预检类 - 并发探测URL可用性，过滤无效链接
+
+    优先发送HEAD请求，源站不支持HEAD时回退为Range GET(bytes=0-0)，
+    记录状态码、文件大小和Content-Type。预检使用独立的连接池，
+    并按源站host限制并发，避免集中压到同一个源站。
+    """
+    def __init__(self, max_workers=PREFLIGHT_MAX_WORKERS,
+                 per_host_concurrency=PREFLIGHT_PER_HOST_CONCURRENCY,
+                 timeout=PREFLIGHT_TIMEOUT):
+        self.max_workers = max_workers
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        # 独立连接池，与拉取上传的API调用互不影响
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _host_semaphore(self, host):
+        """获取源站host对应的并发信号量"""
+        with self.lock:
+            semaphore = self.host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host_concurrency)
+                self.host_semaphores[host] = semaphore
+            return semaphore
+
+    def _head(self, url):
+        rsp = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        size = parse_content_length(rsp.headers.get('Content-Length'))
+        return rsp.status_code, size, rsp.headers.get('Content-Type')
+
+    def _ranged_get(self, url):
+        rsp = self.session.get(url, timeout=self.timeout, allow_redirects=True,
+                               headers={"Range": "bytes=0-0"}, stream=True)
+        try:
+            size = None
+            content_range = rsp.headers.get('Content-Range', '')
+            if rsp.status_code == 206 and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                if total.isdigit():
+                    size = int(total)
+            elif rsp.status_code == 200:
+                size = parse_content_length(rsp.headers.get('Content-Length'))
+            return rsp.status_code, size, rsp.headers.get('Content-Type')
+        finally:
+            rsp.close()
+
+    def probe(self, url):
+        """探测单个URL，返回状态码、大小、Content-Type以及是否通过预检"""
+        info = {"url": url, "ok": False, "status_code": None, "size": None, "content_type": None}
+        with self._host_semaphore(get_url_host(url)), profile_span("preflight_probe"):
+            try:
+                status_code, size, content_type = None, None, None
+                try:
+                    status_code, size, content_type = self._head(url)
+                except requests.RequestException:
+                    pass
+                # HEAD失败、不被支持或未返回大小时，回退为Range GET
+                if status_code is None or status_code >= 400 or size is None:
+                    status_code, size, content_type = self._ranged_get(url)
+                info.update(status_code=status_code, size=size, content_type=content_type)
+            except requests.RequestException as e:
+                info["error"] = f"{type(e).__name__}: {e}"
+                return info
+
+        if status_code >= 400:
+            info["error"] = f"HTTP {status_code}"
+        elif size == 0:
+            info["error"] = "Zero-byte file"
+        else:
+            info["ok"] = True
+        return info
+
+    def probe_all(self, tasks):
+        """并发预检所有任务，返回 {line_num: 预检结果}"""
+        probe_results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_line = {
+                executor.submit(self.probe, task[1]): task[0] for task in tasks
+            }
+            for future in as_completed(future_to_line):
+                probe_results[future_to_line[future]] = future.result()
+        self.session.close()
+        return probe_results
+
+
 class PullUploadWorker:
     """拉取上传工作线程类"""
-    def __init__(self, config, rate_limiter, max_retries=3):
+    def __init__(self, config, rate_limiter, max_retries=3, host_rate_limiter=None):
         self.config = config
         self.rate_limiter = rate_limiter
+        self.host_rate_limiter = host_rate_limiter
         self.max_retries = max_retries
         # 初始化时创建客户端，避免每次调用重复创建
         self.client = self._create_client()
@@ -227,7 +577,10 @@ class PullUploadWorker:
 
         try:
             # 限流控制
-            self.rate_limiter.acquire()
+            with profile_span("rate_limit_wait"):
+                self.rate_limiter.acquire()
+                if self.host_rate_limiter is not None:
+                    self.host_rate_limiter.acquire(get_url_host(url))
             
             # 使用已初始化的客户端，避免重复创建
             method = getattr(models, "PullUploadRequest")
@@ -235,7 +588,8 @@ class PullUploadWorker:
             req.from_json_string(json.dumps(params))
             
             start_time = time.time()
-            rsp = self.client.PullUpload(req)
+            with profile_span("pull_upload"):
+                rsp = self.client.PullUpload(req)
             end_time = time.time()
             
             return {
@@ -319,13 +673,27 @@ class BatchPullUploader:
     def __init__(self, config_file=None, max_workers=10, log_level=logging.INFO):
         self.config = PullUploadConfig(config_file)
         self.rate_limiter = RateLimiter(max_requests_per_second=5)
-        self.worker = PullUploadWorker(self.config.config, self.rate_limiter)
+        host_limit_config = self.config.config.get("host_limit", {})
+        self.max_in_flight_per_host = host_limit_config.get("max_in_flight", 0)
+        self.max_requests_per_host = host_limit_config.get("max_requests_per_second", 0)
+        self.host_rate_limiter = HostRateLimiter(max_requests_per_second=self.max_requests_per_host)
+        self.worker = PullUploadWorker(self.config.config, self.rate_limiter,
+                                       host_rate_limiter=self.host_rate_limiter)
         self.max_workers = max_workers
         self.total_tasks = 0
         self.completed_tasks = 0
         self.success_tasks = 0
         self.failed_tasks = 0
         self.results = []
+        self.probe_results = {}
+        # 按字节统计进度：源文件大小来自预检，未开启预检时按任务数统计
+        self.total_bytes = 0
+        self.completed_bytes = 0
+        self.progress_interval = self.config.config.get("progress_interval", PROGRESS_INTERVAL)
+        self.byte_rate = None
+        self.task_rate = None
+        self.last_progress_time = 0
+        self.last_progress = None
         self.lock = threading.Lock()
         self.start_time = None
         self.end_time = None
@@ -417,6 +785,52 @@ class BatchPullUploader:
             
         return tasks
     
+    def _preflight(self, tasks):
+        """预检源站URL，过滤掉无法访问或大小为0的任务，返回通过预检的任务列表"""
+        preflight_config = self.config.config.get("preflight", {})
+        prober = UrlProber(
+            max_workers=preflight_config.get("max_workers", PREFLIGHT_MAX_WORKERS),
+            per_host_concurrency=preflight_config.get("per_host_concurrency", PREFLIGHT_PER_HOST_CONCURRENCY),
+            timeout=preflight_config.get("timeout", PREFLIGHT_TIMEOUT))
+
+        self.logger.info(f"Preflight probing {len(tasks)} source URLs")
+        with profile_span("preflight"):
+            self.probe_results = prober.probe_all(tasks)
+
+        passed_tasks = []
+        total_bytes = 0
+        unknown_size = 0
+        for task in tasks:
+            line_num, url, media_name, class_id, _ = task
+            probe = self.probe_results[line_num]
+            if probe["ok"]:
+                passed_tasks.append(task)
+                if probe["size"] is None:
+                    unknown_size += 1
+                else:
+                    total_bytes += probe["size"]
+                continue
+
+            self._update_progress({
+                "line_num": line_num,
+                "success": False,
+                "url": url,
+                "media_name": media_name,
+                "class_id": class_id,
+                "error": f"Preflight failed: {probe.get('error', 'Unknown error')}",
+                "error_code": "PREFLIGHT_FAILED",
+                "status_code": probe["status_code"]
+            })
+
+        self.logger.info(f"Preflight passed: {len(passed_tasks)}/{len(tasks)}, "
+                         f"total size: {total_bytes} bytes ({total_bytes / 1024 ** 3:.2f} GB)"
+                         f"{f', unknown size: {unknown_size}' if unknown_size else ''}")
+        # 大小未知的任务按已知大小的平均值估算
+        sized_tasks = len(passed_tasks) - unknown_size
+        if sized_tasks > 0:
+            self.total_bytes = total_bytes + unknown_size * total_bytes // sized_tasks
+        return passed_tasks
+
     def _update_progress(self, result):
         """更新进度"""
         with self.lock:
@@ -426,15 +840,52 @@ class BatchPullUploader:
             else:
                 self.failed_tasks += 1
             self.results.append(result)
-            
-            # 显示进度
-            progress = (self.completed_tasks / self.total_tasks) * 100
+            self.completed_bytes += result.get("source_size") or 0
+
+            # 显示任务状态，整体进度按间隔单独输出
             status = "SUCCESS" if result["success"] else "FAILED"
             retry_info = f" (retry {result.get('retry_attempts', 0)} times)" if result.get('retry_attempts', 0) > 0 else ""
-            
-            self.logger.info(f"[{self.completed_tasks}/{self.total_tasks}] {progress:.1f}% | {status} | "
+
+            self.logger.info(f"[{self.completed_tasks}/{self.total_tasks}] {status} | "
                            f"{result['url'][:50]}{'...' if len(result['url']) > 50 else ''}{retry_info}")
-    
+        self._report_progress()
+
+    def _report_progress(self, force=False):
+        """输出整体进度：有源文件大小时按字节计算完成比例，按指数加权平均的吞吐量估算剩余时间
+
+        每 progress_interval 秒最多输出一次，force 为 True 时不受间隔限制；进度没有变化时不输出。
+        拉取上传由云端下载源文件，吞吐量按已完成任务的源文件大小计算。
+        """
+        now = time.time()
+        with self.lock:
+            if self.total_tasks <= 0 or self.byte_rate is None:
+                return
+            if not force and now - self.last_progress_time < self.progress_interval:
+                return
+            state = (self.completed_tasks, self.completed_bytes)
+            if state == self.last_progress:
+                return
+            self.last_progress_time = now
+            self.last_progress = state
+            byte_rate = self.byte_rate.update(self.completed_bytes, now)
+            task_rate = self.task_rate.update(self.completed_tasks, now)
+            completed_tasks, completed_bytes = state
+
+        task_percent = completed_tasks / self.total_tasks * 100
+        if self.total_bytes > 0:
+            percent = 100.0 if completed_tasks >= self.total_tasks else \
+                min(completed_bytes / self.total_bytes * 100, 100.0)
+            progress = (f"Progress: {percent:.1f}% by bytes ({completed_bytes / 1024 ** 3:.2f}/"
+                        f"{self.total_bytes / 1024 ** 3:.2f} GB), {completed_tasks}/{self.total_tasks} tasks "
+                        f"({task_percent:.1f}%) | {(byte_rate or 0) / 1024 ** 2:.1f} MB/s")
+            eta = (self.total_bytes - completed_bytes) / byte_rate if byte_rate else None
+        else:
+            progress = f"Progress: {completed_tasks}/{self.total_tasks} tasks ({task_percent:.1f}%)"
+            eta = (self.total_tasks - completed_tasks) / task_rate if task_rate else None
+        if eta is not None and completed_tasks < self.total_tasks:
+            progress += f" | ETA {format_duration(max(eta, 0))}"
+        self.logger.info(progress)
+
     def _print_summary(self):
         """打印执行摘要"""
         self.end_time = time.time()
@@ -502,7 +953,10 @@ class BatchPullUploader:
                         "success_rate": (self.success_tasks/self.total_tasks)*100 if self.total_tasks > 0 else 0,
                         "error_breakdown": error_counts,
                         "total_retries": total_retries,
-                        "average_duration": total_duration / len(self.results) if self.results else 0
+                        "average_duration": total_duration / len(self.results) if self.results else 0,
+                        "source_total_bytes": sum(
+                            probe["size"] for probe in self.probe_results.values()
+                            if probe["ok"] and probe["size"] is not None)
                     },
                     "results": self.results
                 }, f, ensure_ascii=False, indent=2)
@@ -513,12 +967,54 @@ class BatchPullUploader:
 
         self.results.clear()
     
+    def _collect_result(self, future, task):
+        """收集已完成任务的结果"""
+        line_num, url, media_name, class_id, media_storage_path = task
+        try:
+            # 设置单个任务的总超时时间（线程池强制超时，作为最后保障）
+            # 注意：这个超时应该略大于内部超时，给内部检查留出时间
+            result = future.result(timeout=EXTERNAL_TIMEOUT)  # 比内部超时多10秒，作为最后保障
+            result["line_num"] = line_num
+            result["media_name"] = media_name
+            result["class_id"] = class_id
+            if line_num in self.probe_results:
+                result["source_size"] = self.probe_results[line_num]["size"]
+                result["content_type"] = self.probe_results[line_num]["content_type"]
+            self._update_progress(result)
+        except TimeoutError:
+            # 线程池强制超时，说明任务可能卡死
+            error_result = {
+                "line_num": line_num,
+                "success": False,
+                "url": url,
+                "media_name": media_name,
+                "class_id": class_id,
+                "error": f"Task execution timeout ({EXTERNAL_TIMEOUT}s)",
+                "error_code": "THREAD_POOL_TIMEOUT",
+                "timeout_type": "external"
+            }
+            self._update_progress(error_result)
+        except Exception as e:
+            error_result = {
+                "line_num": line_num,
+                "success": False,
+                "url": url,
+                "media_name": media_name,
+                "class_id": class_id,
+                "error": f"Task execution error: {type(e).__name__}: {str(e)}",
+                "error_code": "TASK_EXECUTION_ERROR"
+            }
+            self._update_progress(error_result)
+
     def run(self, url_list_file):
         """执行批量拉取上传"""
         self.start_time = time.time()
         
         self.logger.info(f"Starting batch pull upload, max concurrent workers: {self.max_workers}")
-        self.logger.info(f"Rate limiting: max 5 requests per second")
+        self.logger.info(f"Rate limiting: max {self.rate_limiter.max_requests} requests per second")
+        self.logger.info(
+            f"Per-host limits: max {self.max_requests_per_host or 'unlimited'} requests per second, "
+            f"max {self.max_in_flight_per_host or 'unlimited'} tasks in flight")
         self.logger.info(f"Retry setting: max 3 retries with exponential backoff")
         
         # 解析URL列表
@@ -527,58 +1023,47 @@ class BatchPullUploader:
         
         self.logger.info(f"Loaded {self.total_tasks} tasks from {url_list_file}")
         self.logger.info("-" * 80)
+        self.byte_rate = EwmaRate()
+        self.task_rate = EwmaRate()
+
+        # 源站预检（可选）
+        if self.config.config.get("preflight", {}).get("enable", False):
+            urls = self._preflight(urls)
         
-        # 使用线程池并发执行
+        # 按源站公平调度，使用线程池并发执行
+        scheduler = HostScheduler(urls, self.max_in_flight_per_host)
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务
-            future_to_task = {
-                executor.submit(self.worker.pull_with_retry, url, media_name, class_id, media_storage_path): (line_num, url, media_name, class_id, media_storage_path)
-                for line_num, url, media_name, class_id, media_storage_path in urls
-            }
-            
-            # 处理完成的任务
-            for future in as_completed(future_to_task):
-                line_num, url, media_name, class_id, media_storage_path = future_to_task[future]
-                try:
-                    # 设置单个任务的总超时时间（线程池强制超时，作为最后保障）
-                    # 注意：这个超时应该略大于内部超时，给内部检查留出时间
-                    result = future.result(timeout=EXTERNAL_TIMEOUT)  # 比内部超时多10秒，作为最后保障
-                    result["line_num"] = line_num
-                    result["media_name"] = media_name
-                    result["class_id"] = class_id
-                    self._update_progress(result)
-                except TimeoutError:
-                    # 线程池强制超时，说明任务可能卡死
-                    error_result = {
-                        "line_num": line_num,
-                        "success": False,
-                        "url": url,
-                        "media_name": media_name,
-                        "class_id": class_id,
-                        "error": f"Task execution timeout ({EXTERNAL_TIMEOUT}s)",
-                        "error_code": "THREAD_POOL_TIMEOUT",
-                        "timeout_type": "external"
-                    }
-                    self._update_progress(error_result)
-                except Exception as e:
-                    error_result = {
-                        "line_num": line_num,
-                        "success": False,
-                        "url": url,
-                        "media_name": media_name,
-                        "class_id": class_id,
-                        "error": f"Task execution error: {type(e).__name__}: {str(e)}",
-                        "error_code": "TASK_EXECUTION_ERROR"
-                    }
-                    self._update_progress(error_result)
-        
+            future_to_task = {}
+            while True:
+                # 补充提交任务，在途任务数不超过最大并发数
+                while len(future_to_task) < self.max_workers:
+                    task = scheduler.next_task()
+                    if task is None:
+                        break
+                    _, url, media_name, class_id, media_storage_path = task
+                    future = executor.submit(self.worker.pull_with_retry, url, media_name, class_id, media_storage_path)
+                    future_to_task[future] = task
+
+                if not future_to_task:
+                    break
+
+                # 处理完成的任务，没有任务完成时也按间隔输出进度
+                done, _ = wait(future_to_task, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = future_to_task.pop(future)
+                    scheduler.task_done(task)
+                    self._collect_result(future, task)
+                self._report_progress()
+
+        self._report_progress(force=True)
+
         # 打印执行摘要
         self._print_summary()
 
 
 def usage():
     """脚本用法"""
-    print("Usage: python3 batch_pull_upload.py {url_list_file}")
+    print("Usage: python3 batch_pull_upload.py [--profile [sample|cprofile]] [--profile-output FILE] {url_list_file}")
     print("")
     print("url_list_file format example:")
     print("https://example.com/video1.mp4,我的视频1,1001,/custom/path/video1.mp4")
@@ -599,23 +1084,43 @@ def usage():
     print("- 路径组合优先级：use_url_path=true 时使用 url_path，否则使用 MediaStoragePath，最后拼接 prefix。")
 
 
-def main():
-    """主函数"""
-    if len(sys.argv) != 2:
+class ArgumentParser(argparse.ArgumentParser):
+    """参数不正确时输出脚本用法并退出"""
+    def error(self, message):
         usage()
         sys.exit(1)
-    
-    url_list_file = sys.argv[1]
-    
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument("url_list_file")
+    parser.add_argument("--profile", nargs="?", const="sample", choices=PROFILE_MODES)
+    parser.add_argument("--profile-output", default=PROFILE_OUTPUT)
+    return parser.parse_args()
+
+
+def main():
+    """主函数"""
+    global PROFILER
+    args = parse_args()
+
+    if args.profile:
+        PROFILER = Profiler(args.profile, args.profile_output)
+        PROFILER.start()
+
     try:
         uploader = BatchPullUploader()
-        uploader.run(url_list_file)
+        uploader.run(args.url_list_file)
     except KeyboardInterrupt:
         logging.warning("Operation interrupted by user")
         sys.exit(1)
     except Exception as e:
         logging.error(f"Program execution error: {e}")
         sys.exit(1)
+    finally:
+        if PROFILER is not None:
+            logging.getLogger("batch_pull_upload").info(f"Profile report saved to: {PROFILER.stop()}")
 
 
 if __name__ == "__main__":
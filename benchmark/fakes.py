@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+'''压测使用的本地服务替身：云点播ApplyUpload/CommitUpload接口、cos存储桶、s3兼容存储及http源站
+
+替身只记录对象大小，上传的数据读完即丢弃；源站对象的内容按大小实时生成，不占用内存和磁盘'''
+
+import bisect
+import hashlib
+import json
+import threading
+import time
+import uuid
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+# 生成源站对象内容的数据块
+CONTENT_BLOCK = b''.join(bytes(bytearray(range(256))) for _ in range(4096))
+# 读取上传数据时每次读取的大小
+READ_SIZE = 1024 * 1024
+
+FAKE_MTIME = '2024-01-01T00:00:00.000Z'
+FAKE_HTTP_DATE = 'Mon, 01 Jan 2024 00:00:00 GMT'
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# ApplyUpload返回的临时密钥，用于区分访问的是目标存储桶还是迁移源
+TEMP_SECRET_ID = 'fake-temp-secret-id'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''替身请求处理的基类：使用HTTP/1.1长连接，请求前按latency模拟网络往返时间'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self, sink=None):
+        '''读取请求体，返回读取的字节数；sink不为空时传入每块数据'''
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            total = 0
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # 跳过trailer直到空行
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return total
+                total += self.read_exactly(size, sink)
+                self.rfile.readline()
+        return self.read_exactly(int(self.headers.get('Content-Length') or 0), sink)
+
+    def read_exactly(self, size, sink):
+        remaining = size
+        while remaining > 0:
+            data = self.rfile.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            if sink is not None:
+                sink(data)
+            remaining -= len(data)
+        return size - remaining
+
+    def send(self, status, body=b'', headers=None, content_type='application/xml'):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def simulate_latency(self):
+        if self.server.fake.latency > 0:
+            time.sleep(self.server.fake.latency)
+
+
+class FakeService(object):
+    '''在本地随机端口启动的替身服务，在后台线程中处理请求'''
+
+    handler_class = FakeHandler
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def endpoint(self):
+        return '127.0.0.1:{port}'.format(port=self.port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class VodApiHandler(FakeHandler):
+
+    def do_POST(self):
+        self.simulate_latency()
+        body = []
+        self.read_body(body.append)
+        action = self.headers.get('X-TC-Action', '')
+        params = json.loads(b''.join(body).decode('utf-8') or '{}')
+        response = self.server.fake.handle(action, params)
+        self.send(200, json.dumps({'Response': response}), content_type='application/json')
+
+
+class FakeVodApi(FakeService):
+    '''云点播接口替身：ApplyUpload分配存储路径和临时密钥，CommitUpload返回FileId'''
+
+    handler_class = VodApiHandler
+
+    def __init__(self, bucket, region, latency=0):
+        super(FakeVodApi, self).__init__(latency)
+        self.bucket = bucket
+        self.region = region
+        self.sessions = {}
+        self.committed = 0
+
+    def reset(self):
+        with self.lock:
+            self.sessions.clear()
+            self.committed = 0
+
+    def handle(self, action, params):
+        request_id = str(uuid.uuid4())
+        if action == 'ApplyUpload':
+            session_key = uuid.uuid4().hex
+            media_path = '/{session}/media.{media_type}'.format(
+                session=session_key, media_type=params.get('MediaType', 'mp4'))
+            with self.lock:
+                self.sessions[session_key] = media_path
+            return {
+                'StorageBucket': self.bucket,
+                'StorageRegion': self.region,
+                'VodSessionKey': session_key,
+                'MediaStoragePath': media_path,
+                'TempCertificate': {
+                    'SecretId': TEMP_SECRET_ID, 'SecretKey': 'fake', 'Token': 'fake',
+                    'ExpiredTime': int(time.time()) + 3600},
+                'RequestId': request_id}
+        if action == 'CommitUpload':
+            session_key = params.get('VodSessionKey')
+            with self.lock:
+                media_path = self.sessions.pop(session_key, None)
+                if media_path is not None:
+                    self.committed += 1
+            if media_path is None:
+                return {'Error': {'Code': 'InvalidParameterValue.VodSessionKey',
+                                  'Message': 'session not found'}, 'RequestId': request_id}
+            return {
+                'FileId': session_key,
+                'MediaUrl': 'http://vod.example.com{path}'.format(path=media_path),
+                'RequestId': request_id}
+        return {'Error': {'Code': 'InvalidAction', 'Message': action}, 'RequestId': request_id}
+
+
+class ObjectStoreHandler(FakeHandler):
+
+    def parse(self):
+        url = urlparse(self.path)
+        query = dict((name, values[0]) for name, values in parse_qs(url.query, keep_blank_values=True).items())
+        key = unquote(url.path)[1:]
+        if self.server.fake.bucket_in_path:
+            key = key.split('/', 1)[1] if '/' in key else ''
+        return key, query
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.simulate_latency()
+        store = self.server.fake
+        key, query = self.parse()
+        if not key:
+            if 'uploads' in query:
+                self.send(200, '<ListMultipartUploadsResult><IsTruncated>false</IsTruncated>'
+                               '</ListMultipartUploadsResult>')
+            else:
+                self.send(200, store.list_objects(query))
+            return
+
+        obj = store.get(key)
+        if obj is None:
+            self.send(404, '<Error><Code>NoSuchKey</Code></Error>')
+            return
+        size, etag = obj
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, last = range_header[len('bytes='):].split('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"{etag}"'.format(etag=etag))
+        self.send_header('Last-Modified', FAKE_HTTP_DATE)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {start}-{end}/{size}'.format(start=start, end=end, size=size))
+        self.end_headers()
+        if self.command == 'GET':
+            store.write_content(self.wfile, start, end + 1)
+
+    def do_PUT(self):
+        self.simulate_latency()
+        store = self.server.fake
+        key, query = self.parse()
+        md5 = hashlib.md5()
+        size = self.read_body(md5.update)
+        etag = md5.hexdigest()
+        if 'uploadId' in query:
+            store.upload_part(query['uploadId'], int(query['partNumber']), size)
+        else:
+            store.put(key, size, etag)
+        self.send(200, headers={'ETag': '"{etag}"'.format(etag=etag)})
+
+    def do_POST(self):
+        self.simulate_latency()
+        store = self.server.fake
+        key, query = self.parse()
+        self.read_body()
+        if 'uploads' in query:
+            self.send(200, '<InitiateMultipartUploadResult><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                           '</InitiateMultipartUploadResult>'.format(
+                               key=escape(key), upload_id=store.create_upload()))
+        elif 'uploadId' in query:
+            etag = store.complete_upload(key, query['uploadId'])
+            self.send(200, '<CompleteMultipartUploadResult><Key>{key}</Key><ETag>"{etag}"</ETag>'
+                           '</CompleteMultipartUploadResult>'.format(key=escape(key), etag=etag))
+        else:
+            self.send(400, '<Error><Code>InvalidRequest</Code></Error>')
+
+    def do_DELETE(self):
+        self.simulate_latency()
+        key, query = self.parse()
+        if 'uploadId' in query:
+            self.server.fake.abort_upload(query['uploadId'])
+        self.send(204)
+
+
+class FakeObjectStore(FakeService):
+    '''对象存储替身：支持简单上传、分块上传、HEAD/GET（含Range）以及cos（v1）和s3（v2）列举，
+    同时可作为http源站；bucket_in_path为True时按s3 path-style从路径中去掉存储桶名'''
+
+    handler_class = ObjectStoreHandler
+
+    def __init__(self, bucket_in_path=False, latency=0):
+        super(FakeObjectStore, self).__init__(latency)
+        self.bucket_in_path = bucket_in_path
+        self.objects = {}
+        self.keys = []
+        self.uploads = {}
+        self.received_bytes = 0
+
+    def reset(self):
+        with self.lock:
+            self.objects.clear()
+            self.keys = []
+            self.uploads.clear()
+            self.received_bytes = 0
+
+    def add_object(self, key, size):
+        '''添加源站对象，内容在读取时生成'''
+
+        self.put(key, size, hashlib.md5(key.encode('utf-8')).hexdigest(), received=False)
+
+    def get(self, key):
+        with self.lock:
+            return self.objects.get(key)
+
+    def put(self, key, size, etag, received=True):
+        with self.lock:
+            if key not in self.objects:
+                bisect.insort(self.keys, key)
+            self.objects[key] = (size, etag)
+            if received:
+                self.received_bytes += size
+
+    def create_upload(self):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, upload_id, part_number, size):
+        with self.lock:
+            self.uploads[upload_id][part_number] = size
+            self.received_bytes += size
+
+    def complete_upload(self, key, upload_id):
+        with self.lock:
+            parts = self.uploads.pop(upload_id)
+        etag = '{upload_id}-{num}'.format(upload_id=upload_id, num=len(parts))
+        self.put(key, sum(parts.values()), etag, received=False)
+        return etag
+
+    def abort_upload(self, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+    def write_content(self, wfile, start, end):
+        block_size = len(CONTENT_BLOCK)
+        offset = start
+        while offset < end:
+            block_offset = offset % block_size
+            length = min(block_size - block_offset, end - offset)
+            wfile.write(CONTENT_BLOCK[block_offset:block_offset + length])
+            offset += length
+
+    def list_objects(self, query):
+        '''list-type=2时按s3 ListObjectsV2返回，否则按cos GET Bucket返回'''
+
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys') or 1000)
+        v2 = query.get('list-type') == '2'
+        if v2:
+            marker = query.get('continuation-token') or query.get('start-after') or ''
+        else:
+            marker = query.get('marker', '')
+        with self.lock:
+            index = bisect.bisect_right(self.keys, marker) if marker else bisect.bisect_left(self.keys, prefix)
+            contents = []
+            while index < len(self.keys) and len(contents) < max_keys:
+                key = self.keys[index]
+                if not key.startswith(prefix):
+                    break
+                contents.append((key, self.objects[key]))
+                index += 1
+            truncated = index < len(self.keys) and self.keys[index].startswith(prefix)
+
+        lines = ['<ListBucketResult xmlns="{xmlns}">'.format(xmlns=S3_XMLNS),
+                 '<Prefix>{prefix}</Prefix>'.format(prefix=escape(prefix)),
+                 '<MaxKeys>{max_keys}</MaxKeys>'.format(max_keys=max_keys),
+                 '<IsTruncated>{truncated}</IsTruncated>'.format(truncated='true' if truncated else 'false')]
+        if v2:
+            lines.append('<KeyCount>{num}</KeyCount>'.format(num=len(contents)))
+        if truncated:
+            lines.append('<{tag}>{marker}</{tag}>'.format(
+                tag='NextContinuationToken' if v2 else 'NextMarker', marker=escape(contents[-1][0])))
+        for key, (size, etag) in contents:
+            lines.append(
+                '<Contents><Key>{key}</Key><LastModified>{mtime}</LastModified><ETag>"{etag}"</ETag>'
+                '<Size>{size}</Size><StorageClass>STANDARD</StorageClass></Contents>'.format(
+                    key=escape(key), mtime=FAKE_MTIME, etag=etag, size=size))
+        lines.append('</ListBucketResult>')
+        return ''.join(lines)
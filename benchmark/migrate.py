@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''在独立进程中执行一次迁移：将云点播、cos的sdk客户端指向本地替身，计时后把结果写入json文件
+
+python -m benchmark.migrate config.toml endpoints.json result.json'''
+
+import json
+import os
+import sys
+import time
+
+
+def patch_endpoints(endpoints):
+    '''云点播接口和cos的访问地址在sdk内部根据地域拼接，这里替换为替身的地址；
+    s3通过AWS_ENDPOINT_URL_S3环境变量指定，http源站直接写在url列表中'''
+
+    import qcloud_cos
+    from tencentcloud.common.profile.client_profile import ClientProfile
+    from tencentcloud.common.profile.http_profile import HttpProfile
+    from tencentcloud.vod.v20180717 import vod_client
+    from qcloud_vod_migrate import upload
+    from benchmark.fakes import TEMP_SECRET_ID
+
+    class VodClient(vod_client.VodClient):
+        def __init__(self, credential, region, profile=None):
+            profile = ClientProfile(httpProfile=HttpProfile(protocol='http', endpoint=endpoints['vod']))
+            super(VodClient, self).__init__(credential, region, profile)
+
+    class CosConfig(qcloud_cos.CosConfig):
+        def __init__(self, **kwargs):
+            # 迁移源使用源站替身，ApplyUpload分配的存储桶使用目标替身
+            name = 'cos' if kwargs.get('SecretId') == TEMP_SECRET_ID else 'cosSource'
+            host, port = endpoints[name].split(':')
+            kwargs.update(Scheme='http', IP=host, Port=int(port))
+            super(CosConfig, self).__init__(**kwargs)
+
+    vod_client.VodClient = VodClient
+    upload.CosConfig = CosConfig
+    # 迁移源在选中时才导入，导入时取得替换后的CosConfig
+    qcloud_cos.CosConfig = CosConfig
+    os.environ['AWS_ENDPOINT_URL_S3'] = 'http://{endpoint}'.format(endpoint=endpoints['s3'])
+    os.environ['NO_PROXY'] = '127.0.0.1'
+
+
+def main():
+    conf_path, endpoints_path, result_path = sys.argv[1:4]
+    with open(endpoints_path) as f:
+        patch_endpoints(json.load(f))
+
+    from qcloud_vod_migrate import cmd
+    sys.argv = ['vodmigrate', conf_path] + sys.argv[4:]
+    start_time = time.time()
+    cmd._main()
+    seconds = time.time() - start_time
+    with open(result_path, 'w') as f:
+        json.dump({'seconds': seconds, 'exit_code': cmd.res}, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+'''端到端吞吐量压测：启动云点播接口、cos存储桶、s3兼容存储和http源站的本地替身，
+按迁移类型、并发数和文件大小分布逐一执行迁移，统计 files/s 和 MB/s，结果保存为json便于跨版本对比
+
+python -m benchmark.run [--types migrateLocal,migrateUrl] [--concurrency 1,4,16] [--distributions small,mixed]
+                        [--scale 1] [--latency-ms 0] [--output result.json] [--compare baseline.json]'''
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmark.fakes import FakeVodApi, FakeObjectStore
+
+KB = 1024
+MB = 1024 * 1024
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 文件大小分布：files为文件数，sizes为 [(权重, 文件大小)]，每个文件的大小在此基础上随机浮动20%
+DISTRIBUTIONS = {
+    'small': {'files': 200, 'sizes': [(1, 256 * KB)]},
+    'medium': {'files': 40, 'sizes': [(1, 8 * MB)]},
+    'large': {'files': 4, 'sizes': [(1, 64 * MB)]},
+    'mixed': {'files': 100, 'sizes': [(9, 512 * KB), (1, 16 * MB)]},
+}
+SIZE_JITTER = 0.2
+
+# 支持替身的迁移类型，阿里云oss和七牛的sdk只支持按存储桶域名访问，未包含在内
+MIGRATE_TYPES = ('migrateLocal', 'migrateUrl', 'migrateCos', 'migrateAws')
+
+DEFAULT_TYPES = 'migrateLocal,migrateUrl,migrateCos,migrateAws'
+DEFAULT_CONCURRENCY = '1,4,16'
+DEFAULT_DISTRIBUTIONS = 'small,medium,mixed'
+
+VOD_BUCKET = 'vod-bench-1250000000'
+SOURCE_BUCKET = 'source-bench-1250000000'
+REGION = 'ap-guangzhou'
+
+# 单次迁移的超时时间（秒）
+RUN_TIMEOUT = 3600
+
+CONFIG_TEMPLATE = u'''[migrateType]
+type = '{migrate_type}'
+
+[common]
+secretId = 'bench'
+secretKey = 'bench'
+region = '{region}'
+subAppId = 0
+concurrency = {concurrency}
+supportMediaClassification = [ 'video', 'audio', 'image' ]
+excludeMediaType = []
+migrateDbStoragePath = '{run_dir}'
+migrateResultOutputPath = '{run_dir}'
+maxAttempts = 1
+
+[common.storagePath]
+useOriginal = false
+prefix = ''
+
+[migrateLocal]
+localPath = '{local_path}'
+excludes = []
+
+[migrateUrl]
+urllistPath = '{url_list_path}'
+
+[migrateCos]
+region = '{region}'
+bucket = '{source_bucket}'
+secretId = 'bench'
+secretKey = 'bench'
+prefix = '{prefix}'
+
+[migrateAws]
+region = 'us-east-1'
+bucket = '{source_bucket}'
+accessKeyId = 'bench'
+accessKeySecret = 'bench'
+prefix = '{prefix}'
+'''
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def generate_sizes(distribution, scale, seed=0):
+    '''按分布生成各文件的大小，同一分布每次生成的结果相同'''
+
+    rand = random.Random(seed)
+    spec = DISTRIBUTIONS[distribution]
+    weights = [weight for weight, _ in spec['sizes']]
+    sizes = []
+    for _ in range(max(1, int(spec['files'] * scale))):
+        point = rand.uniform(0, sum(weights))
+        for weight, size in spec['sizes']:
+            point -= weight
+            if point <= 0:
+                break
+        sizes.append(int(size * rand.uniform(1 - SIZE_JITTER, 1 + SIZE_JITTER)))
+    return sizes
+
+
+def write_local_files(path, sizes):
+    block = os.urandom(MB)
+    for i, size in enumerate(sizes):
+        with open(os.path.join(path, '{i:06d}.mp4'.format(i=i)), 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:min(remaining, len(block))])
+                remaining -= len(block)
+
+
+class Benchmark(object):
+    '''启动替身并依次执行各组合的迁移'''
+
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = tempfile.mkdtemp(prefix='vodmigrate_bench_')
+        latency = args.latency_ms / 1000.0
+        self.vod = FakeVodApi(VOD_BUCKET, REGION, latency).start()
+        self.cos = FakeObjectStore(latency=latency).start()
+        # cos迁移源同时作为url列表的http源站
+        self.source = FakeObjectStore(latency=latency).start()
+        self.s3 = FakeObjectStore(bucket_in_path=True, latency=latency).start()
+        self.endpoints_path = os.path.join(self.work_dir, 'endpoints.json')
+        with open(self.endpoints_path, 'w') as f:
+            json.dump({'vod': self.vod.endpoint, 'cos': self.cos.endpoint,
+                       'cosSource': self.source.endpoint, 's3': self.s3.endpoint}, f)
+
+    def close(self):
+        for service in (self.vod, self.cos, self.source, self.s3):
+            service.stop()
+        if not self.args.keep:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def prepare(self, distribution, sizes):
+        '''准备迁移源：本地文件、源站对象和url列表'''
+
+        prefix = '{distribution}/'.format(distribution=distribution)
+        local_path = os.path.join(self.work_dir, 'local', distribution)
+        if 'migrateLocal' in self.args.types and not os.path.exists(local_path):
+            os.makedirs(local_path)
+            write_local_files(local_path, sizes)
+        url_list_path = os.path.join(self.work_dir, '{distribution}.txt'.format(distribution=distribution))
+        with open(url_list_path, 'w') as f:
+            for i, size in enumerate(sizes):
+                key = '{prefix}{i:06d}.mp4'.format(prefix=prefix, i=i)
+                self.source.add_object(key, size)
+                self.s3.add_object(key, size)
+                f.write('http://{endpoint}/{key}\n'.format(endpoint=self.source.endpoint, key=key))
+        return prefix, local_path, url_list_path
+
+    def run_one(self, migrate_type, distribution, concurrency, sizes, prefix, local_path, url_list_path):
+        run_dir = os.path.join(self.work_dir, 'runs', '{migrate_type}-{distribution}-c{concurrency}'.format(
+            migrate_type=migrate_type, distribution=distribution, concurrency=concurrency))
+        os.makedirs(run_dir)
+        conf_path = os.path.join(run_dir, 'config.toml')
+        with io.open(conf_path, 'w', encoding='utf-8') as f:
+            f.write(CONFIG_TEMPLATE.format(
+                migrate_type=migrate_type, region=REGION, concurrency=concurrency, run_dir=run_dir,
+                local_path=local_path, url_list_path=url_list_path, source_bucket=SOURCE_BUCKET, prefix=prefix))
+        result_path = os.path.join(run_dir, 'result.json')
+
+        self.vod.reset()
+        self.cos.reset()
+        command = [sys.executable, '-m', 'benchmark.migrate', conf_path, self.endpoints_path, result_path]
+        if self.args.profile:
+            command += ['--profile', '--profile-output', os.path.join(run_dir, 'profile.txt')]
+        with open(os.path.join(run_dir, 'migrate.log'), 'w') as log:
+            process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=log, stderr=subprocess.STDOUT)
+            deadline = time.time() + RUN_TIMEOUT
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+        seconds = None
+        if os.path.exists(result_path):
+            with open(result_path) as f:
+                seconds = json.load(f)['seconds']
+        files = self.vod.committed
+        transferred = self.cos.received_bytes
+        result = {
+            'migrate_type': migrate_type,
+            'distribution': distribution,
+            'concurrency': concurrency,
+            'files': len(sizes),
+            'bytes': sum(sizes),
+            'migrated_files': files,
+            'transferred_bytes': transferred,
+            'failed_files': len(sizes) - files,
+            'seconds': seconds,
+            'files_per_second': files / seconds if seconds else 0,
+            'mb_per_second': transferred / float(MB) / seconds if seconds else 0,
+        }
+        print('{migrate_type:<14}{distribution:<8}{concurrency:>6}{files:>8}{seconds:>10}{fps:>10.1f}{mbps:>10.1f}{failed:>8}'.format(
+            migrate_type=migrate_type, distribution=distribution, concurrency=concurrency, files=files,
+            seconds='{0:.2f}'.format(seconds) if seconds else 'error', fps=result['files_per_second'],
+            mbps=result['mb_per_second'], failed=result['failed_files']))
+        if seconds is None or result['failed_files'] > 0:
+            print('  see {path}'.format(path=os.path.join(run_dir, 'migrate.log')))
+        return result
+
+    def run(self):
+        print('{migrate_type:<14}{distribution:<8}{concurrency:>6}{files:>8}{seconds:>10}{fps:>10}{mbps:>10}{failed:>8}'.format(
+            migrate_type='type', distribution='sizes', concurrency='conc', files='files',
+            seconds='seconds', fps='files/s', mbps='MB/s', failed='failed'))
+        results = []
+        for distribution in self.args.distributions:
+            sizes = generate_sizes(distribution, self.args.scale)
+            prefix, local_path, url_list_path = self.prepare(distribution, sizes)
+            for migrate_type in self.args.types:
+                for concurrency in self.args.concurrency:
+                    results.append(self.run_one(
+                        migrate_type, distribution, concurrency, sizes, prefix, local_path, url_list_path))
+        return results
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=REPO_ROOT,
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except Exception:
+        return ''
+
+
+def compare(results, baseline_path):
+    '''与之前保存的结果对比，输出各组合吞吐量的变化'''
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print('')
+    print('compared with {path} ({revision})'.format(
+        path=baseline_path, revision=baseline.get('meta', {}).get('revision', '')))
+    base = dict(((r['migrate_type'], r['distribution'], r['concurrency']), r) for r in baseline['results'])
+    matched = 0
+    for result in results:
+        old = base.get((result['migrate_type'], result['distribution'], result['concurrency']))
+        if old is None or not old['mb_per_second'] or not old['files_per_second']:
+            continue
+        matched += 1
+        print('{migrate_type:<14}{distribution:<8}{concurrency:>6}  MB/s {old_mbps:.1f} -> {mbps:.1f} ({mbps_change:+.1%})'
+              '  files/s {old_fps:.1f} -> {fps:.1f} ({fps_change:+.1%})'.format(
+                  migrate_type=result['migrate_type'], distribution=result['distribution'],
+                  concurrency=result['concurrency'],
+                  old_mbps=old['mb_per_second'], mbps=result['mb_per_second'],
+                  mbps_change=result['mb_per_second'] / old['mb_per_second'] - 1,
+                  old_fps=old['files_per_second'], fps=result['files_per_second'],
+                  fps_change=result['files_per_second'] / old['files_per_second'] - 1))
+    if matched == 0:
+        print('no matching type/sizes/concurrency in the baseline')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark.run', description='end-to-end migration throughput benchmark with local fakes')
+    parser.add_argument('--types', type=parse_list, default=parse_list(DEFAULT_TYPES),
+                        help='migrate types to run (default: %(default)s)')
+    parser.add_argument('--concurrency', type=lambda value: [int(c) for c in parse_list(value)],
+                        default=[int(c) for c in parse_list(DEFAULT_CONCURRENCY)],
+                        help='concurrency levels (default: %(default)s)')
+    parser.add_argument('--distributions', type=parse_list, default=parse_list(DEFAULT_DISTRIBUTIONS),
+                        help='file size distributions: {names} (default: %(default)s)'.format(
+                            names=', '.join(sorted(DISTRIBUTIONS))))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of files of each distribution')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='latency added to every request served by the fakes')
+    parser.add_argument('--output', help='result json path (default: benchmark_<revision>_<time>.json)')
+    parser.add_argument('--compare', help='baseline result json to compare with')
+    parser.add_argument('--profile', action='store_true', help='run each migration with --profile')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with logs and databases')
+    args = parser.parse_args()
+    for migrate_type in args.types:
+        if migrate_type not in MIGRATE_TYPES:
+            parser.error('unsupported migrate type: {migrate_type}'.format(migrate_type=migrate_type))
+    for distribution in args.distributions:
+        if distribution not in DISTRIBUTIONS:
+            parser.error('unknown distribution: {distribution}'.format(distribution=distribution))
+    return args
+
+
+def main():
+    args = parse_args()
+    revision = get_git_revision()
+    started_at = datetime.datetime.now()
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.run()
+    finally:
+        benchmark.close()
+    if args.keep:
+        print('work directory: {path}'.format(path=benchmark.work_dir))
+
+    output = args.output or 'benchmark_{revision}_{time}.json'.format(
+        revision=revision or 'unknown', time=started_at.strftime('%Y%m%d_%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {
+                'revision': revision,
+                'started_at': started_at.isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+                'scale': args.scale,
+                'latency_ms': args.latency_ms,
+            },
+            'results': results,
+        }, f, indent=2)
+    print('results saved to {path}'.format(path=output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
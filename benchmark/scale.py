@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+'''扫描和迁移记录存储的规模压测：合成分页列举结果和本地目录树，测量百万到数千万条记录时
+扫描入库速度、领取未完成记录的延迟、完成记录的写入速度、结果导出耗时以及db文件大小
+
+python -m benchmark.scale [--records 1000000] [--tree-files 100000] [--output scale.json]'''
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from benchmark.run import get_git_revision
+
+MB = 1024 * 1024
+
+DEFAULT_RECORDS = 1000000
+DEFAULT_TREE_FILES = 100000
+# 合成目录树每层的子目录数和每个目录的文件数
+TREE_FANOUT = 32
+TREE_FILES_PER_DIR = 200
+# 合成文件的大小：本地目录树中的文件为稀疏文件，不占用磁盘
+SYNTHETIC_FILE_SIZE = 8 * MB
+
+# 在这些完成比例时测量领取未完成记录的延迟
+CLAIM_CHECKPOINTS = (0.0, 0.5, 0.9, 0.99)
+# 每个完成比例测量的领取次数
+CLAIM_SAMPLES = 5
+CLAIM_OWNER = 'scale-benchmark'
+# 租约立即过期：测量后记录仍可再次领取，不影响后续完成比例的剩余记录数
+CLAIM_LEASE_SECONDS = -1
+
+CONFIG_TEMPLATE = u'''[migrateType]
+type = '{migrate_type}'
+
+[common]
+secretId = 'bench'
+secretKey = 'bench'
+region = 'ap-guangzhou'
+concurrency = 16
+supportMediaClassification = [ 'video', 'audio', 'image' ]
+excludeMediaType = []
+migrateDbStoragePath = '{work_dir}'
+migrateResultOutputPath = '{work_dir}'
+
+[common.storagePath]
+useOriginal = false
+prefix = ''
+
+[migrateLocal]
+localPath = '{local_path}'
+excludes = []
+
+[migrateCos]
+region = 'ap-guangzhou'
+bucket = 'source-bench-1250000000'
+secretId = 'bench'
+secretKey = 'bench'
+prefix = ''
+'''
+
+
+def load_manager(work_dir, migrate_type, local_path=''):
+    '''在work_dir中创建新的迁移db，返回MigrateManager和配置文件路径'''
+
+    from qcloud_vod_migrate.cmd import _load_config
+    from qcloud_vod_migrate.manager import MigrateManager
+
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    conf_path = os.path.join(work_dir, 'config.toml')
+    with io.open(conf_path, 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(migrate_type=migrate_type, work_dir=work_dir, local_path=local_path))
+    migrate_manager = MigrateManager(conf=_load_config(conf_path))
+    migrate_manager.init_migrate_db()
+    migrate_manager.init_migrate_status(conf_path)
+    return migrate_manager
+
+
+def get_db_size(work_dir):
+    '''db文件及wal文件的总大小'''
+
+    from qcloud_vod_migrate.manager import MIGRATE_DB
+
+    path = os.path.join(work_dir, MIGRATE_DB)
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def timed_call(func, *args, **kwargs):
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start_time, result
+
+
+class SyntheticListing(object):
+    '''合成的分页列举结果，替换对象存储迁移源的list_pages'''
+
+    def __init__(self, source, records, page_size):
+        self.source = source
+        self.records = records
+        self.page_size = page_size
+
+    def list_pages(self, cursor=None):
+        from qcloud_vod_migrate.source.base import SourceObject
+
+        mtime = time.time()
+        for start in range(0, self.records, self.page_size):
+            yield [SourceObject('videos/{dir:05d}/{i:09d}.mp4'.format(dir=i // 10000, i=i),
+                                SYNTHETIC_FILE_SIZE + i % 1024, mtime, '"{i:032x}"'.format(i=i))
+                   for i in range(start, min(start + self.page_size, self.records))]
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+def write_tree(path, files):
+    '''合成本地目录树：每个目录TREE_FILES_PER_DIR个文件，目录按TREE_FANOUT分层'''
+
+    for i in range(files):
+        dir_index = i // TREE_FILES_PER_DIR
+        parts = []
+        while True:
+            parts.append('d{index:02d}'.format(index=dir_index % TREE_FANOUT))
+            dir_index //= TREE_FANOUT
+            if dir_index == 0:
+                break
+        dir_path = os.path.join(path, *reversed(parts))
+        if i % TREE_FILES_PER_DIR == 0 and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, '{i:09d}.mp4'.format(i=i)), 'wb') as f:
+            f.truncate(SYNTHETIC_FILE_SIZE)
+
+
+def bench_tree_scan(work_dir, files):
+    '''扫描本地目录树并入库'''
+
+    from qcloud_vod_migrate.execute import TaskProducer
+
+    tree_path = os.path.join(work_dir, 'tree')
+    os.makedirs(tree_path)
+    print('writing {files} files to {path}'.format(files=files, path=tree_path))
+    write_tree(tree_path, files)
+
+    db_dir = os.path.join(work_dir, 'tree_db')
+    migrate_manager = load_manager(db_dir, 'migrateLocal', tree_path)
+    producer = TaskProducer(migrate_manager=migrate_manager)
+    seconds, _ = timed_call(producer.run)
+    migrate_manager.record_writer.close()
+    result = {
+        'files': files,
+        'seconds': seconds,
+        'records_per_second': files / seconds,
+        'db_bytes': get_db_size(db_dir),
+    }
+    print('tree scan: {files} files in {seconds:.1f}s, {rate:.0f} records/s, db {db:.1f}MB'.format(
+        files=files, seconds=seconds, rate=result['records_per_second'], db=result['db_bytes'] / float(MB)))
+    shutil.rmtree(tree_path, ignore_errors=True)
+    return result
+
+
+def measure_claims(migrate_manager, migrate_type):
+    '''领取未完成记录的延迟：按默认顺序和按文件大小倒序（largest_first/mixed策略）分别领取'''
+
+    from qcloud_vod_migrate.manager import MigrateRecord, MAX_FETCH_NUM
+
+    latencies = {}
+    for name, order_by in (('default', None), ('filesize_desc', MigrateRecord.filesize.desc())):
+        samples = []
+        for _ in range(CLAIM_SAMPLES):
+            seconds, records = timed_call(
+                migrate_manager.claim_migrate_records, migrate_type, CLAIM_OWNER, MAX_FETCH_NUM,
+                CLAIM_LEASE_SECONDS, order_by=order_by)
+            if len(records) == 0:
+                break
+            samples.append(seconds)
+        samples.sort()
+        latencies[name] = {
+            'median_ms': samples[len(samples) // 2] * 1000 if samples else None,
+            'max_ms': samples[-1] * 1000 if samples else None,
+        }
+    return latencies
+
+
+def complete_records(migrate_manager, migrate_type, last_id, num):
+    '''按id顺序将num条记录保存为迁移成功，与迁移时一样经由写入线程批量提交并追加结果日志'''
+
+    from qcloud_vod_migrate.manager import MIGRATE_TASK_SUCCESS, MAX_FETCH_NUM
+
+    completed = 0
+    while completed < num:
+        records = migrate_manager.get_migrate_results(last_id, min(MAX_FETCH_NUM, num - completed))
+        if len(records) == 0:
+            break
+        for record in records:
+            record.status = MIGRATE_TASK_SUCCESS
+            record.file_id = str(record.id)
+            record.vod_url = 'http://vod.example.com/{id}.mp4'.format(id=record.id)
+            record.owner = ''
+            migrate_manager.save_migrate_record(record)
+        last_id = records[-1].id
+        completed += len(records)
+    migrate_manager.flush_migrate_records()
+    return last_id, completed
+
+
+def bench_record_store(work_dir, records, page_size):
+    '''合成分页列举结果入库，随后模拟迁移过程：在各完成比例测量领取延迟，最后导出结果'''
+
+    from qcloud_vod_migrate.execute import TaskProducer
+
+    migrate_type = 'migrateCos'
+    db_dir = os.path.join(work_dir, 'listing_db')
+    migrate_manager = load_manager(db_dir, migrate_type)
+    producer = TaskProducer(migrate_manager=migrate_manager)
+    producer.source = SyntheticListing(producer.source, records, page_size)
+    ingest_seconds, _ = timed_call(producer.run)
+    result = {
+        'records': records,
+        'ingest_seconds': ingest_seconds,
+        'ingest_records_per_second': records / ingest_seconds,
+        'db_bytes_after_ingest': get_db_size(db_dir),
+    }
+    print('ingest: {records} records in {seconds:.1f}s, {rate:.0f} records/s, db {db:.1f}MB'.format(
+        records=records, seconds=ingest_seconds, rate=result['ingest_records_per_second'],
+        db=result['db_bytes_after_ingest'] / float(MB)))
+
+    result['init_counter_seconds'], _ = timed_call(migrate_manager.init_counter)
+    print('init_counter: {seconds:.2f}s'.format(seconds=result['init_counter_seconds']))
+
+    migrate_manager.update_execute_begin_time()
+    result['claims'] = []
+    last_id = 0
+    completed = 0
+    complete_seconds = 0
+    for checkpoint in CLAIM_CHECKPOINTS:
+        seconds, (last_id, num) = timed_call(
+            complete_records, migrate_manager, migrate_type, last_id, int(records * checkpoint) - completed)
+        completed += num
+        complete_seconds += seconds
+        latencies = measure_claims(migrate_manager, migrate_type)
+        result['claims'].append({'completed': checkpoint, 'latency': latencies})
+        print('claim at {checkpoint:.0%} completed: default {default} ms, filesize desc {largest} ms'.format(
+            checkpoint=checkpoint,
+            default='{0:.1f}'.format(latencies['default']['median_ms']) if latencies['default']['median_ms'] else '-',
+            largest='{0:.1f}'.format(latencies['filesize_desc']['median_ms'])
+            if latencies['filesize_desc']['median_ms'] else '-'))
+
+    seconds, (last_id, num) = timed_call(complete_records, migrate_manager, migrate_type, last_id, records)
+    completed += num
+    complete_seconds += seconds
+    result['complete_records_per_second'] = completed / complete_seconds if complete_seconds else 0
+    print('complete: {num} records, {rate:.0f} records/s'.format(
+        num=completed, rate=result['complete_records_per_second']))
+
+    # 正常结束时合并结果日志；结果日志不完整时从db全量导出
+    migrate_manager.init_counter()
+    result['export_journal_seconds'], _ = timed_call(migrate_manager.output_migrate_results)
+    result_file = migrate_manager.get_result_file()
+    result['result_file_bytes'] = os.path.getsize(result_file)
+    migrate_manager.journal.clear()
+    result['export_db_seconds'], _ = timed_call(migrate_manager.output_migrate_results)
+    print('export: from journal {journal:.1f}s, from db {db:.1f}s, result file {size:.1f}MB'.format(
+        journal=result['export_journal_seconds'], db=result['export_db_seconds'],
+        size=result['result_file_bytes'] / float(MB)))
+
+    migrate_manager.record_writer.close()
+    result['db_bytes'] = get_db_size(db_dir)
+    print('db size: {size:.1f}MB ({per_record:.0f} bytes/record)'.format(
+        size=result['db_bytes'] / float(MB), per_record=result['db_bytes'] / float(records)))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark.scale', description='scan and record store microbenchmarks at scale')
+    parser.add_argument('--records', type=int, default=DEFAULT_RECORDS,
+                        help='records in the synthetic listing (default: %(default)s)')
+    parser.add_argument('--page-size', type=int, default=1000, help='records per listing page')
+    parser.add_argument('--tree-files', type=int, default=DEFAULT_TREE_FILES,
+                        help='files in the synthetic directory tree, 0 to skip (default: %(default)s)')
+    parser.add_argument('--work-dir', help='directory for the databases and the tree (default: a temp dir)')
+    parser.add_argument('--output', help='result json path (default: scale_<revision>_<time>.json)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    from qcloud_vod_migrate.cmd import _init_logger
+    _init_logger()
+
+    revision = get_git_revision()
+    started_at = datetime.datetime.now()
+    work_dir = tempfile.mkdtemp(prefix='vodmigrate_scale_', dir=args.work_dir)
+    try:
+        results = {'record_store': bench_record_store(work_dir, args.records, args.page_size)}
+        if args.tree_files > 0:
+            results['tree_scan'] = bench_tree_scan(work_dir, args.tree_files)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or 'scale_{revision}_{time}.json'.format(
+        revision=revision or 'unknown', time=started_at.strftime('%Y%m%d_%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {
+                'revision': revision,
+                'started_at': started_at.isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'sqlite': __import__('sqlite3').sqlite_version,
+            },
+            'results': results,
+        }, f, indent=2)
+    print('results saved to {path}'.format(path=output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
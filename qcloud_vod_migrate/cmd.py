@@ -1,10 +1,21 @@
 # -*- coding:utf-8 -*-
 
+import argparse
 import logging
+import multiprocessing
+import signal
 import sys
-from qcloud_vod_migrate.config import ConfigParser
+import time
+from qcloud_vod_migrate.config import ConfigParser, MIGRATE_FROM_LOCAL
 from qcloud_vod_migrate.manager import MigrateManager, MIGRATE_INIT
+from qcloud_vod_migrate.dedup import Deduplicator
 from qcloud_vod_migrate.execute import TaskProducer, TaskConsumer
+from qcloud_vod_migrate.library import VodLibrary
+from qcloud_vod_migrate.log import init_logger, stop_logger, LOG_FORMATS, LOG_FORMAT_TEXT, LOG_LEVELS
+from qcloud_vod_migrate.plan import MigratePlanner
+from qcloud_vod_migrate.metrics import start_metrics_exporter
+from qcloud_vod_migrate.profiler import start_profiler, stop_profiler, PROFILE_MODES, PROFILE_SAMPLE, DEFAULT_PROFILE_OUTPUT
+from qcloud_vod_migrate.watch import LocalWatcher
 from qcloud_vod_migrate.util import fs_coding
 from six import PY2
 
@@ -14,51 +25,199 @@ logger.setLevel(logging.INFO)
 global res
 
 
+def _init_logger(log_format=LOG_FORMAT_TEXT, log_level="info"):
+    init_logger(log_format, getattr(logging, log_level.upper()))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='vodmigrate', usage='vodmigrate config.toml [--workers N] [--join] [--incremental] [--watch] [--profile [MODE]] '
+              '[--log-format FORMAT] [--log-level LEVEL] '
+              '[--plan [--plan-sample N] [--plan-output FILE]]')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of worker processes consuming migrate records concurrently')
+    parser.add_argument(
+        '--join', action='store_true',
+        help='join a migration started elsewhere as an extra worker, '
+             'sharing its database (see migrateDbUrl); no scanning is done')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='rescan the source of an existing migration and migrate only '
+             'new or changed files (compared by mtime/size/etag)')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running after the initial migration and migrate new or changed '
+             'files under localPath (migrateLocal only), stop with Ctrl-C or SIGTERM')
+    parser.add_argument(
+        '--profile', nargs='?', const=PROFILE_SAMPLE, choices=PROFILE_MODES,
+        help='record timings of scan pages, db writes and upload phases, and profile all threads '
+             'with a periodic stack sampler (sample, default) or per-thread cProfile (cprofile); '
+             'the report is written at exit')
+    parser.add_argument(
+        '--profile-output', default=DEFAULT_PROFILE_OUTPUT,
+        help='profile report path, worker N of --workers writes to name.N.ext (default: %(default)s)')
+    parser.add_argument(
+        '--log-format', default=LOG_FORMAT_TEXT, choices=LOG_FORMATS,
+        help='log as plain text lines or as one json object per line (default: %(default)s)')
+    parser.add_argument(
+        '--log-level', default='info', choices=LOG_LEVELS,
+        help='debug also logs every skipped file and the ApplyUpload/CommitUpload '
+             'requests and responses (default: %(default)s)')
+    parser.add_argument(
+        '--plan', action='store_true',
+        help='dry run: scan and filter the source without touching the migrate database or uploading, '
+             'and report files and bytes to migrate by media class, extension and prefix')
+    parser.add_argument(
+        '--plan-sample', type=int, default=0, metavar='N',
+        help='with --plan, read N randomly chosen source files (without uploading) '
+             'to measure throughput and estimate the migration duration')
+    parser.add_argument(
+        '--plan-output', metavar='FILE', help='with --plan, also save the plan as json')
+    return parser.parse_args()
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def _load_config(conf_path):
+    config = ConfigParser.parse(conf_path)
+
+    # 兼容中文,避免str与unicode类型字符串拼接时报UnicodeDecodeError
+    if PY2:
+        config.common.region = config.common.region.encode(fs_coding)
+        config.common.secretId = config.common.secretId.encode(fs_coding)
+        config.common.secretKey = config.common.secretKey.encode(fs_coding)
+
+    return config
+
+
+def _run_worker(conf_path, index=0, profile=None, profile_output=DEFAULT_PROFILE_OUTPUT,
+                log_format=LOG_FORMAT_TEXT, log_level="info"):
+    '''加入已有的迁移，作为额外的工作进程领取并执行迁移任务；
+    index为本机工作进程的序号，用于区分各进程的指标端口、指标文件和性能分析报告'''
+
+    _init_logger(log_format, log_level)
+    exporter = None
+    profiler = None
+    try:
+        profiler = start_profiler(profile, profile_output, index)
+        config = _load_config(conf_path)
+        migrate_manager = MigrateManager(conf=config)
+        exporter = start_metrics_exporter(migrate_manager.metrics, config, index)
+
+        # 等待发起迁移的进程完成源站扫描
+        while migrate_manager.get_migrate_status() == MIGRATE_INIT:
+            time.sleep(5)
+        if not migrate_manager.check_config_file(conf_path):
+            raise Exception("config has changed, exit!")
+
+        task_consumer = TaskConsumer(
+            migrate_manager=migrate_manager, finalize=False)
+        task_consumer.run()
+    except Exception as e:
+        logger.error(e)
+        return -2
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        stop_profiler(profiler)
+        stop_logger()
+
+    return 0
+
+
 def _main():
     global res
     res = 0
+    exporter = None
+    profiler = None
     try:
         if len(sys.argv) < 2:
             res = -1
-            print('Usage: vodmigrate config.toml')
+            print('Usage: vodmigrate config.toml [--workers N] [--join] [--incremental] [--watch] [--profile [MODE]] '
+                  '[--log-format FORMAT] [--log-level LEVEL] [--plan [--plan-sample N] [--plan-output FILE]]')
             return
 
-        logger = logging.getLogger('cmd')
-        console = logging.StreamHandler(sys.stdout)
-        console.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
-        logger.setLevel(logging.INFO)
-        logger.addHandler(console)
+        args = _parse_args()
+        _init_logger(args.log_format, args.log_level)
 
-        conf_path = sys.argv[1]
-        config = ConfigParser.parse(conf_path)
+        if args.join:
+            res = _run_worker(args.config, profile=args.profile, profile_output=args.profile_output,
+                              log_format=args.log_format, log_level=args.log_level)
+            return
 
-        # 兼容中文,避免str与unicode类型字符串拼接时报UnicodeDecodeError
-        if PY2:
-            config.common.region = config.common.region.encode(fs_coding)
-            config.common.secretId = config.common.secretId.encode(fs_coding)
-            config.common.secretKey = config.common.secretKey.encode(fs_coding)
+        profiler = start_profiler(args.profile, args.profile_output)
+
+        conf_path = args.config
+        config = _load_config(conf_path)
+        if args.plan:
+            MigratePlanner(config, args.plan_sample).run(args.plan_output)
+            return
+
+        if args.watch and config.migrateType.type != MIGRATE_FROM_LOCAL:
+            raise Exception("--watch only supports migrateLocal")
 
         migrate_manager = MigrateManager(conf=config)
+        exporter = start_metrics_exporter(migrate_manager.metrics, config)
         if migrate_manager.get_migrate_status() == MIGRATE_INIT:
-            migrate_manager.init_migrate_db()
-            migrate_manager.init_migrate_status(conf_path)
+            # 首次扫描被中断且配置未变化时，保留已入库的记录，从保存的列举位置继续扫描
+            if migrate_manager.get_listing_cursor() is None or \
+                    not migrate_manager.check_config_file(conf_path):
+                migrate_manager.init_migrate_db()
+                migrate_manager.init_migrate_status(conf_path)
         else:
             if not migrate_manager.check_config_file(conf_path):
                 raise Exception("config has changed, exit!")
+        # 各工作进程共用本次执行的开始时间，在扫描和启动工作进程之前记录
+        migrate_manager.update_execute_begin_time()
 
         task_producer = TaskProducer(
-            migrate_manager=migrate_manager)
+            migrate_manager=migrate_manager, incremental=args.incremental)
         task_producer.run()
 
+        if config.common.skipExistingMedia:
+            VodLibrary(migrate_manager).run()
+
+        if config.common.dedup:
+            Deduplicator(migrate_manager).run()
+
+        workers = []
+        for i in range(args.workers - 1):
+            worker = multiprocessing.Process(
+                target=_run_worker,
+                args=(conf_path, i + 1, args.profile, args.profile_output, args.log_format, args.log_level))
+            worker.start()
+            workers.append(worker)
+
+        watcher = None
+        if args.watch:
+            signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+            watcher = LocalWatcher(
+                task_producer,
+                settle_seconds=float(config.migrateLocal.watchSettleSeconds),
+                reconcile_interval=float(config.migrateLocal.watchReconcileInterval))
+            watcher.start()
+
         task_consumer = TaskConsumer(
-            migrate_manager=migrate_manager)
+            migrate_manager=migrate_manager, watcher=watcher)
         task_consumer.run()
+
+        for worker in workers:
+            worker.join()
     except Exception as e:
         logger.error(e)
         res = -2
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        stop_profiler(profiler)
+        stop_logger()
 
 
 if __name__ == '__main__':
     _main()
     global res
-    sys.exit(res)
\ No newline at end of file
+    sys.exit(res)
@@ -17,10 +17,55 @@ COMMON_SUPPORT_MEDIA_CLASSIFICATION = "supportMediaClassification"
 COMMON_EXCLUDE_MEDIA_TYPE = "excludeMediaType"
 COMMON_MIGRATE_DB_STORAGE_PATH = "migrateDbStoragePath"
 COMMON_MIGRATE_RESULT_OUTPUT_PATH = "migrateResultOutputPath"
+COMMON_MIGRATE_DB_URL = "migrateDbUrl"
+COMMON_LEASE_SECONDS = "leaseSeconds"
+COMMON_FILTER = "filter"
+COMMON_RESULT_FORMAT = "resultFormat"
+COMMON_RESULT_COMPRESS = "resultCompress"
+RESULT_FORMATS = ["jsonl", "csv"]
+COMMON_DEDUP = "dedup"
+COMMON_SKIP_EXISTING_MEDIA = "skipExistingMedia"
+COMMON_DEDUP_PROCESSES = "dedupProcesses"
+COMMON_MAX_ATTEMPTS = "maxAttempts"
+COMMON_RETRY_BASE_SECONDS = "retryBaseSeconds"
+COMMON_RETRY_MAX_SECONDS = "retryMaxSeconds"
+COMMON_SCHEDULE_POLICY = "schedulePolicy"
+COMMON_BANDWIDTH_LIMIT = "bandwidthLimit"
+COMMON_BANDWIDTH_SCHEDULE = "bandwidthSchedule"
+COMMON_MEMORY_BUDGET = "memoryBudget"
+COMMON_PIPELINE = "pipeline"
+COMMON_PROGRESS_INTERVAL = "progressInterval"
+COMMON_METRICS_PORT = "metricsPort"
+COMMON_METRICS_ADDRESS = "metricsAddress"
+COMMON_METRICS_FILE = "metricsFile"
+COMMON_METRICS_INTERVAL = "metricsInterval"
+SCHEDULE_POLICY_DEFAULT = "default"
+SCHEDULE_POLICY_LARGEST_FIRST = "largestFirst"
+SCHEDULE_POLICY_MIXED = "mixed"
+SCHEDULE_POLICIES = [SCHEDULE_POLICY_DEFAULT, SCHEDULE_POLICY_LARGEST_FIRST, SCHEDULE_POLICY_MIXED]
+
+PIPELINE_APPLY = "apply"
+PIPELINE_TRANSFER = "transfer"
+PIPELINE_COMMIT = "commit"
+PIPELINE_PERSIST = "persist"
+DEFAULT_PIPELINE_PERSIST = 1
+
+FILTER_INCLUDE = "include"
+FILTER_EXCLUDE = "exclude"
+FILTER_MIN_SIZE = "minSize"
+FILTER_MAX_SIZE = "maxSize"
+FILTER_MTIME_AFTER = "mtimeAfter"
+FILTER_MTIME_BEFORE = "mtimeBefore"
 
 LOCAL_SECTION_NAME = "migrateLocal"
 LOCAL_LOCAL_PATH = "localPath"
 LOCAL_EXCLUDES = "excludes"
+LOCAL_SCAN_CONCURRENCY = "scanConcurrency"
+LOCAL_WATCH_SETTLE_SECONDS = "watchSettleSeconds"
+LOCAL_WATCH_RECONCILE_INTERVAL = "watchReconcileInterval"
+DEFAULT_SCAN_CONCURRENCY = 8
+DEFAULT_WATCH_SETTLE_SECONDS = 10
+DEFAULT_WATCH_RECONCILE_INTERVAL = 600
 
 COS_SECTION_NAME = "migrateCos"
 COS_REGION = "region"
@@ -31,6 +76,8 @@ COS_PREFIX = "prefix"
 
 URLLIST_SECTION_NAME = "migrateUrl"
 URLLIST_PATH = "urllistPath"
+URLLIST_PER_HOST_CONCURRENCY = "perHostConcurrency"
+URLLIST_PER_HOST_REQUESTS_PER_SECOND = "perHostRequestsPerSecond"
 
 ALI_SECTION_NAME = "migrateAli"
 AWS_SECTION_NAME = "migrateAws"
@@ -51,6 +98,13 @@ MIGRATE_FROM_ALI = "migrateAli"
 MIGRATE_FROM_QINIU = "migrateQiniu"
 
 MAX_CONCURRENCY = 50
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_SECONDS = 5
+DEFAULT_RETRY_MAX_SECONDS = 300
+DEFAULT_PROGRESS_INTERVAL = 10
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"
+DEFAULT_METRICS_INTERVAL = 15
 
 logger = logging.getLogger("cmd")
 
@@ -155,11 +209,100 @@ class ConfigParser(object):
         if COMMON_SUBAPPID not in dict_config[COMMON_SECTION_NAME]:
             dict_config[COMMON_SECTION_NAME][COMMON_SUBAPPID] = 0
 
+        if COMMON_MIGRATE_DB_URL not in common_config:
+            common_config[COMMON_MIGRATE_DB_URL] = ''
+
+        if COMMON_LEASE_SECONDS not in common_config:
+            common_config[COMMON_LEASE_SECONDS] = DEFAULT_LEASE_SECONDS
+        if int(common_config[COMMON_LEASE_SECONDS]) < 10:
+            logger.error("leaseSeconds must not be less than 10")
+            return False
+
+        if COMMON_MAX_ATTEMPTS not in common_config:
+            common_config[COMMON_MAX_ATTEMPTS] = DEFAULT_MAX_ATTEMPTS
+        if int(common_config[COMMON_MAX_ATTEMPTS]) < 1:
+            logger.error("maxAttempts must not be less than 1")
+            return False
+        if COMMON_RETRY_BASE_SECONDS not in common_config:
+            common_config[COMMON_RETRY_BASE_SECONDS] = DEFAULT_RETRY_BASE_SECONDS
+        if COMMON_RETRY_MAX_SECONDS not in common_config:
+            common_config[COMMON_RETRY_MAX_SECONDS] = DEFAULT_RETRY_MAX_SECONDS
+        if float(common_config[COMMON_RETRY_BASE_SECONDS]) <= 0 or \
+                float(common_config[COMMON_RETRY_MAX_SECONDS]) < float(common_config[COMMON_RETRY_BASE_SECONDS]):
+            logger.error("retryBaseSeconds must be positive and not greater than retryMaxSeconds")
+            return False
+
+        if COMMON_SCHEDULE_POLICY not in common_config:
+            common_config[COMMON_SCHEDULE_POLICY] = SCHEDULE_POLICY_DEFAULT
+        if common_config[COMMON_SCHEDULE_POLICY] not in SCHEDULE_POLICIES:
+            logger.error("schedulePolicy must be one of {policies}".format(policies=SCHEDULE_POLICIES))
+            return False
+
+        if COMMON_BANDWIDTH_LIMIT not in common_config:
+            common_config[COMMON_BANDWIDTH_LIMIT] = 0
+        if float(common_config[COMMON_BANDWIDTH_LIMIT]) < 0:
+            logger.error("bandwidthLimit must not be negative")
+            return False
+        if COMMON_BANDWIDTH_SCHEDULE not in common_config:
+            common_config[COMMON_BANDWIDTH_SCHEDULE] = []
+
+        if COMMON_MEMORY_BUDGET not in common_config:
+            common_config[COMMON_MEMORY_BUDGET] = 0
+        if int(common_config[COMMON_MEMORY_BUDGET]) < 0:
+            logger.error("memoryBudget must not be negative")
+            return False
+
+        if COMMON_PROGRESS_INTERVAL not in common_config:
+            common_config[COMMON_PROGRESS_INTERVAL] = DEFAULT_PROGRESS_INTERVAL
+        if float(common_config[COMMON_PROGRESS_INTERVAL]) <= 0:
+            logger.error("progressInterval must be positive")
+            return False
+
+        if COMMON_METRICS_PORT not in common_config:
+            common_config[COMMON_METRICS_PORT] = 0
+        if COMMON_METRICS_ADDRESS not in common_config:
+            common_config[COMMON_METRICS_ADDRESS] = DEFAULT_METRICS_ADDRESS
+        if COMMON_METRICS_FILE not in common_config:
+            common_config[COMMON_METRICS_FILE] = ''
+        if COMMON_METRICS_INTERVAL not in common_config:
+            common_config[COMMON_METRICS_INTERVAL] = DEFAULT_METRICS_INTERVAL
+        if not 0 <= int(common_config[COMMON_METRICS_PORT]) < 65536 or \
+                float(common_config[COMMON_METRICS_INTERVAL]) <= 0:
+            logger.error("metricsPort must be in [0, 65535] and metricsInterval must be positive")
+            return False
+        if common_config[COMMON_METRICS_FILE]:
+            common_config[COMMON_METRICS_FILE] = os.path.abspath(common_config[COMMON_METRICS_FILE])
+
+        if COMMON_RESULT_FORMAT not in common_config:
+            common_config[COMMON_RESULT_FORMAT] = RESULT_FORMATS[0]
+        if common_config[COMMON_RESULT_FORMAT] not in RESULT_FORMATS:
+            logger.error("resultFormat must be one of {formats}".format(formats=RESULT_FORMATS))
+            return False
+        if COMMON_RESULT_COMPRESS not in common_config:
+            common_config[COMMON_RESULT_COMPRESS] = False
+
+        if COMMON_SKIP_EXISTING_MEDIA not in common_config:
+            common_config[COMMON_SKIP_EXISTING_MEDIA] = False
+
+        if COMMON_DEDUP not in common_config:
+            common_config[COMMON_DEDUP] = False
+        if COMMON_DEDUP_PROCESSES not in common_config:
+            common_config[COMMON_DEDUP_PROCESSES] = 0
+        if int(common_config[COMMON_DEDUP_PROCESSES]) < 0:
+            logger.error("dedupProcesses must not be negative")
+            return False
+
+        if not ConfigParser.check_filter_config(common_config):
+            return False
+
         concurrency = int(common_config[COMMON_CONCURRENCY])
         if concurrency <= 0 or concurrency >= MAX_CONCURRENCY:
             logger.error("legal concurrency is [1, 50]")
             return False
 
+        if not ConfigParser.check_pipeline_config(common_config):
+            return False
+
         migrate_db_storage_path = dict_config[COMMON_SECTION_NAME][
             COMMON_MIGRATE_DB_STORAGE_PATH]
         dict_config[COMMON_SECTION_NAME][
@@ -178,6 +321,53 @@ class ConfigParser(object):
 
         return True
 
+    @staticmethod
+    def check_filter_config(common_config):
+        '''[common.filter] 为可选分节，未配置的项不做过滤'''
+
+        if COMMON_FILTER not in common_config:
+            common_config[COMMON_FILTER] = {}
+        filter_config = common_config[COMMON_FILTER]
+
+        filter_config.setdefault(FILTER_INCLUDE, [])
+        filter_config.setdefault(FILTER_EXCLUDE, [])
+        filter_config.setdefault(FILTER_MIN_SIZE, 0)
+        filter_config.setdefault(FILTER_MAX_SIZE, 0)
+        filter_config.setdefault(FILTER_MTIME_AFTER, '')
+        filter_config.setdefault(FILTER_MTIME_BEFORE, '')
+
+        if int(filter_config[FILTER_MIN_SIZE]) < 0 or int(filter_config[FILTER_MAX_SIZE]) < 0:
+            logger.error("minSize and maxSize must not be negative")
+            return False
+
+        return True
+
+    @staticmethod
+    def check_pipeline_config(common_config):
+        '''[common.pipeline] 为可选分节，配置迁移流水线各阶段的并发数：
+        apply（ApplyUpload）、transfer（读取源文件并上传）、commit（校验大小及CommitUpload）、persist（保存结果），
+        transfer默认与concurrency一致，apply和commit默认与transfer一致'''
+
+        if COMMON_PIPELINE not in common_config:
+            common_config[COMMON_PIPELINE] = {}
+        pipeline_config = common_config[COMMON_PIPELINE]
+
+        pipeline_config.setdefault(PIPELINE_TRANSFER, common_config[COMMON_CONCURRENCY])
+        pipeline_config.setdefault(PIPELINE_APPLY, pipeline_config[PIPELINE_TRANSFER])
+        pipeline_config.setdefault(PIPELINE_COMMIT, pipeline_config[PIPELINE_TRANSFER])
+        pipeline_config.setdefault(PIPELINE_PERSIST, DEFAULT_PIPELINE_PERSIST)
+
+        transfer = int(pipeline_config[PIPELINE_TRANSFER])
+        if transfer <= 0 or transfer >= MAX_CONCURRENCY:
+            logger.error("legal pipeline.transfer is [1, 50]")
+            return False
+        for item in (PIPELINE_APPLY, PIPELINE_COMMIT, PIPELINE_PERSIST):
+            if int(pipeline_config[item]) <= 0:
+                logger.error("pipeline.{item} must be positive".format(item=item))
+                return False
+
+        return True
+
     @staticmethod
     def check_migrate_local_config(dict_config):
         if LOCAL_SECTION_NAME not in dict_config:
@@ -199,6 +389,22 @@ class ConfigParser(object):
             dict_config[LOCAL_SECTION_NAME][LOCAL_EXCLUDES][
                 i] = os.path.abspath(excludes[i])
 
+        if LOCAL_SCAN_CONCURRENCY not in local_config:
+            local_config[LOCAL_SCAN_CONCURRENCY] = DEFAULT_SCAN_CONCURRENCY
+        if int(local_config[LOCAL_SCAN_CONCURRENCY]) <= 0:
+            logger.error("scanConcurrency must be positive")
+            return False
+
+        if LOCAL_WATCH_SETTLE_SECONDS not in local_config:
+            local_config[LOCAL_WATCH_SETTLE_SECONDS] = DEFAULT_WATCH_SETTLE_SECONDS
+        if LOCAL_WATCH_RECONCILE_INTERVAL not in local_config:
+            local_config[LOCAL_WATCH_RECONCILE_INTERVAL] = DEFAULT_WATCH_RECONCILE_INTERVAL
+
+        if float(local_config[LOCAL_WATCH_SETTLE_SECONDS]) < 0 or \
+                float(local_config[LOCAL_WATCH_RECONCILE_INTERVAL]) <= 0:
+            logger.error("watchSettleSeconds must not be negative and watchReconcileInterval must be positive")
+            return False
+
         return True
 
     @staticmethod
@@ -226,6 +432,16 @@ class ConfigParser(object):
         urllist_config[URLLIST_PATH] = os.path.abspath(
             urllist_config[URLLIST_PATH])
 
+        if URLLIST_PER_HOST_CONCURRENCY not in urllist_config:
+            urllist_config[URLLIST_PER_HOST_CONCURRENCY] = 0
+        if URLLIST_PER_HOST_REQUESTS_PER_SECOND not in urllist_config:
+            urllist_config[URLLIST_PER_HOST_REQUESTS_PER_SECOND] = 0
+
+        if int(urllist_config[URLLIST_PER_HOST_CONCURRENCY]) < 0 or \
+                float(urllist_config[URLLIST_PER_HOST_REQUESTS_PER_SECOND]) < 0:
+            logger.error("perHostConcurrency and perHostRequestsPerSecond must not be negative")
+            return False
+
         return True
 
     @staticmethod
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL, MIGRATE_FROM_URLLIST
+from qcloud_vod_migrate.manager import DEDUP_PAGE_SIZE
+from qcloud_vod_migrate.util import to_printable_str
+
+logger = logging.getLogger("cmd")
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 每个进程一次领取的文件数，减少进程间通信次数
+HASH_MAP_CHUNK_SIZE = 8
+
+
+def hash_file(item):
+    '''计算文件内容的md5，在子进程中执行；返回 (id, md5, 错误信息)'''
+
+    record_id, filename = item
+    md5 = hashlib.md5()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    try:
+        with io.open(filename, 'rb') as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                md5.update(view[:n])
+    except (IOError, OSError) as e:
+        return record_id, None, str(e)
+    return record_id, md5.hexdigest(), None
+
+
+class Deduplicator(object):
+    '''重复文件检测：内容相同的文件只迁移一份，其余文件迁移结束后复用其FileId
+
+    本地文件只对存在相同大小的文件计算内容hash（多进程并行读取），对象存储直接使用源站ETag'''
+
+    def __init__(self, migrate_manager):
+        self.conf = migrate_manager.conf
+        self.migrate_type = self.conf.migrateType.type
+        self.migrate_manager = migrate_manager
+        self.processes = int(self.conf.common.dedupProcesses) or multiprocessing.cpu_count()
+
+    def hash_local_files(self):
+        hashed_num = 0
+        executor = ProcessPoolExecutor(max_workers=self.processes)
+        try:
+            page = []
+            for record in self.migrate_manager.iter_unhashed_records(self.migrate_type):
+                page.append((record.id, record.filename))
+                if len(page) >= DEDUP_PAGE_SIZE:
+                    hashed_num += self.hash_page(executor, page)
+                    page = []
+            hashed_num += self.hash_page(executor, page)
+        finally:
+            executor.shutdown()
+        return hashed_num
+
+    def hash_page(self, executor, page):
+        if len(page) == 0:
+            return 0
+
+        hashes = []
+        for record_id, content_hash, error in executor.map(
+                hash_file, page, chunksize=HASH_MAP_CHUNK_SIZE):
+            if content_hash is None:
+                logger.error("hash record {id} failed: {error}".format(
+                    id=record_id, error=to_printable_str(error)))
+                continue
+            hashes.append((record_id, content_hash))
+        self.migrate_manager.update_content_hashes(hashes)
+        return len(hashes)
+
+    def run(self):
+        if self.migrate_type == MIGRATE_FROM_URLLIST:
+            logger.info("dedup is not supported for migrateUrl, skip")
+            return
+
+        self.migrate_manager.flush_migrate_records()
+        logger.info("dedup: checking duplicate files")
+        if self.migrate_type == MIGRATE_FROM_LOCAL:
+            hashed_num = self.hash_local_files()
+            logger.info("dedup: hashed {num} files with the same size as others".format(
+                num=hashed_num))
+        else:
+            self.migrate_manager.copy_etag_to_content_hash(self.migrate_type)
+
+        duplicate_num = self.migrate_manager.mark_duplicate_records(self.migrate_type)
+        logger.info("dedup: {num} records updated, duplicate files will not be uploaded".format(
+            num=duplicate_num))
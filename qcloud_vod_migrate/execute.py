@@ -5,140 +5,192 @@ import os
 import sys
 import time
 import datetime
+import socket
+import threading
+import uuid
 if sys.version_info[0] == 3:
-    from urllib.request import urlopen
-    from urllib.parse import quote
     from urllib.parse import urlparse
 else:
-    from urllib2 import urlopen
-    from urllib import quote
     from urlparse import urlparse
-import requests
+from collections import deque
 
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from qcloud_vod.common import FileUtil
-from qcloud_vod_migrate.manager import MIGRATE_INIT, MIGRATE_RUNNING, MIGRATE_FINISHED, MIGRATE_TASK_SUCCESS, MIGRATE_TASK_FAIL, MigrateRecord
+from qcloud_vod_migrate.manager import MIGRATE_INIT, MIGRATE_RUNNING, MIGRATE_FINISHED, MIGRATE_TASK_INIT, MIGRATE_TASK_SUCCESS, MIGRATE_TASK_FAIL, MIGRATE_ERROR_RETRYABLE, MigrateRecord, MAX_FETCH_NUM
 from qcloud_vod_migrate.upload import VodUploader
-from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL, MIGRATE_FROM_URLLIST, MIGRATE_FROM_COS, MIGRATE_FROM_AWS, MIGRATE_FROM_ALI, MIGRATE_FROM_QINIU
+from qcloud_vod_migrate.pipeline import Pipeline
+from qcloud_vod_migrate.limiter import HostScheduler, HostRateLimiter, BandwidthLimiter
+from qcloud_vod_migrate.retry import classify_error, get_error_code, get_retry_delay
+from qcloud_vod_migrate.metrics import STAGE_APPLY_UPLOAD, STAGE_SOURCE_OPEN, STAGE_PUT, STAGE_VERIFY, STAGE_COMMIT_UPLOAD
+from qcloud_vod_migrate.profiler import span, timed_iter, SPAN_SCAN_PAGE, SPAN_SOURCE_OPEN
+from qcloud_vod_migrate.filter import MediaFilter
+# 媒体分类配置原先定义在本模块，已移至filter；保留导出以兼容 execute.media_classification_config 的引用
+from qcloud_vod_migrate.filter import media_classification_config  # noqa: F401
+from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL, MIGRATE_FROM_URLLIST
+from qcloud_vod_migrate.config import SCHEDULE_POLICY_DEFAULT, SCHEDULE_POLICY_LARGEST_FIRST, SCHEDULE_POLICY_MIXED
 from qcloud_vod_migrate.util import to_printable_str
 from qcloud_vod_migrate.util import fs_coding
-from qcloud_vod.vod_upload_client import VodUploadClient
 from qcloud_vod.model import VodUploadRequest
-from qcloud_cos import CosConfig, CosS3Client
+from qcloud_vod_migrate.source import get_source
 from six import text_type
-from botocore.client import Config
-import boto3
-import boto3.session
-import oss2
-import qiniu
 
 logger = logging.getLogger("cmd")
 
-# 媒体格式所属分类配置
-media_classification_config = [{
-    "class":
-        "video",
-    "mediaTypeList": [
-        "mp4", "flv", "wmv", "asf", "rm", "rmvb", "mpg", "mpeg", "3gp", "mov",
-        "webm", "mkv", "avi", "ts", "wm", "asx", "ram", "mpe", "vob", "dat", "mp4v", "m4v", "f4v", "mxf"
-    ],
-}, {
-    "class": "audio",
-    "mediaTypeList": ["mp3", "m4a", "flac", "ogg", "wav", "ra", "aac", "amr"],
-}, {
-    "class":
-        "image",
-    "mediaTypeList": [
-        "jpg", "jpeg", "png", "gif", "bmp", "tiff", "ai", "cdr", "eps"
-    ],
-}]
-
-max_retry_times = 3
+# 增量扫描时，每批对比的文件数
+incremental_page_size = 500
+
+# 首次扫描时保存列举位置的最小间隔（秒）
+list_cursor_save_interval = 5
+
+# 有任务在执行时，定期检查是否有到达重试时间的失败任务
+retry_poll_seconds = 5
+
+# mixed调度策略下，专门迁移大文件的并发数
+large_file_lanes = 1
+
+# sdk上传本地文件的分块大小、分块数上限及并发线程数（cos upload_file 的默认值）
+local_upload_part_size = 1024 * 1024
+local_upload_max_parts = 10000
+local_upload_threads = 5
+
+
+def is_record_changed(existing, record):
+    '''对比扫描结果与已有记录：只对比扫描时取得的字段，
+    如Url列表扫描时不知道文件大小（下载时才写入记录），对象存储没有mtime，本地文件没有etag'''
+
+    if record.mtime is not None and existing.mtime != record.mtime:
+        return True
+    if record.filesize is not None and existing.filesize != record.filesize:
+        return True
+    if record.etag and existing.etag != record.etag:
+        return True
+    return False
 
 
 class TaskProducer(object):
     '''任务生产者， 通过扫描存储源，取得需要迁移文件列表，生成相应的迁移任务'''
 
-    def __init__(self, migrate_manager):
+    def __init__(self, migrate_manager, incremental=False):
         self.conf = migrate_manager.conf
         self.migrate_type = self.conf.migrateType.type
         self.task_list = []
         self.executor = ThreadPoolExecutor(max_workers=self.conf.common.concurrency)
         self.start_time = int(time.time())
         self.migrate_manager = migrate_manager
+        self.incremental = incremental
+        self.media_filter = MediaFilter(self.conf)
+        self.source = get_source(self.conf)
+        self.pending_records = []
+        self.new_num = 0
+        self.changed_num = 0
+        self.unchanged_num = 0
+        # 从中断的首次扫描继续时，与增量扫描一样对比已有记录，跳过中断前已经保存的文件
+        self.resumed = False
+        self.last_cursor_time = 0
 
-    def get_media_classification(self, filename):
-        file_type = FileUtil.get_file_type(filename)
-        for classification in iter(media_classification_config):
-            for media_type in iter(classification["mediaTypeList"]):
-                if file_type.lower() == media_type:
-                    return classification["class"]
-        return ""
-
-    def is_support_media_classification(self, filename):
-        classification = self.get_media_classification(filename)
-        for c in self.conf.common.supportMediaClassification:
-            if c == classification:
-                return True
+    def save_record(self, record):
+        '''保存迁移结果'''
 
-        return False
+        if self.incremental or self.resumed:
+            self.pending_records.append(record)
+            if len(self.pending_records) >= incremental_page_size:
+                self.save_changed_records()
+            return
 
-    def is_exclude_media_type(self, filename):
-        file_type = FileUtil.get_file_type(filename)
-        for media_type in iter(self.conf.common.excludeMediaType):
-            if file_type.lower() == media_type.lower():
-                return True
-        return False
+        try:
+            self.migrate_manager.save_migrate_record(record)
+            return
+        except Exception as e:
+            logger.error(e)
+            raise e
 
-    def is_excludes(self, filename):
-        '''检查文件的目录是否被排除'''
+    def save_changed_records(self):
+        '''增量扫描：与已有迁移记录对比 mtime/size/etag，只保存新增或有变化的文件'''
 
-        for exclude_path in iter(self.conf.migrateLocal.excludes):
-            filepath = os.path.dirname(filename)
-            if filepath.startswith(exclude_path):
-                return True
-        return False
+        if len(self.pending_records) == 0:
+            return
 
-    def save_record(self, record):
-        '''保存迁移结果'''
+        records, self.pending_records = self.pending_records, []
+        existing_records = self.migrate_manager.get_migrate_records_by_filenames(
+            self.migrate_type, [record.filename for record in records])
 
         try:
-            self.migrate_manager.save_migrate_record(record)
-            return
+            for record in records:
+                existing = existing_records.get(record.filename)
+                if existing is None:
+                    self.new_num += 1
+                elif not is_record_changed(existing, record):
+                    self.unchanged_num += 1
+                    continue
+                else:
+                    # 文件有变化，重置为待迁移状态
+                    self.changed_num += 1
+                    record.id = existing.id
+                    record.file_id = ""
+                    record.vod_url = ""
+                    record.err_msg = ""
+                    record.content_hash = ""
+                    record.dup_of = 0
+                    record.attempts = 0
+                    record.error_class = ""
+                    record.next_attempt_at = 0
+                    record.status = MIGRATE_TASK_INIT
+                self.migrate_manager.save_migrate_record(record)
         except Exception as e:
             logger.error(e)
             raise e
 
+    def save_listing_cursor(self, force=False):
+        '''首次扫描时定期保存列举位置，中断后再次执行从该位置继续；
+        先提交待对比的记录，保证列举位置之前的文件都已入库'''
+
+        if self.incremental:
+            return
+        now = time.time()
+        if not force and now - self.last_cursor_time < list_cursor_save_interval:
+            return
+        cursor = self.source.get_cursor()
+        if cursor is None:
+            return
+        if self.resumed:
+            self.save_changed_records()
+        self.migrate_manager.save_listing_cursor(cursor)
+        self.last_cursor_time = now
+
     def bad_filename(self, filename):
         '''获取不合法的文件名'''
         return repr(filename)[1:-1]
 
-    def need_to_migrate(self, filename):
-        '''检查该文件的类别（视频、音频、图片）是否需要迁移；检查该文件的类型（mp4、flv、mp3等）是否被排除'''
+    def need_to_migrate(self, filename, filesize=None, mtime=None, check_excludes=True):
+        '''检查该文件的类别（视频、音频、图片）、类型（mp4、flv、mp3等）、路径、大小及修改时间是否需要迁移'''
 
-        if self.migrate_type == MIGRATE_FROM_LOCAL:
-            if self.is_excludes(filename):
-                logger.info("{filename}: skipped by path".format(filename=to_printable_str(filename)))
-                return False
+        return self.media_filter.check(filename, filesize, mtime, check_excludes)
 
-        if not self.is_support_media_classification(filename):
-            logger.info("{filename}: skipped by media classification".format(filename=to_printable_str(filename)))
-            return False
+    def build_local_record(self, local_file, file_info=None, check_excludes=True):
+        '''为本地文件构建迁移记录，文件不需要迁移时返回None；
+        扫描时已取得的stat结果通过file_info传入，避免重复stat'''
 
-        if self.is_exclude_media_type(filename):
-            logger.info("{filename}: skipped by media type".format(filename=to_printable_str(filename)))
-            return False
-
-        return True
+        if file_info is None:
+            obj = self.source.stat(local_file)
+        else:
+            obj = self.source.build_object(local_file, file_info)
+        if not self.need_to_migrate(obj.key, obj.size, obj.mtime, check_excludes):
+            return None
+        return self.source.to_record(obj)
 
     def need_to_build(self):
         '''是否需要执行扫描，构建迁移任务'''
 
         status = self.migrate_manager.get_migrate_status()
         if status != MIGRATE_INIT:
+            if self.incremental:
+                logger.info("incremental scan, only new or changed files will be migrated")
+                return True
             logger.info("tasks have already built, skip")
             return False
 
+        # 首次扫描时db为空，无需对比
+        self.incremental = False
         return True
 
     def run(self):
@@ -147,259 +199,390 @@ class TaskProducer(object):
         if not self.need_to_build():
             return
 
+        cursor = None
+        if not self.incremental:
+            cursor = self.migrate_manager.get_listing_cursor()
+            if cursor is not None:
+                logger.info("resume the interrupted scan from the last saved listing position")
+                self.resumed = True
+
         logger.info("build tasks")
 
-        if self.migrate_type == MIGRATE_FROM_LOCAL:
-            try:
-                for root, _, files in os.walk(
-                        self.conf.migrateLocal.localPath, topdown=True):
-                    for name in files:
-                        try:
-                            local_file = os.path.join(root, name)
-                            if not isinstance(local_file, text_type):
-                                local_file = local_file.decode(fs_coding)
-                            if self.need_to_migrate(local_file):
-                                file_info = os.stat(local_file)
-                                record = MigrateRecord(
-                                    migrate_type=self.migrate_type,
-                                    filename=local_file,
-                                    mtime=int(file_info.st_mtime),
-                                    filesize=file_info.st_size,
-                                    etag="",
-                                    status=MIGRATE_INIT)
-                                self.save_record(record)
-                        except UnicodeEncodeError as e:
-                            logger.error("{file} build failed: {error}".format(
-                                file=self.bad_filename(os.path.join(root, name)), error=e))
-            except Exception as e:
-                logger.error(e)
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_URLLIST:
-            try:
-                for url in open(self.conf.migrateUrl.urllistPath):
-                    if not isinstance(url, text_type):
-                        url = url.decode(fs_coding)
-                    url = url.strip('\n')
-                    u = urlparse(url)
-                    if self.need_to_migrate(u.path):
-                        record = MigrateRecord(
-                            migrate_type=self.migrate_type,
-                            filename=url,
-                            etag="",
-                            status=MIGRATE_INIT)
-                        self.save_record(record)
-            except Exception as e:
-                logger.error(e)
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_COS:
-            cos_config = CosConfig(
-                Region=self.conf.migrateCos.region,
-                SecretId=self.conf.migrateCos.secretId,
-                SecretKey=self.conf.migrateCos.secretKey)
-            cos_client = CosS3Client(cos_config)
-            marker = ""
-            is_truncated = 'true'
-            while is_truncated == 'true':
-                for i in range(max_retry_times):
-                    try:
-                        res = cos_client.list_objects(
-                            Bucket=self.conf.migrateCos.bucket,
-                            Prefix=self.conf.migrateCos.prefix,
-                            Delimiter='',
-                            MaxKeys=1000,
-                            Marker=marker)
-
-                        if 'Contents' in res:
-                            for file in res['Contents']:
-                                if not isinstance(file['Key'], text_type):
-                                    file['Key'] = file['Key'].decode('utf-8')
-                                if self.need_to_migrate(file['Key']):
-                                    record = MigrateRecord(
-                                        migrate_type=self.migrate_type,
-                                        filename=file['Key'],
-                                        etag=file['ETag'],
-                                        filesize=int(file['Size']),
-                                        status=MIGRATE_INIT)
-                                    self.save_record(record)
-                        if 'NextMarker' in res:
-                            marker = res['NextMarker']
-                        if 'IsTruncated' in res:
-                            is_truncated = res['IsTruncated']
-                        break
-                    except Exception as e:
-                        time.sleep(1 << i)
-                        logger.error(e)
-                        if i + 1 == max_retry_times:
-                            raise e
-        elif self.migrate_type == MIGRATE_FROM_AWS:
-            try:
-                session = boto3.session.Session(
-                    region_name=self.conf.migrateAws.region,
-                    aws_access_key_id=self.conf.migrateAws.accessKeyId,
-                    aws_secret_access_key=self.conf.migrateAws.accessKeySecret)
-                s3 = session.resource('s3')
-                bucket = s3.Bucket(self.conf.migrateAws.bucket)
-                prefix = self.conf.migrateAws.prefix
-
-                for obj in bucket.objects.all():
-                    if not isinstance(obj.key, text_type):
-                        obj.key = obj.key.decode('utf-8')
-                    if prefix != '':
-                        if not obj.key.startswith(prefix):
-                            continue
-                    if self.need_to_migrate(obj.key):
-                        record = MigrateRecord(
-                            migrate_type=self.migrate_type,
-                            filename=obj.key,
-                            etag=obj.e_tag,
-                            filesize=obj.size,
-                            status=MIGRATE_INIT)
-                        self.save_record(record)
-            except Exception as e:
-                logger.error(e)
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_ALI:
-            try:
-                auth = oss2.Auth(
-                    self.conf.migrateAli.accessKeyId,
-                    self.conf.migrateAli.accessKeySecret)
-
-                bucket = oss2.Bucket(
-                    auth,
-                    self.conf.migrateAli.endPoint,
-                    self.conf.migrateAli.bucket)
-
-                for obj in oss2.ObjectIterator(
-                        bucket=bucket, prefix=self.conf.migrateAli.prefix):
-                    if not isinstance(obj.key, text_type):
-                        obj.key = obj.key.decode('utf-8')
-                    if self.need_to_migrate(obj.key):
-                        record = MigrateRecord(
-                            migrate_type=self.migrate_type,
-                            filename=obj.key,
-                            etag=obj.etag,
-                            filesize=obj.size,
-                            status=MIGRATE_INIT)
-                        self.save_record(record)
-            except Exception as e:
-                logger.error(e)
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_QINIU:
-            auth = qiniu.Auth(
-                self.conf.migrateQiniu.accessKeyId,
-                self.conf.migrateQiniu.accessKeySecret)
-            bucket = qiniu.BucketManager(auth)
-
-            marker = None
-            prefix = self.conf.migrateQiniu.prefix
-            if prefix == '':
-                prefix = None
-            eof = False
-            while not eof:
-                for i in range(max_retry_times):
+        try:
+            # 本地目录中被排除的目录在扫描时已整体跳过，无需再逐个文件检查
+            for page in timed_iter(self.source.list_pages(cursor), SPAN_SCAN_PAGE):
+                for obj in page:
                     try:
-                        res, eof, _ = bucket.list(
-                            bucket=self.conf.migrateQiniu.bucket,
-                            prefix=prefix,
-                            limit=1000,
-                            marker=marker)
-
-                        if 'items' in res:
-                            for file in res['items']:
-                                if not isinstance(file['key'], text_type):
-                                    file['key'] = file['key'].decode('utf-8')
-                                if self.need_to_migrate(file['key']):
-                                    record = MigrateRecord(
-                                        migrate_type=self.migrate_type,
-                                        filename=file['key'],
-                                        etag=file['md5'],
-                                        filesize=int(file['fsize']),
-                                        status=MIGRATE_INIT)
-                                    self.save_record(record)
-                        if 'marker' in res:
-                            marker = res['marker']
-                        break
-                    except Exception as e:
-                        time.sleep(1 << i)
-                        logger.error(e)
-                        if i + 1 == max_retry_times:
-                            raise e
+                        if self.need_to_migrate(obj.filter_name, obj.size, obj.mtime, check_excludes=False):
+                            self.save_record(self.source.to_record(obj))
+                    except UnicodeEncodeError as e:
+                        logger.error("{file} build failed: {error}".format(
+                            file=self.bad_filename(obj.key), error=e))
+                self.save_listing_cursor()
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+        self.media_filter.log_skipped()
+
+        if self.incremental:
+            self.save_changed_records()
+            logger.info("incremental scan finished, new: {new}, changed: {changed}, unchanged: {unchanged}".format(
+                new=self.new_num, changed=self.changed_num, unchanged=self.unchanged_num))
+        elif self.resumed:
+            self.save_changed_records()
+            logger.info("resumed scan finished, new: {new}, already saved before the interruption: {saved}".format(
+                new=self.new_num + self.changed_num, saved=self.unchanged_num))
 
+        self.migrate_manager.flush_migrate_records()
         self.migrate_manager.update_migrate_status(MIGRATE_RUNNING)
         return
 
 
+def get_storage_prefix(conf):
+    '''取得存储路径前缀，确保以 / 开头，并且不以 / 结尾'''
+
+    prefix = conf.common.storagePath.prefix
+    if prefix:
+        prefix = prefix.strip()
+        if not prefix.startswith('/'):
+            prefix = '/' + prefix
+        prefix = prefix.rstrip('/')
+    return prefix
+
+
+def get_media_storage_path(conf, filename):
+    '''useOriginal为true时，文件上传到vod后的存储路径'''
+
+    migrate_type = conf.migrateType.type
+    prefix = get_storage_prefix(conf)
+    if migrate_type == MIGRATE_FROM_LOCAL:
+        return prefix + filename
+    if migrate_type == MIGRATE_FROM_URLLIST:
+        return prefix + urlparse(filename).path
+    return prefix + "/" + filename
+
+
+def get_media_name(conf, filename):
+    '''文件上传到vod后的媒体名称（不含扩展名的文件名）'''
+
+    if conf.migrateType.type == MIGRATE_FROM_URLLIST:
+        filename = urlparse(filename).path
+    return FileUtil.get_file_name(filename)
+
+
+def get_local_upload_buffer_size(filesize):
+    '''sdk上传本地文件时最多同时缓冲的字节数：按1MB分块（超过10000块时增大分块），每个线程缓冲一个分块'''
+
+    part_size = max(local_upload_part_size, filesize // local_upload_max_parts)
+    return min(filesize, part_size * local_upload_threads)
+
+
+def close_body(body):
+    '''关闭源站数据流，释放连接'''
+
+    close = getattr(body, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as e:
+        logger.debug(e)
+
+
+def get_record_host(record):
+    '''获取迁移记录对应的源站host，非Url列表迁移的记录视为同一个源站'''
+
+    if record.migrate_type != MIGRATE_FROM_URLLIST:
+        return ""
+    return urlparse(record.filename).netloc.lower()
+
+
 class TaskConsumer(object):
-    '''任务消费类，负责拉取未完成的任务提交到线程池'''
+    '''任务消费类，负责以租约方式领取未完成的任务并提交到迁移流水线
+
+    多个进程（或多台机器）共享同一个迁移db时，每个进程都运行一个TaskConsumer，
+    finalize为True的进程负责在全部任务结束后更新迁移状态并输出迁移结果；
+    指定watcher时持续运行，迁移监听到的新文件，直到进程被中断
+
+    schedulePolicy为largestFirst时按文件大小从大到小领取任务，大文件先开始，小文件在其间补齐并发；
+    为mixed时保留large_file_lanes个并发从大到小迁移大文件，其余并发从小到大迁移小文件'''
 
-    def __init__(self, migrate_manager):
+    def __init__(self, migrate_manager, finalize=True, watcher=None):
         self.conf = migrate_manager.conf
+        self.finalize = finalize
+        self.watcher = watcher
+        self.owner = '{host}-{pid}-{rand}'.format(
+            host=socket.gethostname(), pid=os.getpid(), rand=uuid.uuid4().hex[:8])
+        self.lease_seconds = int(self.conf.common.leaseSeconds)
+        pipeline_config = self.conf.common.pipeline
+        self.pipeline = Pipeline([
+            ("apply", Task.apply, pipeline_config.apply),
+            ("transfer", Task.transfer, pipeline_config.transfer),
+            ("commit", Task.commit, pipeline_config.commit),
+            ("persist", Task.persist, pipeline_config.persist),
+        ], on_error=Task.fail)
+        # 在途任务数（各阶段执行中及排队中的任务）上限
+        self.max_in_flight = self.pipeline.capacity
+        migrate_manager.metrics.add_collector(self.collect_metrics)
+        self.claim_num = min(MAX_FETCH_NUM, max(self.conf.common.concurrency * 10, self.max_in_flight))
+        self.claimed_ids = set()
+        self.claimed_lock = threading.Lock()
+        self.stopped = threading.Event()
         self.migrate_type = self.conf.migrateType.type
         self.task_list = []
-        self.executor = ThreadPoolExecutor(max_workers=self.conf.common.concurrency)
         self.start_time = int(time.time())
         self.migrate_manager = migrate_manager
+        self.host_rate_limiter = None
+        max_in_flight_per_host = 0
+        if self.migrate_type == MIGRATE_FROM_URLLIST:
+            max_in_flight_per_host = int(self.conf.migrateUrl.perHostConcurrency)
+            self.host_rate_limiter = HostRateLimiter(
+                float(self.conf.migrateUrl.perHostRequestsPerSecond))
+        self.scheduler = HostScheduler(get_record_host, max_in_flight_per_host)
+        self.running_records = {}
+        self.source = get_source(self.conf)
+        self.bandwidth_limiter = None
+        if float(self.conf.common.bandwidthLimit) > 0 or len(self.conf.common.bandwidthSchedule) > 0:
+            self.bandwidth_limiter = BandwidthLimiter(
+                self.conf.common.bandwidthLimit, self.conf.common.bandwidthSchedule)
+
+        self.schedule_policy = self.conf.common.schedulePolicy
+        if self.migrate_type == MIGRATE_FROM_URLLIST and self.schedule_policy != SCHEDULE_POLICY_DEFAULT:
+            logger.info("schedulePolicy is not supported for migrateUrl (file size unknown), ignore")
+            self.schedule_policy = SCHEDULE_POLICY_DEFAULT
+        self.claim_order = None
+        if self.schedule_policy == SCHEDULE_POLICY_LARGEST_FIRST:
+            self.claim_order = MigrateRecord.filesize.desc()
+        elif self.schedule_policy == SCHEDULE_POLICY_MIXED:
+            self.claim_order = MigrateRecord.filesize
+        # mixed策略下大文件通道的待执行任务及在途任务id
+        self.large_records = deque()
+        self.large_running_ids = set()
+
+    def collect_metrics(self):
+        metrics = self.migrate_manager.metrics
+        metrics.in_flight.set(len(self.task_list))
+        for stage, depth in self.pipeline.queue_depths():
+            metrics.queue_depth.set(depth, (stage,))
+
+    def claim_tasks(self):
+        '''待执行的任务不足时，领取新的迁移记录'''
+
+        if self.schedule_policy == SCHEDULE_POLICY_MIXED and len(self.large_records) == 0:
+            records = self.migrate_manager.claim_migrate_records(
+                self.migrate_type, self.owner, large_file_lanes, self.lease_seconds,
+                order_by=MigrateRecord.filesize.desc())
+            with self.claimed_lock:
+                for record in records:
+                    self.claimed_ids.add(record.id)
+                    self.large_records.append(record)
+
+        if len(self.scheduler) >= self.max_in_flight:
+            return
+        records = self.migrate_manager.claim_migrate_records(
+            self.migrate_type, self.owner, self.claim_num, self.lease_seconds,
+            order_by=self.claim_order)
+        with self.claimed_lock:
+            for record in records:
+                self.claimed_ids.add(record.id)
+                self.scheduler.add(record)
+
+    def next_record(self):
+        '''取出下一个待执行的任务：mixed策略下大文件通道空闲时优先执行大文件，
+        小文件执行完后，空闲的并发也迁移大文件'''
+
+        if len(self.large_records) > 0 and len(self.large_running_ids) < large_file_lanes:
+            record = self.large_records.popleft()
+            self.large_running_ids.add(record.id)
+            return record
+        record = self.scheduler.next()
+        if record is None and len(self.large_records) > 0:
+            record = self.large_records.popleft()
+            self.large_running_ids.add(record.id)
+        return record
+
+    def add_watched_tasks(self):
+        '''将监听到的新文件写入db并直接由当前进程领取'''
+
+        records = self.watcher.get_records()
+        if len(records) == 0 and not self.watcher.is_alive():
+            raise Exception("local watcher exited unexpectedly")
+        if len(records) == 0:
+            return
+        self.migrate_manager.add_claimed_migrate_records(
+            records, self.owner, self.lease_seconds)
+        with self.claimed_lock:
+            for record in records:
+                self.claimed_ids.add(record.id)
+                self.scheduler.add(record)
+
+    def renew_leases(self):
+        '''后台线程：定期续约已领取但尚未完成的迁移记录'''
+
+        while not self.stopped.wait(self.lease_seconds / 3.0):
+            with self.claimed_lock:
+                ids = list(self.claimed_ids)
+            if len(ids) > 0:
+                self.migrate_manager.renew_migrate_leases(
+                    self.owner, ids, self.lease_seconds)
+
+    def promote_duplicates(self):
+        '''全部任务结束后，主记录最终失败的重复文件改为由其中一份重新迁移；返回是否有新的任务'''
+
+        if not self.finalize or not self.conf.common.dedup:
+            return False
+        promoted_num = self.migrate_manager.promote_duplicate_records(self.migrate_type)
+        if promoted_num > 0:
+            logger.info("{num} duplicate files will be migrated since the primary copy failed".format(
+                num=promoted_num))
+        return promoted_num > 0
 
     def add_task(self, task):
-        '''将迁移任务提交到线程池中'''
+        '''将迁移任务提交到流水线中'''
 
         try:
-            running_task = self.executor.submit(task.run)
+            running_task = self.pipeline.submit(task)
             self.task_list.append(running_task)
+            self.running_records[running_task] = task.record
         except Exception as e:
             logger.error(e)
             raise e
 
+    def dispatch_tasks(self):
+        '''按源站公平调度提交任务，在途任务数不超过流水线容量'''
+
+        while len(self.task_list) < self.max_in_flight:
+            record = self.next_record()
+            if record is None:
+                return
+            task = Task(
+                conf=self.conf,
+                migrate_manager=self.migrate_manager,
+                record=record,
+                source=self.source,
+                host_rate_limiter=self.host_rate_limiter,
+                bandwidth_limiter=self.bandwidth_limiter)
+            self.add_task(task)
+
+            logger.info("add migrate task: {filename}".format(
+                filename=to_printable_str(record.filename)))
+
+    def finish_tasks(self, done):
+        for running_task in done:
+            record = self.running_records.pop(running_task)
+            if record.id in self.large_running_ids:
+                self.large_running_ids.discard(record.id)
+            else:
+                self.scheduler.done(record)
+            with self.claimed_lock:
+                self.claimed_ids.discard(record.id)
+
     def run(self):
-        '''拉取迁移任务并提交到线程池'''
+        '''领取迁移任务并提交到迁移流水线'''
 
-        self.migrate_manager.update_execute_begin_time()
+        self.migrate_manager.load_execute_begin_time()
         self.migrate_manager.init_counter()
 
-        while True:
-            time.sleep(1)
-            records = self.migrate_manager.get_unfinished_migrate_records(
-                self.migrate_type)
-            if len(records) == 0:
-                break
-            for record in records:
-                task = Task(
-                    conf=self.conf,
-                    migrate_manager=self.migrate_manager,
-                    record=record)
-                self.add_task(task)
-
-                logger.info("add migrate task: {filename}".format(
-                    filename=to_printable_str(record.filename)))
-
-            self.wait_tasks_over()
+        lease_keeper = threading.Thread(target=self.renew_leases)
+        lease_keeper.daemon = True
+        lease_keeper.start()
 
+        completed = False
+        try:
+            while True:
+                # 迁移记录写入失败时立即停止，不再领取和执行任务
+                self.migrate_manager.check_migrate_records()
+                if self.watcher is not None:
+                    self.add_watched_tasks()
+                self.claim_tasks()
+                self.dispatch_tasks()
+
+                if len(self.task_list) == 0 and self.watcher is not None:
+                    time.sleep(1)
+                    continue
+                if len(self.task_list) == 0:
+                    # 其他进程仍持有有效租约时继续等待，租约过期（进程异常退出）后接管其任务；
+                    # 有等待重试的失败任务时，等到重试时间后重新领取
+                    self.migrate_manager.flush_migrate_records()
+                    next_retry_time = self.migrate_manager.get_next_retry_time(self.migrate_type)
+                    if next_retry_time is None and \
+                            self.migrate_manager.count_leased_migrate_records(self.migrate_type) == 0:
+                        if self.promote_duplicates():
+                            continue
+                        break
+                    wait_seconds = min(self.lease_seconds / 3.0, 5)
+                    if next_retry_time is not None:
+                        wait_seconds = min(wait_seconds, max(next_retry_time - time.time(), 0.1))
+                    time.sleep(wait_seconds)
+                    continue
+
+                # 监听模式下需要定期醒来接收新文件，否则定期检查到达重试时间的任务及输出进度
+                timeout = 1 if self.watcher is not None else min(
+                    retry_poll_seconds, float(self.conf.common.progressInterval))
+                done, not_done = wait(
+                    self.task_list, timeout=timeout, return_when=FIRST_COMPLETED)
+                self.finish_tasks(done)
+                self.task_list[:] = list(not_done)
+                # 大文件传输期间没有任务完成，也按间隔输出当前速度
+                self.migrate_manager.output_migrate_progress()
+        except KeyboardInterrupt:
+            if self.watcher is None:
+                raise
+            # 监听模式下收到中断信号：停止监听，等待在途任务完成后正常结束
+            logger.info("stop watching, waiting for running tasks")
+            self.watcher.stop()
+            self.finish_tasks(wait(self.task_list).done)
+            self.task_list[:] = []
+        else:
+            completed = True
+        finally:
+            self.stopped.set()
+            # 异常退出时不再执行排队中的任务，只等待正在执行的任务
+            self.pipeline.shutdown(cancel=not completed)
+            self.migrate_manager.flush_migrate_records()
+
+        if self.finalize and self.conf.common.dedup:
+            resolved_num = self.migrate_manager.resolve_duplicate_records(self.migrate_type)
+            if resolved_num > 0:
+                logger.info("{num} duplicate files reuse the FileId of the migrated copy".format(
+                    num=resolved_num))
+        self.migrate_manager.output_migrate_progress(force=True)
         logger.info("tasks finished")
-        self.migrate_manager.update_migrate_status(MIGRATE_FINISHED)
-        self.migrate_manager.output_migrate_results()
+        if self.finalize:
+            self.migrate_manager.update_migrate_status(MIGRATE_FINISHED)
+            self.migrate_manager.output_migrate_results()
 
         return
 
-    def wait_tasks_over(self):
-        '''阻塞等待，直到迁移任务完成'''
-
-        wait(self.task_list, return_when=ALL_COMPLETED)
-        self.task_list[:] = []
-        return
-
 
 class Task(object):
-    '''迁移任务类，真正执行迁移操作'''
+    '''迁移任务类，真正执行迁移操作
+
+    迁移分为几个阶段，分别由流水线中不同的线程池执行：
+    apply（ApplyUpload）、transfer（读取源文件并上传到cos）、commit（校验大小并CommitUpload）、persist（保存结果），
+    任一阶段失败时调用fail，然后直接执行persist'''
 
-    def __init__(self, conf, migrate_manager, record):
+    def __init__(self, conf, migrate_manager, record, source, host_rate_limiter=None, bandwidth_limiter=None):
         self.conf = conf
+        self.source = source
         self.migrate_type = conf.migrateType.type
         self.migrate_manager = migrate_manager
         self.record = record
-        self.vod_client = VodUploadClient(conf.common.secretId,
-                                          conf.common.secretKey)
+        self.host_rate_limiter = host_rate_limiter
+        self.bandwidth_limiter = bandwidth_limiter
+        self.memory_budget = migrate_manager.memory_budget
+        self.metrics = migrate_manager.metrics
         self.vod_uploader = VodUploader(conf.common.secretId,
-                                        conf.common.secretKey)
+                                        conf.common.secretKey,
+                                        bandwidth_limiter,
+                                        self.memory_budget,
+                                        migrate_manager.progress_meter)
+        # 本地文件未限速时由sdk多线程分块上传，其余情况以数据流方式上传
+        self.upload_local = self.migrate_type == MIGRATE_FROM_LOCAL and bandwidth_limiter is None
+        self.session = None
+        self.size = 0
+        self.finished = False
 
     def save_record(self):
         '''保存迁移结果'''
@@ -410,179 +593,122 @@ class Task(object):
         except Exception as e:
             logger.error(e)
 
-    def upload_file(self, filename):
-        '''上传文件到vod'''
-        prefix = self.conf.common.storagePath.prefix
-        if prefix:
-            prefix = prefix.strip()
-            # 确保 prefix 以 / 开头，并且不以 / 结尾
-            if not prefix.startswith('/'):
-                prefix = '/' + prefix
-            prefix = prefix.rstrip('/')
+    def apply(self):
+        '''申请上传'''
+
+        # 新领取的记录（不是本次执行中的重试）重新计算尝试次数
+        if not self.record.next_attempt_at:
+            self.record.attempts = 0
+        self.record.attempts = (self.record.attempts or 0) + 1
+        self.record.next_attempt_at = 0
+
+        filename = self.record.filename
         request = VodUploadRequest()
         request.SubAppId = self.conf.common.subAppId
-
-        if self.migrate_type == MIGRATE_FROM_LOCAL:
+        request.MediaFilePath = self.source.media_file_path(filename)
+        if self.conf.common.storagePath.useOriginal:
+            request.MediaStoragePath = get_media_storage_path(self.conf, filename)
+        start_time = time.time()
+        self.session = self.vod_uploader.apply(self.conf.common.region, request, self.upload_local)
+        self.metrics.observe_stage(STAGE_APPLY_UPLOAD, start_time)
+
+    def transfer(self):
+        '''读取源文件并上传'''
+
+        filename = self.record.filename
+        if self.upload_local:
+            self.size = os.path.getsize(filename)
+            reserved = 0
+            if self.memory_budget is not None:
+                # sdk内部多线程分块读取文件，按其最多同时缓冲的分块预约内存
+                reserved = self.memory_budget.acquire(get_local_upload_buffer_size(self.size))
             try:
-                request.MediaFilePath = filename
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + filename
-                return self.vod_client.upload(self.conf.common.region, request)
-            except Exception as e:
-                logger.error("{file} upload failed: {error}".format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_URLLIST:
-            try:
-                r = requests.get(filename)
-                if r.status_code != 200:
-                    raise Exception('download: {key} failed, httpCode: {code}'.format(
-                        key=filename, code=r.getcode()))
-                size = 0
-                if 'Content-Length' in r.headers:
-                    size = int(r.headers['Content-Length'])
-                self.record.filesize = size
-                u = urlparse(filename)
-                filepath = os.path.basename(u.path)
-                request.MediaFilePath = filepath
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + u.path
-                response = self.vod_uploader.upload_from_buffer(
-                    self.conf.common.region, request, r, size)
-
-                return response
-            except Exception as e:
-                logger.error('{file} upload failed: {error}'.format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_COS:
-            try:
-                cos_config = CosConfig(
-                    Region=self.conf.migrateCos.region,
-                    SecretId=self.conf.migrateCos.secretId,
-                    SecretKey=self.conf.migrateCos.secretKey)
-                cos_client = CosS3Client(cos_config)
-
-                r = cos_client.get_object(self.conf.migrateCos.bucket, filename)
-                request.MediaFilePath = filename
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + "/" + filename
-                response = self.vod_uploader.upload_from_buffer(
-                    self.conf.common.region, request,
-                    r['Body'], int(r['Content-Length']))
-
-                return response
-            except Exception as e:
-                logger.error('{file} upload failed: {error}'.format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_AWS:
-            try:
-                session = boto3.session.Session(
-                    region_name=self.conf.migrateAws.region,
-                    aws_access_key_id=self.conf.migrateAws.accessKeyId,
-                    aws_secret_access_key=self.conf.migrateAws.accessKeySecret)
-                s3 = session.resource('s3')
-                bucket = s3.Bucket(self.conf.migrateAws.bucket)
-
-                r = bucket.Object(filename).get()
-                request.MediaFilePath = filename
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + "/" + filename
-                response = self.vod_uploader.upload_from_buffer(
-                    self.conf.common.region, request, r['Body'], r['ContentLength'])
-
-                return response
-            except Exception as e:
-                logger.error('{file} upload failed: {error}'.format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_ALI:
-            try:
-                auth = oss2.Auth(
-                    self.conf.migrateAli.accessKeyId,
-                    self.conf.migrateAli.accessKeySecret)
-
-                bucket = oss2.Bucket(
-                    auth,
-                    self.conf.migrateAli.endPoint,
-                    self.conf.migrateAli.bucket)
-
-                r = bucket.get_object(filename)
-                request.MediaFilePath = filename
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + "/" + filename
-                response = self.vod_uploader.upload_from_buffer(
-                    self.conf.common.region, request, r, r.content_length)
-
-                return response
-            except Exception as e:
-                logger.error('{file} upload failed: {error}'.format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-        elif self.migrate_type == MIGRATE_FROM_QINIU:
-            try:
-                auth = qiniu.Auth(
-                    self.conf.migrateQiniu.accessKeyId,
-                    self.conf.migrateQiniu.accessKeySecret)
-
-                end_point = self.conf.migrateQiniu.endPoint
-                base_url = 'http://{end_point}/{key}'.format(
-                    end_point=end_point, key=quote(to_printable_str(filename)))
-                private_url = auth.private_download_url(base_url)
-
-                r = requests.get(private_url)
-                if r.status_code != 200:
-                    logger.error("code: {code}".format(code=r.status_code))
-                    raise Exception('download: {key} failed, httpCode: {code}'.format(
-                        key=filename, code=r.status_code))
-                size = 0
-                if 'Content-Length' in r.headers:
-                    size = int(r.headers['Content-Length'])
-
-                request.MediaFilePath = filename
-                if self.conf.common.storagePath.useOriginal:
-                    request.MediaStoragePath = prefix + "/" + filename
-                response = self.vod_uploader.upload_from_buffer(
-                    self.conf.common.region, request, r, size)
-
-                return response
-            except Exception as e:
-                logger.error("{file} upload failed: {error}".format(
-                    file=to_printable_str(filename), error=e))
-                raise e
-
-        return
+                start_time = time.time()
+                self.vod_uploader.upload_local(self.session)
+                self.metrics.observe_stage(STAGE_PUT, start_time)
+            finally:
+                if reserved:
+                    self.memory_budget.release(reserved)
+            return
 
-    def do_task(self):
+        if self.host_rate_limiter is not None:
+            self.host_rate_limiter.acquire(get_record_host(self.record))
+        start_time = time.time()
+        with span(SPAN_SOURCE_OPEN):
+            body, size = self.source.open_stream(filename)
+        self.metrics.observe_stage(STAGE_SOURCE_OPEN, start_time)
         try:
-            upload_result = self.upload_file(self.record.filename)
-            if upload_result is None or upload_result.FileId is None or upload_result.MediaUrl is None:
-                raise Exception(
-                    "{file} upload failed".format(file=to_printable_str(self.record.filename)))
-
-            self.record.file_id = upload_result.FileId
-            self.record.vod_url = upload_result.MediaUrl
-            self.record.err_msg = ""
-            self.record.status = MIGRATE_TASK_SUCCESS
-            self.save_record()
-            self.report_task_result(is_success=True)
-        except Exception as e:
-            logger.error(e)
-            self.record.status = MIGRATE_TASK_FAIL
-            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-            self.record.err_msg = "error: {error}, time: {time}".format(
-                error=e,
-                time=now
-            )
-            if not isinstance(self.record.err_msg, text_type):
-                self.record.err_msg = self.record.err_msg.decode(fs_coding)
-            self.save_record()
-            self.report_task_result(is_success=False)
-
-    def report_task_result(self, is_success):
-        self.migrate_manager.increse_counter(is_success)
-
-    def run(self):
-        self.do_task()
-        self.migrate_manager.output_migrate_progress()
\ No newline at end of file
+            # Url列表迁移前不知道文件大小，下载时取得
+            if size:
+                self.record.filesize = size
+            self.size = size
+            start_time = time.time()
+            self.vod_uploader.upload_stream(self.session, body, size)
+            self.metrics.observe_stage(STAGE_PUT, start_time)
+        finally:
+            close_body(body)
+
+    def commit(self):
+        '''校验上传后的文件大小，确认上传'''
+
+        start_time = time.time()
+        self.vod_uploader.verify(self.session, self.size)
+        self.metrics.observe_stage(STAGE_VERIFY, start_time)
+        start_time = time.time()
+        upload_result = self.vod_uploader.commit(self.session)
+        self.metrics.observe_stage(STAGE_COMMIT_UPLOAD, start_time)
+        if upload_result is None or upload_result.FileId is None or upload_result.MediaUrl is None:
+            raise Exception(
+                "{file} upload failed".format(file=to_printable_str(self.record.filename)))
+
+        self.record.file_id = upload_result.FileId
+        self.record.vod_url = upload_result.MediaUrl
+        self.record.err_msg = ""
+        self.record.error_class = ""
+        self.record.status = MIGRATE_TASK_SUCCESS
+        self.finished = True
+
+    def fail(self, e):
+        '''记录失败原因，可重试的错误在尝试次数未用完时安排重试'''
+
+        logger.error("{file} upload failed: {error}".format(
+            file=to_printable_str(self.record.filename), error=e))
+        self.record.status = MIGRATE_TASK_FAIL
+        self.record.error_class = classify_error(e)
+        self.metrics.errors.inc((self.migrate_type, self.record.error_class, get_error_code(e)))
+        retry = self.record.error_class == MIGRATE_ERROR_RETRYABLE and \
+            self.record.attempts < int(self.conf.common.maxAttempts)
+        if retry:
+            self.metrics.retries.inc((self.migrate_type,))
+            delay = get_retry_delay(
+                self.record.attempts, float(self.conf.common.retryBaseSeconds),
+                float(self.conf.common.retryMaxSeconds))
+            self.record.next_attempt_at = int(time.time() + delay) + 1
+            logger.info("{file}: attempt {attempts} failed, retry in {delay:.0f}s".format(
+                file=to_printable_str(self.record.filename),
+                attempts=self.record.attempts, delay=delay))
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        self.record.err_msg = "error: {error}, time: {time}".format(
+            error=e,
+            time=now
+        )
+        if not isinstance(self.record.err_msg, text_type):
+            self.record.err_msg = self.record.err_msg.decode(fs_coding)
+        # 等待重试的任务尚未结束，不计入失败数
+        self.finished = not retry
+
+    def persist(self):
+        '''保存迁移结果并输出进度'''
+
+        self.save_record()
+        if self.finished:
+            is_success = self.record.status == MIGRATE_TASK_SUCCESS
+            size = self.size or self.record.filesize or 0
+            self.report_task_result(is_success, size)
+            self.metrics.files.inc((self.migrate_type, self.record.status))
+            if is_success:
+                self.metrics.bytes.inc((self.migrate_type,), size)
+        self.migrate_manager.output_migrate_progress()
+
+    def report_task_result(self, is_success, size=0):
+        self.migrate_manager.increse_counter(is_success, size)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import fnmatch
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL
+from qcloud_vod_migrate.util import to_printable_str
+from six import string_types
+
+logger = logging.getLogger("cmd")
+
+# 媒体格式所属分类配置
+media_classification_config = [{
+    "class":
+        "video",
+    "mediaTypeList": [
+        "mp4", "flv", "wmv", "asf", "rm", "rmvb", "mpg", "mpeg", "3gp", "mov",
+        "webm", "mkv", "avi", "ts", "wm", "asx", "ram", "mpe", "vob", "dat", "mp4v", "m4v", "f4v", "mxf"
+    ],
+}, {
+    "class": "audio",
+    "mediaTypeList": ["mp3", "m4a", "flac", "ogg", "wav", "ra", "aac", "amr"],
+}, {
+    "class":
+        "image",
+    "mediaTypeList": [
+        "jpg", "jpeg", "png", "gif", "bmp", "tiff", "ai", "cdr", "eps"
+    ],
+}]
+
+# 规则以 re: 开头时按正则表达式匹配，否则按glob通配符匹配
+REGEX_RULE_PREFIX = "re:"
+
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
+
+SKIP_BY_PATH = "path"
+SKIP_BY_MEDIA_CLASSIFICATION = "media classification"
+SKIP_BY_MEDIA_TYPE = "media type"
+SKIP_BY_INCLUDE = "include rules"
+SKIP_BY_EXCLUDE = "exclude rules"
+SKIP_BY_SIZE = "size"
+SKIP_BY_MTIME = "mtime"
+
+
+def get_file_type(filename):
+    '''取得文件扩展名（小写，不含点），与 os.path.splitext 规则一致（以点开头的文件名没有扩展名）'''
+
+    sep_index = filename.rfind(os.sep)
+    dot_index = filename.rfind('.')
+    if dot_index <= sep_index + 1 or filename[sep_index + 1:dot_index].strip('.') == '':
+        return ''
+    return filename[dot_index + 1:].lower()
+
+
+def compile_rules(rules):
+    '''将glob/正则规则列表合并编译为一个正则表达式，规则为空时返回None'''
+
+    patterns = []
+    for rule in rules:
+        if rule.startswith(REGEX_RULE_PREFIX):
+            pattern = rule[len(REGEX_RULE_PREFIX):]
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise Exception("invalid filter rule {rule}: {error}".format(rule=rule, error=e))
+            patterns.append(pattern)
+        else:
+            patterns.append(fnmatch.translate(rule))
+    if len(patterns) == 0:
+        return None
+    return re.compile("|".join("(?:{p})".format(p=p) for p in patterns))
+
+
+def parse_time(value):
+    '''将配置中的时间（toml日期时间、字符串或时间戳）转换为时间戳，空值返回None'''
+
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return calendar.timegm(value.utctimetuple())
+        return time.mktime(value.timetuple())
+    if isinstance(value, datetime.date):
+        return time.mktime(value.timetuple())
+    if isinstance(value, string_types):
+        for time_format in TIME_FORMATS:
+            try:
+                return time.mktime(time.strptime(value, time_format))
+            except ValueError:
+                continue
+    raise Exception("invalid filter time: {value}".format(value=value))
+
+
+def parse_iso_time(value):
+    '''解析对象存储列表返回的UTC时间，如 2020-01-01T08:00:00.000Z'''
+
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+class MediaFilter(object):
+    '''迁移文件过滤器：配置在初始化时编译为哈希表和正则表达式，逐个文件过滤时只做查表和一次正则匹配；
+    跳过的文件按原因累计计数，扫描结束后统一输出，不再逐个文件打印日志'''
+
+    def __init__(self, conf):
+        self.local_excludes = ()
+        if conf.migrateType.type == MIGRATE_FROM_LOCAL:
+            self.local_excludes = tuple(conf.migrateLocal.excludes)
+
+        supported = set(conf.common.supportMediaClassification)
+        excluded_types = set(t.lower() for t in conf.common.excludeMediaType)
+        # 扩展名 -> 是否迁移，同时完成媒体分类和排除类型的判断
+        self.file_types = {}
+        for classification in media_classification_config:
+            for media_type in classification["mediaTypeList"]:
+                if classification["class"] not in supported:
+                    self.file_types[media_type] = SKIP_BY_MEDIA_CLASSIFICATION
+                elif media_type in excluded_types:
+                    self.file_types[media_type] = SKIP_BY_MEDIA_TYPE
+                else:
+                    self.file_types[media_type] = None
+
+        filter_conf = conf.common.filter
+        self.include = compile_rules(filter_conf.include)
+        self.exclude = compile_rules(filter_conf.exclude)
+        self.min_size = int(filter_conf.minSize)
+        self.max_size = int(filter_conf.maxSize)
+        self.mtime_after = parse_time(filter_conf.mtimeAfter)
+        self.mtime_before = parse_time(filter_conf.mtimeBefore)
+
+        self.skipped = OrderedDict()
+
+    def is_excludes(self, filename):
+        '''检查文件的目录是否被排除'''
+
+        # 取到最后一个分隔符（含），与 os.path.dirname 的前缀判断结果一致
+        filepath = filename[:filename.rfind(os.sep) + 1]
+        return filepath.startswith(self.local_excludes)
+
+    def get_skip_reason(self, filename, filesize=None, mtime=None, check_excludes=True):
+        '''返回文件被跳过的原因，需要迁移时返回None；filesize/mtime未知时不做对应的检查'''
+
+        if check_excludes and self.local_excludes and self.is_excludes(filename):
+            return SKIP_BY_PATH
+
+        reason = self.file_types.get(get_file_type(filename), SKIP_BY_MEDIA_CLASSIFICATION)
+        if reason is not None:
+            return reason
+
+        if self.include is not None and self.include.match(filename) is None:
+            return SKIP_BY_INCLUDE
+        if self.exclude is not None and self.exclude.match(filename) is not None:
+            return SKIP_BY_EXCLUDE
+
+        if filesize is not None:
+            if filesize < self.min_size or 0 < self.max_size < filesize:
+                return SKIP_BY_SIZE
+        if mtime is not None:
+            if self.mtime_after is not None and mtime < self.mtime_after:
+                return SKIP_BY_MTIME
+            if self.mtime_before is not None and mtime >= self.mtime_before:
+                return SKIP_BY_MTIME
+        return None
+
+    def check(self, filename, filesize=None, mtime=None, check_excludes=True):
+        '''文件需要迁移时返回True，否则累计跳过原因并返回False'''
+
+        reason = self.get_skip_reason(filename, filesize, mtime, check_excludes)
+        if reason is None:
+            return True
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("{filename}: skipped by {reason}".format(
+                filename=to_printable_str(filename), reason=reason))
+        return False
+
+    def log_skipped(self):
+        if len(self.skipped) == 0:
+            return
+        logger.info("skipped files: {counts}".format(counts=", ".join(
+            "{reason}: {num}".format(reason=reason, num=num)
+            for reason, num in self.skipped.items())))
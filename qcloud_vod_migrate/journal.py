@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import csv
+import glob
+import gzip
+import heapq
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from six import PY2, text_type
+
+logger = logging.getLogger("cmd")
+
+JOURNAL_DIR = "vod_migrate_journal"
+JOURNAL_SUFFIX = ".jsonl"
+GZIP_SUFFIX = ".gz"
+
+RESULT_FORMAT_JSONL = "jsonl"
+RESULT_FORMAT_CSV = "csv"
+
+RESULT_FIELDS = [
+    "id", "migrateType", "filename", "lastModified", "filesize", "etag",
+    "fileId", "mediaUrl", "status", "errMsg", "updateTime"
+]
+
+# 日志行以 {"ts": 时间戳, "id": 记录id, 开头，合并时无需解析整行json
+JOURNAL_LINE_PREFIX = b'{"ts": '
+JOURNAL_ID_PREFIX = b'"id": '
+
+# 合并日志时每个有序分段的行数，内存占用与该值成正比，与记录数及记录id的大小无关
+COMPACT_RUN_LINES = 200000
+
+
+def format_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
+def build_result(record, update_time):
+    '''迁移记录对应的结果，字段顺序固定；update_time为格式化后的本地时间'''
+
+    return OrderedDict([
+        ("id", record.id),
+        ("migrateType", record.migrate_type),
+        ("filename", record.filename),
+        ("lastModified", record.mtime),
+        ("filesize", record.filesize),
+        ("etag", record.etag),
+        ("fileId", record.file_id),
+        ("mediaUrl", record.vod_url),
+        ("status", record.status),
+        ("errMsg", record.err_msg),
+        ("updateTime", update_time),
+    ])
+
+
+def dump_json(data):
+    line = json.dumps(data, ensure_ascii=False) + '\n'
+    if not isinstance(line, text_type):
+        line = line.decode('utf-8')
+    return line.encode('utf-8')
+
+
+def gzip_bytes(data):
+    '''压缩为一个完整的gzip member，多个member直接拼接仍是合法的gzip文件'''
+
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class ResultOutput(object):
+    '''迁移结果文件：一行一条记录的json或csv，可选gzip压缩'''
+
+    def __init__(self, path, result_format, compress):
+        self.path = path
+        self.result_format = result_format
+        tmp_path = path + ".tmp"
+        self.tmp_path = tmp_path
+        if compress:
+            self.f = gzip.open(tmp_path, 'wb')
+        else:
+            self.f = io.open(tmp_path, 'wb')
+        self.csv_writer = None
+        if result_format == RESULT_FORMAT_CSV:
+            if PY2:
+                self.csv_writer = csv.writer(self.f)
+            else:
+                self.text = io.TextIOWrapper(self.f, encoding='utf-8', newline='')
+                self.csv_writer = csv.writer(self.text)
+            self.write_row(RESULT_FIELDS)
+
+    def write_row(self, row):
+        if PY2:
+            row = [v.encode('utf-8') if isinstance(v, text_type) else v for v in row]
+        self.csv_writer.writerow(row)
+
+    def write_result(self, result):
+        if self.csv_writer is not None:
+            self.write_row([result[field] for field in RESULT_FIELDS])
+        else:
+            self.f.write(dump_json(result))
+
+    def write_json_line(self, line):
+        '''line为utf-8编码的json行'''
+
+        if self.csv_writer is not None:
+            self.write_result(json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict))
+        else:
+            self.f.write(line)
+
+    def close(self):
+        if self.csv_writer is not None and not PY2:
+            self.text.close()
+        else:
+            self.f.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        '''放弃已写入的内容，删除临时文件'''
+
+        if self.csv_writer is not None and not PY2:
+            self.text.close()
+        else:
+            self.f.close()
+        os.remove(self.tmp_path)
+
+
+class ResultJournal(object):
+    '''迁移结果日志：每个进程在任务完成（记录提交到db）时，将结果追加到自己的日志文件，
+    迁移过程中即可读取已完成文件的FileId；迁移结束时合并所有日志，每条记录只保留最后一次结果'''
+
+    def __init__(self, output_path, part_name, compress=False):
+        self.dir = os.path.join(output_path, JOURNAL_DIR)
+        self.compress = compress
+        suffix = JOURNAL_SUFFIX + (GZIP_SUFFIX if compress else "")
+        self.path = os.path.join(self.dir, part_name + suffix)
+        self.f = None
+
+    def append(self, results):
+        '''results为 [(时间戳, 结果)]'''
+
+        if len(results) == 0:
+            return
+        lines = []
+        for ts, result in results:
+            entry = OrderedDict([("ts", ts)])
+            entry.update(result)
+            lines.append(dump_json(entry))
+        data = b''.join(lines)
+        if self.compress:
+            data = gzip_bytes(data)
+
+        if self.f is None:
+            if not os.path.exists(self.dir):
+                os.makedirs(self.dir)
+            self.f = io.open(self.path, 'ab')
+        self.f.write(data)
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def clear(self):
+        self.close()
+        for path in self.get_parts():
+            os.remove(path)
+
+    def get_parts(self):
+        return sorted(glob.glob(os.path.join(self.dir, "*" + JOURNAL_SUFFIX)) +
+                      glob.glob(os.path.join(self.dir, "*" + JOURNAL_SUFFIX + GZIP_SUFFIX)))
+
+    def iter_lines(self):
+        '''依次读取所有日志文件中完整的行；进程异常退出时最后一行可能不完整，直接跳过'''
+
+        for path in self.get_parts():
+            if path.endswith(GZIP_SUFFIX):
+                f = gzip.open(path, 'rb')
+            else:
+                f = io.open(path, 'rb')
+            try:
+                for line in f:
+                    if line.endswith(b'\n') and line.startswith(JOURNAL_LINE_PREFIX):
+                        yield line
+            except (EOFError, IOError) as e:
+                logger.error("read {path} failed: {error}".format(path=path, error=e))
+            finally:
+                f.close()
+
+    @staticmethod
+    def parse_prefix(line):
+        ts, record_id, _ = line[len(JOURNAL_LINE_PREFIX):].split(b', ', 2)
+        return float(ts), int(record_id[len(JOURNAL_ID_PREFIX):])
+
+    def write_run(self, entries):
+        '''将一段日志按 (id, 时间戳, 行号) 排序后写入临时文件，每行以行号开头'''
+
+        entries.sort(key=lambda entry: entry[:3])
+        f = tempfile.TemporaryFile(dir=self.dir)
+        for _, _, seq, line in entries:
+            f.write(str(seq).encode('ascii') + b' ' + line)
+        f.seek(0)
+        return f
+
+    def iter_run(self, f):
+        for run_line in f:
+            seq, line = run_line.split(b' ', 1)
+            ts, record_id = self.parse_prefix(line)
+            yield record_id, ts, int(seq), line
+
+    def compact(self, output_path, result_format, compress, expected_num):
+        '''合并日志生成最终结果文件：日志按段排序写入临时文件后多路归并，每个id只输出时间戳最大
+        （相同时为最后写入）的一行，按id顺序输出；内存占用只与分段大小有关。
+        日志中的记录数少于expected_num（如旧版本db、未完成的记录）时返回False'''
+
+        self.close()
+        runs = []
+        try:
+            entries = []
+            for seq, line in enumerate(self.iter_lines()):
+                try:
+                    ts, record_id = self.parse_prefix(line)
+                except ValueError:
+                    continue
+                entries.append((record_id, ts, seq, line))
+                if len(entries) >= COMPACT_RUN_LINES:
+                    runs.append(self.write_run(entries))
+                    entries = []
+            if len(entries) > 0:
+                runs.append(self.write_run(entries))
+            entries = None
+
+            output = ResultOutput(output_path, result_format, compress)
+            record_num = 0
+            last = None
+            try:
+                for entry in heapq.merge(*[self.iter_run(f) for f in runs]):
+                    if last is not None and entry[0] != last[0]:
+                        record_num += 1
+                        # 去掉开头的 "ts" 字段
+                        output.write_json_line(b'{' + last[3].split(b', ', 1)[1])
+                    last = entry
+                if last is not None:
+                    record_num += 1
+                    output.write_json_line(b'{' + last[3].split(b', ', 1)[1])
+            except Exception:
+                output.abort()
+                raise
+            if record_num < expected_num:
+                output.abort()
+                return False
+            output.close()
+            return True
+        finally:
+            for f in runs:
+                f.close()
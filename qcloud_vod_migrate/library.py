@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from tencentcloud.common import credential
+from tencentcloud.vod.v20180717 import vod_client, models
+from qcloud_vod_migrate.config import MIGRATE_FROM_URLLIST
+from qcloud_vod_migrate.execute import get_media_name, get_media_storage_path
+from qcloud_vod_migrate.source.base import max_retry_times
+
+logger = logging.getLogger("cmd")
+
+# SearchMedia 要求 Offset + Limit 不超过5000，超过后按创建时间开启下一个查询窗口
+SEARCH_PAGE_SIZE = 1000
+SEARCH_WINDOW_SIZE = 5000
+
+# 按名称/路径批量匹配时，每批的记录数
+MATCH_PAGE_SIZE = 500
+
+
+class VodLibrary(object):
+    '''拉取vod（子应用）中已有的媒体建立本地索引，迁移前将已经上传过的文件标记为迁移成功
+
+    useOriginal为true时按存储路径匹配，否则按媒体名称和文件大小匹配'''
+
+    def __init__(self, migrate_manager):
+        self.conf = migrate_manager.conf
+        self.migrate_type = self.conf.migrateType.type
+        self.migrate_manager = migrate_manager
+        self.match_storage_path = self.conf.common.storagePath.useOriginal
+        cred = credential.Credential(self.conf.common.secretId, self.conf.common.secretKey)
+        self.api_client = vod_client.VodClient(cred, self.conf.common.region)
+
+    def search_media(self, create_after, offset):
+        request = models.SearchMediaRequest()
+        if self.conf.common.subAppId:
+            request.SubAppId = self.conf.common.subAppId
+        request.Filters = ["basicInfo", "metaData"]
+        request.Sort = models.SortBy()
+        request.Sort.Field = "CreateTime"
+        request.Sort.Order = "Asc"
+        if create_after:
+            request.CreateTime = models.TimeRange()
+            request.CreateTime.After = create_after
+        request.Offset = offset
+        request.Limit = SEARCH_PAGE_SIZE
+
+        for i in range(max_retry_times):
+            try:
+                return self.api_client.SearchMedia(request).MediaInfoSet or []
+            except Exception as e:
+                logger.error(e)
+                if i + 1 == max_retry_times:
+                    raise e
+                time.sleep(1 << i)
+
+    def build_index(self):
+        '''按创建时间顺序分窗口拉取全部媒体，窗口边界上创建时间相同的媒体按FileId去重'''
+
+        self.migrate_manager.reset_library_media()
+        media_num = 0
+        create_after = None
+        boundary_file_ids = set()
+        while True:
+            window = []
+            for offset in range(0, SEARCH_WINDOW_SIZE, SEARCH_PAGE_SIZE):
+                media_set = self.search_media(create_after, offset)
+                window.extend(media_set)
+                if len(media_set) < SEARCH_PAGE_SIZE:
+                    break
+
+            mappings = []
+            for media in window:
+                if media.FileId in boundary_file_ids:
+                    continue
+                basic_info = media.BasicInfo
+                mappings.append({
+                    'file_id': media.FileId,
+                    'name': basic_info.Name or '',
+                    'storage_path': basic_info.StoragePath or '',
+                    'size': media.MetaData.Size if media.MetaData is not None else 0,
+                    'media_url': basic_info.MediaUrl or '',
+                })
+            if len(mappings) > 0:
+                self.migrate_manager.add_library_media(mappings)
+                media_num += len(mappings)
+                logger.info("vod library: {num} media indexed".format(num=media_num))
+
+            if len(window) < SEARCH_WINDOW_SIZE:
+                break
+
+            last_create_time = window[-1].BasicInfo.CreateTime
+            if last_create_time == create_after:
+                # 同一时刻创建的媒体超过一个窗口，无法继续翻页
+                raise Exception("more than {num} media created at {time}, cannot page through vod library".format(
+                    num=SEARCH_WINDOW_SIZE, time=last_create_time))
+            create_after = last_create_time
+            boundary_file_ids = set(
+                media.FileId for media in window if media.BasicInfo.CreateTime == last_create_time)
+
+        return media_num
+
+    def match_records(self, records):
+        mappings = []
+        if self.match_storage_path:
+            paths = dict((get_media_storage_path(self.conf, r.filename), r) for r in records)
+            for path, media in self.migrate_manager.find_library_media_by_storage_paths(
+                    list(paths.keys())).items():
+                mappings.append({'id': paths[path].id, 'file_id': media.file_id,
+                                 'vod_url': media.media_url})
+        else:
+            # 文件大小未知（如URL列表）时无法可靠匹配，不做处理
+            records = [r for r in records if r.filesize]
+            names = dict((r.id, get_media_name(self.conf, r.filename)) for r in records)
+            media_set = self.migrate_manager.find_library_media_by_names(list(set(names.values())))
+            for record in records:
+                media = media_set.get((names[record.id], record.filesize))
+                if media is not None:
+                    mappings.append({'id': record.id, 'file_id': media.file_id,
+                                     'vod_url': media.media_url})
+        if len(mappings) > 0:
+            self.migrate_manager.mark_records_existing(mappings)
+        return len(mappings)
+
+    def run(self):
+        if self.migrate_type == MIGRATE_FROM_URLLIST and not self.match_storage_path:
+            logger.info("skipExistingMedia requires useOriginal for migrateUrl, skip")
+            return
+
+        self.migrate_manager.flush_migrate_records()
+        media_num = self.build_index()
+        if media_num == 0:
+            return
+
+        matched_num = 0
+        last_id = 0
+        while True:
+            records = self.migrate_manager.get_unmigrated_records(
+                self.migrate_type, last_id, MATCH_PAGE_SIZE)
+            if len(records) == 0:
+                break
+            last_id = records[-1].id
+            matched_num += self.match_records(records)
+
+        logger.info("vod library: {num} files already exist in vod, skip".format(num=matched_num))
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+
+
+class HostScheduler(object):
+    '''源站公平调度：按源站host轮询分发任务，并限制单个源站的在途任务数'''
+
+    def __init__(self, key_func, max_in_flight_per_host=0):
+        self.key_func = key_func
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.queues = OrderedDict()
+        self.in_flight = {}
+        self.hosts = deque()
+
+    def add(self, item):
+        host = self.key_func(item)
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.in_flight.setdefault(host, 0)
+            self.hosts.append(host)
+        self.queues[host].append(item)
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def next(self):
+        '''按轮询顺序取出下一个可执行的任务；所有源站都已达到在途上限或无任务时返回None'''
+
+        for _ in range(len(self.hosts)):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if self.max_in_flight_per_host > 0 and \
+                    self.in_flight[host] >= self.max_in_flight_per_host:
+                continue
+            item = self.queues[host].popleft()
+            self.in_flight[host] += 1
+            if len(self.queues[host]) == 0:
+                del self.queues[host]
+                self.hosts.remove(host)
+            return item
+
+        return None
+
+    def done(self, item):
+        host = self.key_func(item)
+        self.in_flight[host] -= 1
+
+
+class HostRateLimiter(object):
+    '''按源站host限制请求速率，同一源站相邻两次请求至少间隔 1/rate 秒'''
+
+    def __init__(self, requests_per_second=0):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        if self.interval <= 0:
+            return
+
+        # 在锁内预约时间片，在锁外等待，避免不同源站之间相互阻塞
+        with self.lock:
+            now = time.time()
+            allowed = max(now, self.next_allowed.get(host, 0))
+            self.next_allowed[host] = allowed + self.interval
+
+        wait_time = allowed - now
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# 限速配置的单位为Mbps
+BYTES_PER_MBIT = 1000 * 1000 / 8.0
+
+# 令牌桶容量：最多积攒1秒的流量，空闲后的突发不超过1秒
+BANDWIDTH_BURST_SECONDS = 1.0
+
+# 限速数据流每次读取的块大小
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# 时段限速配置，如 "08:00-20:00 200" 表示每天8点到20点限速200Mbps，结束时间小于开始时间表示跨天
+SCHEDULE_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s+(\d+(?:\.\d+)?)\s*$')
+
+
+def parse_bandwidth_schedule(items):
+    '''解析时段限速配置，返回 [(开始分钟, 结束分钟, 字节/秒)]'''
+
+    schedule = []
+    for item in items:
+        match = SCHEDULE_PATTERN.match(item)
+        if match is None:
+            raise Exception("invalid bandwidthSchedule: {item}".format(item=item))
+        start_hour, start_minute, end_hour, end_minute, limit = match.groups()
+        start = int(start_hour) * 60 + int(start_minute)
+        end = int(end_hour) * 60 + int(end_minute)
+        if int(start_minute) >= 60 or int(end_minute) >= 60 or \
+                start > 24 * 60 or end > 24 * 60 or start == end:
+            raise Exception("invalid bandwidthSchedule: {item}".format(item=item))
+        schedule.append((start, end, float(limit) * BYTES_PER_MBIT))
+    return schedule
+
+
+class BandwidthLimiter(object):
+    '''全局带宽限制（令牌桶），进程内所有迁移任务共享；按本地时间匹配时段限速，
+    不在任何时段内时使用默认限速，限速为0表示不限速'''
+
+    def __init__(self, limit_mbps=0, schedule=None):
+        self.default_rate = float(limit_mbps) * BYTES_PER_MBIT
+        self.schedule = parse_bandwidth_schedule(schedule or [])
+        self.tokens = 0.0
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def get_rate(self, now):
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, rate in self.schedule:
+            if start < end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default_rate
+
+    def consume(self, size):
+        '''取得size字节的令牌，令牌不足时等待；与HostRateLimiter相同，在锁内预约，在锁外等待'''
+
+        with self.lock:
+            now = time.time()
+            rate = self.get_rate(now)
+            if rate <= 0:
+                self.tokens = 0.0
+                self.last_time = now
+                return
+            self.tokens = min(rate * BANDWIDTH_BURST_SECONDS,
+                              self.tokens + (now - self.last_time) * rate)
+            self.last_time = now
+            # 令牌可以透支，后续的请求按透支量排队等待
+            self.tokens -= size
+            wait_time = -self.tokens / rate
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class MemoryBudget(object):
+    '''进程内传输缓冲区的内存预算（字节）：数据块、分块在读取前先预约相应的字节数，
+    预算用尽时等待其他缓冲区释放，而不是继续分配内存'''
+
+    def __init__(self, limit):
+        self.limit = int(limit)
+        self.used = 0
+        self.peak = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        '''预约size字节，返回实际预约的字节数（超过预算时按整个预算预约，避免永远等待）'''
+
+        size = min(int(size), self.limit)
+        with self.cond:
+            while self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+            self.peak = max(self.peak, self.used)
+        return size
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+
+class TransferStream(object):
+    '''传输数据流：包装源站返回的数据流（或本地文件），每读取一块数据都从令牌桶取得相应的字节数，
+    读取源站与上传到vod是同一个数据流，因此同时限制了下载和上传速度；
+    指定memory_budget时，每块数据（迭代或read）在读取前预约内存，发送后（读取下一块时）释放，
+    分块上传的分块由调用方预约后通过read_part读取；指定meter时统计读取的字节数'''
+
+    def __init__(self, body, limiter=None, memory_budget=None, meter=None):
+        self.body = body
+        self.limiter = limiter
+        self.memory_budget = memory_budget
+        self.meter = meter
+        # requests根据len属性设置Content-Length，保持与原数据流一致（未知时使用chunked上传）
+        size = self.get_body_size(body)
+        if size:
+            self.len = size
+        # 原数据流没有read方法时（如requests.Response），read从iter_body中取数据
+        self.chunks = None
+        self.pending = b''
+        # read预约的内存，读取下一块或调用release_memory时释放
+        self.reserved = 0
+
+    @staticmethod
+    def get_body_size(body):
+        if hasattr(body, '__len__'):
+            return len(body)
+        if isinstance(body, io.IOBase):
+            try:
+                return os.fstat(body.fileno()).st_size - body.tell()
+            except (IOError, OSError, ValueError):
+                return None
+        return None
+
+    def iter_body(self):
+        if hasattr(self.body, 'iter_content'):
+            # requests.Response
+            return self.body.iter_content(STREAM_CHUNK_SIZE)
+        if hasattr(self.body, 'get_stream'):
+            # cos StreamBody
+            return self.body.get_stream(STREAM_CHUNK_SIZE)
+        if hasattr(self.body, 'read'):
+            return iter(lambda: self.body.read(STREAM_CHUNK_SIZE), b'')
+        return iter(self.body)
+
+    def __iter__(self):
+        chunks = self.iter_body()
+        reserved = 0
+        try:
+            while True:
+                if self.memory_budget is not None:
+                    # 上一块已经发送，释放后再为下一块预约
+                    self.memory_budget.release(reserved)
+                    reserved = self.memory_budget.acquire(STREAM_CHUNK_SIZE)
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                if self.limiter is not None:
+                    self.limiter.consume(len(chunk))
+                if self.meter is not None:
+                    self.meter.add(len(chunk))
+                yield chunk
+        finally:
+            if reserved:
+                self.memory_budget.release(reserved)
+
+    def read(self, size=-1):
+        '''requests/http.client发送有read方法的数据流时按块调用read，
+        上一块已经发送，释放后再为本块预约内存'''
+
+        if self.memory_budget is None:
+            return self.read_part(size)
+        self.release_memory()
+        if size is None or size < 0:
+            size = getattr(self, 'len', STREAM_CHUNK_SIZE)
+        self.reserved = self.memory_budget.acquire(size)
+        data = self.read_part(size)
+        if not data:
+            self.release_memory()
+        return data
+
+    def read_part(self, size=-1):
+        '''分块上传时读取一个分块，分块的内存由调用方预约'''
+
+        if hasattr(self.body, 'read'):
+            data = self.body.read(size)
+        else:
+            data = self.read_chunks(size)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        if self.meter is not None:
+            self.meter.add(len(data))
+        return data
+
+    def release_memory(self):
+        '''释放read预约的内存；数据流未读完（如上传失败）时由调用方释放'''
+
+        if self.reserved:
+            self.memory_budget.release(self.reserved)
+            self.reserved = 0
+
+    def read_chunks(self, size):
+        if self.chunks is None:
+            self.chunks = self.iter_body()
+        buffers = [self.pending]
+        length = len(self.pending)
+        while size is None or size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            buffers.append(chunk)
+            length += len(chunk)
+        data = b''.join(buffers)
+        if size is not None and 0 <= size < len(data):
+            data, self.pending = data[:size], data[size:]
+        else:
+            self.pending = b''
+        return data
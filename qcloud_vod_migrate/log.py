@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+'''日志输出：工作线程只将日志记录放入队列，由后台线程格式化并写入标准输出，
+避免大量任务并发时格式化和写入阻塞迁移线程；支持文本和json lines两种格式'''
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import sys
+from six.moves import queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # python2没有QueueHandler，直接同步输出
+    QueueHandler = QueueListener = None
+
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_JSON = "json"
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSON)
+
+LOG_LEVELS = ("debug", "info", "warning", "error")
+
+TEXT_FORMAT = '[%(asctime)s] %(message)s'
+
+_listener = None
+_listener_pid = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''每条日志输出为一行json，便于日志系统采集和检索'''
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname.lower(),
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(QueueHandler or object):
+    '''日志记录原样放入队列，格式化留给后台线程（标准QueueHandler在调用线程中格式化）'''
+
+    def prepare(self, record):
+        return record
+
+
+def init_logger(log_format=LOG_FORMAT_TEXT, level=logging.INFO):
+    '''初始化"cmd"日志；重复调用时替换之前的输出（如fork出的工作进程中，父进程的后台线程不存在）'''
+
+    global _listener, _listener_pid
+
+    logger = logging.getLogger("cmd")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+    console = logging.StreamHandler(sys.stdout)
+    if log_format == LOG_FORMAT_JSON:
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    logger.setLevel(level)
+    if QueueListener is None:
+        logger.addHandler(console)
+        return
+
+    log_queue = queue.Queue()
+    _listener = QueueListener(log_queue, console)
+    _listener_pid = os.getpid()
+    _listener.start()
+    logger.addHandler(RecordQueueHandler(log_queue))
+
+
+def stop_logger():
+    '''等待队列中的日志全部输出，之后的日志直接同步输出'''
+
+    global _listener
+
+    listener, _listener = _listener, None
+    if listener is None or _listener_pid != os.getpid():
+        return
+    listener.stop()
+    logger = logging.getLogger("cmd")
+    for handler in list(logger.handlers):
+        if isinstance(handler, RecordQueueHandler):
+            logger.removeHandler(handler)
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+
+
+atexit.register(stop_logger)
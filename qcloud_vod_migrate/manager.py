@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
-import json
+import socket
 import time
 import datetime
+import json
 import sys
 import threading
+from qcloud_vod_migrate.limiter import MemoryBudget
+from qcloud_vod_migrate.journal import ResultJournal, ResultOutput, build_result, format_time, RESULT_FORMAT_CSV
+from qcloud_vod_migrate.metrics import Metrics, STAGE_DB_WRITE
+from qcloud_vod_migrate.profiler import span, timed, SPAN_DB_WRITE, SPAN_SAVE_RECORD
+from qcloud_vod_migrate.progress import EwmaRate, ProgressMeter, format_size, format_duration
 from qcloud_vod_migrate.util import get_file_md5
-from qcloud_vod_migrate.util import fs_coding
-from sqlalchemy import create_engine, Column, Integer, String, text, TIMESTAMP, Text
+from sqlalchemy import create_engine, event, inspect, Column, Index, Integer, String, text, TIMESTAMP, Text, and_, or_
+from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import aliased, sessionmaker
 from sqlalchemy.sql import func
-from six import text_type, PY2, PY3
+from six.moves import queue
 
 if sys.version >= '3.2.':
     localtimezone = datetime.timezone(
@@ -27,6 +33,12 @@ MIGRATE_TASK_INIT = "init"
 MIGRATE_TASK_SUCCESS = "success"
 MIGRATE_TASK_FAIL = "fail"
 MIGRATE_TASK_EXCLUDE = "exclude"
+MIGRATE_TASK_RUNNING = "running"
+MIGRATE_TASK_DUPLICATE = "duplicate"
+
+# 迁移失败的错误分类：可重试的失败在本次执行中按退避时间重新领取，不可重试的失败再次执行时也不再迁移
+MIGRATE_ERROR_RETRYABLE = "retryable"
+MIGRATE_ERROR_PERMANENT = "permanent"
 
 MIGRATE_INIT = "init"
 MIGRATE_RUNNING = "running"
@@ -36,8 +48,31 @@ MIGRATE_RESULT_FILE = "vod_migrate_result.txt"
 MIGRATE_DB = "migrate.db"
 MIGRATE_RECORDS_TABLE = "records"
 MIGRATE_SESSION_TABLE = "session"
+LIBRARY_MEDIA_TABLE = "library_media"
 
 MAX_FETCH_NUM = 1000
+MAX_LEASE_RENEW_NUM = 500
+DEDUP_PAGE_SIZE = 1000
+
+# 迁移记录批量写入配置：攒够一批或到达间隔时间后，在一个事务内提交
+WRITE_BATCH_SIZE = 1000
+WRITE_FLUSH_INTERVAL = 0.5
+WRITE_RETRY_TIMES = 5
+
+SQLITE_JOURNAL_MODE = "WAL"
+SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_BUSY_TIMEOUT = 30000
+
+RECORD_UPDATE_FIELDS = [
+    "mtime", "filesize", "etag", "file_id", "vod_url", "status", "err_msg",
+    "content_hash", "dup_of", "attempts", "error_class", "next_attempt_at"
+]
+RECORD_INSERT_FIELDS = ["migrate_type", "filename"] + RECORD_UPDATE_FIELDS
+
+BYTES_PER_MB = 1024 * 1024
+
+# 记录更新为这些状态时，将结果写入结果日志
+JOURNAL_STATUSES = ("success", "fail")
 
 logger = logging.getLogger("cmd")
 
@@ -53,6 +88,10 @@ class MigrateStatus(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     status = Column(String(16))
     config_md5 = Column(String(64))
+    # 首次扫描的列举位置（json），与已保存的迁移记录一起提交，扫描中断后从该位置继续
+    list_cursor = Column(Text().with_variant(LONGTEXT, 'mysql'), nullable=True)
+    # 本次执行的开始时间（秒），所有工作进程共用，早于该时间领取过的记录视为本次执行尚未处理
+    execute_begin_time = Column(Integer, server_default='0')
     create_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
     update_time = Column(
         TIMESTAMP,
@@ -64,6 +103,11 @@ class MigrateRecord(Base):
     '''迁移记录，与文件关联'''
 
     __tablename__ = MIGRATE_RECORDS_TABLE
+    __table_args__ = (
+        Index('idx_records_type_filename', 'migrate_type', 'filename',
+              mysql_length={'filename': 255}),
+        Index('idx_records_type_size_hash', 'migrate_type', 'filesize', 'content_hash'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     migrate_type = Column(String(32))
@@ -75,6 +119,15 @@ class MigrateRecord(Base):
     vod_url = Column(String(256), server_default='')
     status = Column(String(16))
     err_msg = Column(String(256), nullable=True, server_default='')
+    owner = Column(String(128), server_default='')
+    lease_expire = Column(Integer, server_default='0')
+    # 最近一次被领取的时间（秒），与租约使用同一个时钟，用于判断本次执行是否已处理过
+    claim_time = Column(Integer, server_default='0')
+    content_hash = Column(String(128), server_default='')
+    dup_of = Column(Integer, server_default='0')
+    attempts = Column(Integer, server_default='0')
+    error_class = Column(String(16), server_default='')
+    next_attempt_at = Column(Integer, server_default='0')
     create_time = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
     update_time = Column(
         TIMESTAMP,
@@ -82,21 +135,236 @@ class MigrateRecord(Base):
         onupdate=func.now())
 
 
+class LibraryMedia(Base):
+    '''vod中已有的媒体，用于跳过已经上传过的文件'''
+
+    __tablename__ = LIBRARY_MEDIA_TABLE
+    __table_args__ = (
+        Index('idx_library_storage_path', 'storage_path', mysql_length={'storage_path': 255}),
+        Index('idx_library_name_size', 'name', 'size', mysql_length={'name': 255}),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    file_id = Column(String(128), server_default='')
+    name = Column(Text, server_default='')
+    storage_path = Column(Text, server_default='')
+    size = Column(Integer, server_default='0')
+    media_url = Column(String(256), server_default='')
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    '''SQLite使用WAL模式：读写互不阻塞，且只在checkpoint时才需要fsync'''
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode={mode}".format(mode=SQLITE_JOURNAL_MODE))
+    cursor.execute("PRAGMA synchronous={level}".format(level=SQLITE_SYNCHRONOUS))
+    cursor.execute("PRAGMA busy_timeout={timeout}".format(timeout=SQLITE_BUSY_TIMEOUT))
+    cursor.close()
+
+
+class RecordWriter(object):
+    '''迁移记录写入线程：所有记录的新增和更新都由该线程合并后批量提交，
+    迁移线程只负责入队，不在上传路径上等待db写入；提交成功后将已完成记录的结果追加到结果日志；
+    某一批重试后仍提交失败时停止写入（不再提交之后的记录），入队、flush及check都抛出该错误'''
+
+    def __init__(self, journal=None, metrics=None):
+        self.journal = journal
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check(self):
+        '''写入已失败时抛出错误'''
+
+        if self.error is not None:
+            raise self.error
+
+    def insert(self, record):
+        self.check()
+        self.queue.put(('insert', dict(
+            (field, getattr(record, field)) for field in RECORD_INSERT_FIELDS)))
+
+    def update(self, record):
+        self.check()
+        mapping = dict(
+            (field, getattr(record, field)) for field in RECORD_UPDATE_FIELDS)
+        mapping['id'] = record.id
+        result = None
+        if self.journal is not None and record.status in JOURNAL_STATUSES:
+            now = time.time()
+            result = (now, build_result(record, format_time(now)))
+        self.queue.put(('update', (mapping, result)))
+
+    def save_cursor(self, cursor):
+        '''列举位置在之前入队的记录之后提交，且与这些记录在同一个事务中'''
+
+        self.check()
+        self.queue.put(('cursor', cursor))
+
+    def flush(self):
+        '''阻塞等待，直到已入队的记录全部提交'''
+
+        flushed = threading.Event()
+        self.queue.put(('flush', flushed))
+        flushed.wait()
+        self.check()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.queue.put(('close', None))
+            self.thread.join()
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + WRITE_FLUSH_INTERVAL
+            # 遇到flush/close时立即提交，否则继续攒批直到批量上限或间隔时间
+            while len(items) < WRITE_BATCH_SIZE and items[-1][0] in ('insert', 'update', 'cursor'):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            inserts = []
+            updates = {}
+            results = []
+            cursor = None
+            for action, data in items:
+                if action == 'insert':
+                    inserts.append(data)
+                elif action == 'cursor':
+                    cursor = data
+                elif action == 'update':
+                    mapping, result = data
+                    # 同一条记录的多次更新只保留最后一次
+                    updates.setdefault(mapping['id'], {}).update(mapping)
+                    if result is not None:
+                        results.append(result)
+            # 之前的批次提交失败后不再提交，避免db中只有部分后续状态
+            if self.error is None and self.commit(inserts, list(updates.values()), cursor):
+                self.append_journal(results)
+
+            for action, data in items:
+                if action == 'flush':
+                    data.set()
+                elif action == 'close':
+                    return
+
+    def append_journal(self, results):
+        # 结果日志写入失败不影响迁移，最终结果文件会退回到从db导出
+        try:
+            self.journal.append(results)
+        except Exception as e:
+            logger.error("append result journal failed: {error}".format(error=e))
+
+    def commit(self, inserts, updates, cursor=None):
+        if len(inserts) == 0 and len(updates) == 0 and cursor is None:
+            return True
+
+        for i in range(WRITE_RETRY_TIMES):
+            start_time = time.time()
+            session = Session()
+            try:
+                with span(SPAN_DB_WRITE):
+                    if len(inserts) > 0:
+                        session.bulk_insert_mappings(MigrateRecord, inserts)
+                    if len(updates) > 0:
+                        session.bulk_update_mappings(MigrateRecord, updates)
+                    if cursor is not None:
+                        session.query(MigrateStatus).filter(
+                            MigrateStatus.status == MIGRATE_INIT).update(
+                                {MigrateStatus.list_cursor: cursor}, synchronize_session=False)
+                    session.commit()
+                if self.metrics is not None:
+                    self.metrics.observe_stage(STAGE_DB_WRITE, start_time)
+                return True
+            except Exception as e:
+                session.rollback()
+                logger.error(e)
+                if i + 1 == WRITE_RETRY_TIMES:
+                    self.error = e
+                    return False
+                time.sleep(1 << i)
+            finally:
+                session.close()
+
+
 class MigrateManager(object):
 
     def __init__(self, conf):
         self.conf = conf
         self.execute_begin_time = None
         self.lock = threading.Lock()
-        self.engine = create_engine(
-            r'sqlite:///{db_path}?check_same_thread=False'.format(
-                db_path=os.path.join(conf.common.migrateDbStoragePath,
-                                     MIGRATE_DB)))
+        if conf.common.migrateDbUrl:
+            # 使用外部共享数据库，多个进程或多台机器可以共同消费同一个迁移任务
+            self.engine = create_engine(
+                conf.common.migrateDbUrl,
+                pool_pre_ping=True,
+                pool_size=conf.common.concurrency,
+                max_overflow=conf.common.concurrency)
+        else:
+            self.engine = create_engine(
+                r'sqlite:///{db_path}?check_same_thread=False'.format(
+                    db_path=os.path.join(conf.common.migrateDbStoragePath,
+                                         MIGRATE_DB)))
+            event.listen(self.engine, 'connect', _set_sqlite_pragma)
         self.total_num = 0
         self.success_num = 0
         self.fail_num = 0
+        self.total_bytes = 0
+        self.finished_bytes = 0
+        self.size_estimated = False
+        # 本进程实际传输的字节数，用于计算吞吐量
+        self.progress_meter = ProgressMeter()
+        self.byte_rate = EwmaRate()
+        self.file_rate = EwmaRate()
+        self.last_progress_time = 0
+        self.last_progress = None
         Base.metadata.create_all(self.engine, checkfirst=True)
+        self.upgrade_migrate_db()
         Session.configure(bind=self.engine)
+        self.journal = ResultJournal(
+            conf.common.migrateResultOutputPath,
+            '{host}-{pid}'.format(host=socket.gethostname(), pid=os.getpid()),
+            compress=conf.common.resultCompress)
+        # 进程的运行指标，配置metricsPort或metricsFile时对外输出
+        self.metrics = Metrics()
+        self.record_writer = RecordWriter(self.journal, self.metrics)
+        # 进程内所有迁移任务共享的传输缓冲区内存预算，0表示不限制
+        self.memory_budget = None
+        if int(conf.common.memoryBudget) > 0:
+            self.memory_budget = MemoryBudget(int(conf.common.memoryBudget) * BYTES_PER_MB)
+
+    def upgrade_migrate_db(self):
+        '''为旧版本创建的db补充新增的字段和索引；先补充字段，索引可能包含新增的字段'''
+
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            columns = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                sql = 'ALTER TABLE {table} ADD COLUMN {column} {type}'.format(
+                    table=table.name, column=column.name,
+                    type=column.type.compile(dialect=self.engine.dialect))
+                if column.server_default is not None:
+                    sql += " DEFAULT '{default}'".format(default=column.server_default.arg)
+                with self.engine.begin() as conn:
+                    conn.execute(text(sql))
+
+        for table in Base.metadata.sorted_tables:
+            indexes = [i['name'] for i in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(self.engine)
 
     def check_config_file(self, config_path):
         md5_str = get_file_md5(config_path)
@@ -109,8 +377,37 @@ class MigrateManager(object):
         return False
 
     def update_execute_begin_time(self):
-        self.execute_begin_time = datetime.datetime.utcnow().replace(
-            microsecond=0)
+        '''发起迁移的进程记录本次执行的开始时间，需在启动其他工作进程之前调用'''
+
+        self.execute_begin_time = int(time.time())
+        session = Session()
+        try:
+            s = session.query(MigrateStatus).order_by(
+                MigrateStatus.id.desc()).first()
+            if s is not None:
+                s.execute_begin_time = self.execute_begin_time
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    def load_execute_begin_time(self):
+        '''读取发起迁移的进程记录的开始时间；没有记录时（如旧版本db）以当前时间作为开始时间'''
+
+        session = Session()
+        try:
+            s = session.query(MigrateStatus).order_by(
+                MigrateStatus.id.desc()).first()
+            begin_time = s.execute_begin_time if s is not None else None
+        finally:
+            session.close()
+        if not begin_time:
+            self.update_execute_begin_time()
+        else:
+            self.execute_begin_time = begin_time
 
     def get_migrate_record(self, migrate_type, filename):
         session = Session()
@@ -120,48 +417,502 @@ class MigrateManager(object):
 
         return record
 
-    def get_unfinished_migrate_records(self, migrate_type):
+    def get_migrate_records_by_filenames(self, migrate_type, filenames):
+        '''按文件名批量查询已有的迁移记录，返回 {filename: record}'''
+
         session = Session()
         try:
-            records = session.query(MigrateRecord).filter(
-                MigrateRecord.migrate_type == migrate_type).filter(
-                    MigrateRecord.status != MIGRATE_TASK_SUCCESS).filter(
-                        MigrateRecord.update_time < self.execute_begin_time).limit(
-                            MAX_FETCH_NUM).all()
-            return records
+            records = session.query(
+                MigrateRecord.id, MigrateRecord.filename, MigrateRecord.mtime,
+                MigrateRecord.filesize, MigrateRecord.etag).filter(
+                    MigrateRecord.migrate_type == migrate_type).filter(
+                        MigrateRecord.filename.in_(filenames)).all()
+            return dict((r.filename, r) for r in records)
+        finally:
+            session.close()
+
+    def iter_unhashed_records(self, migrate_type):
+        '''按文件大小顺序遍历迁移记录，返回待计算内容hash的记录 (id, filename)：
+        只有存在相同大小的其他文件时才需要计算'''
+
+        session = Session()
+        try:
+            records = session.query(
+                MigrateRecord.id, MigrateRecord.filename, MigrateRecord.filesize,
+                MigrateRecord.content_hash).filter(
+                    MigrateRecord.migrate_type == migrate_type).order_by(
+                        MigrateRecord.filesize).yield_per(DEDUP_PAGE_SIZE)
+
+            group = []
+            for record in records:
+                if len(group) > 0 and record.filesize != group[0].filesize:
+                    if len(group) > 1:
+                        for r in group:
+                            if not r.content_hash:
+                                yield r
+                    group = []
+                group.append(record)
+            if len(group) > 1:
+                for r in group:
+                    if not r.content_hash:
+                        yield r
+        finally:
+            session.close()
+
+    def update_content_hashes(self, hashes):
+        '''批量保存内容hash，hashes为 [(id, content_hash)]'''
+
+        session = Session()
+        try:
+            session.bulk_update_mappings(MigrateRecord, [
+                {'id': record_id, 'content_hash': content_hash}
+                for record_id, content_hash in hashes])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    def copy_etag_to_content_hash(self, migrate_type):
+        '''对象存储的ETag即为内容hash（相同大小时ETag相同即内容相同）'''
+
+        session = Session()
+        try:
+            session.query(MigrateRecord).filter(
+                MigrateRecord.migrate_type == migrate_type,
+                MigrateRecord.etag != '',
+                or_(MigrateRecord.content_hash == None, MigrateRecord.content_hash == '')).update(
+                    {MigrateRecord.content_hash: MigrateRecord.etag}, synchronize_session=False)
+            session.commit()
         except Exception as e:
+            session.rollback()
             logger.error(e)
             raise e
+        finally:
+            session.close()
 
-    def get_migrate_results(self, page_index, page_size):
+    def mark_duplicate_records(self, migrate_type):
+        '''大小和内容hash都相同的文件只迁移一份：已迁移成功的记录优先作为主记录，其次是未失败的记录中id最小的，
+        其余未迁移的记录标记为重复，迁移结束后复用主记录的FileId，返回状态有变化的记录数'''
+
+        session = Session()
         try:
+            records = session.query(
+                MigrateRecord.id, MigrateRecord.filesize, MigrateRecord.content_hash,
+                MigrateRecord.status, MigrateRecord.dup_of).filter(
+                    MigrateRecord.migrate_type == migrate_type,
+                    MigrateRecord.content_hash != None,
+                    MigrateRecord.content_hash != '').order_by(
+                        MigrateRecord.filesize, MigrateRecord.content_hash,
+                        MigrateRecord.status != MIGRATE_TASK_SUCCESS,
+                        MigrateRecord.status == MIGRATE_TASK_FAIL,
+                        MigrateRecord.id).yield_per(DEDUP_PAGE_SIZE)
+
+            mappings = []
+            group_key = None
+            primary_id = None
+            for record in records:
+                key = (record.filesize, record.content_hash)
+                if key != group_key:
+                    group_key = key
+                    primary_id = record.id
+                    # 主记录内容已变化（增量迁移），不再是其他文件的重复
+                    if record.status == MIGRATE_TASK_DUPLICATE:
+                        mappings.append({'id': record.id, 'status': MIGRATE_TASK_INIT,
+                                         'dup_of': 0})
+                    continue
+                if record.status == MIGRATE_TASK_SUCCESS or \
+                        (record.status == MIGRATE_TASK_DUPLICATE and record.dup_of == primary_id):
+                    continue
+                mappings.append({'id': record.id, 'status': MIGRATE_TASK_DUPLICATE,
+                                 'dup_of': primary_id})
+            session.close()
+
             session = Session()
+            for i in range(0, len(mappings), DEDUP_PAGE_SIZE):
+                session.bulk_update_mappings(MigrateRecord, mappings[i:i + DEDUP_PAGE_SIZE])
+            session.commit()
+            return len(mappings)
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    def resolve_duplicate_records(self, migrate_type):
+        '''主记录迁移成功后，重复记录复用其FileId；主记录未完成的重复记录保持不变，下次执行时再处理，
+        主记录最终失败的重复记录由promote_duplicate_records改为主记录重新迁移'''
+
+        session = Session()
+        try:
+            primary = aliased(MigrateRecord)
+            pairs = session.query(
+                MigrateRecord.id, MigrateRecord.filesize, primary.filename, primary.file_id,
+                primary.vod_url).join(
+                    primary, MigrateRecord.dup_of == primary.id).filter(
+                        MigrateRecord.migrate_type == migrate_type,
+                        MigrateRecord.status == MIGRATE_TASK_DUPLICATE,
+                        primary.status == MIGRATE_TASK_SUCCESS).all()
+            mappings = [{
+                'id': pair.id,
+                'status': MIGRATE_TASK_SUCCESS,
+                'file_id': pair.file_id,
+                'vod_url': pair.vod_url,
+                'err_msg': u'duplicate of {filename}'.format(filename=pair.filename)[:256],
+            } for pair in pairs]
+            for i in range(0, len(mappings), DEDUP_PAGE_SIZE):
+                session.bulk_update_mappings(MigrateRecord, mappings[i:i + DEDUP_PAGE_SIZE])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+        self.append_journal([mapping['id'] for mapping in mappings])
+        # 重复记录在复用FileId之前计为未完成
+        with self.lock:
+            self.success_num += len(pairs)
+            self.finished_bytes += sum(pair.filesize or 0 for pair in pairs)
+        return len(mappings)
+
+    def promote_duplicate_records(self, migrate_type):
+        '''主记录最终失败（不可重试或重试次数已用完）时，其id最小的重复记录改为主记录重新迁移，
+        其余重复记录改为该记录的重复，返回改为主记录的记录数'''
+
+        session = Session()
+        try:
+            primary = aliased(MigrateRecord)
+            records = session.query(MigrateRecord.id, MigrateRecord.dup_of).join(
+                primary, MigrateRecord.dup_of == primary.id).filter(
+                    MigrateRecord.migrate_type == migrate_type,
+                    MigrateRecord.status == MIGRATE_TASK_DUPLICATE,
+                    primary.status == MIGRATE_TASK_FAIL,
+                    or_(primary.next_attempt_at == None, primary.next_attempt_at == 0)).order_by(
+                        MigrateRecord.dup_of, MigrateRecord.id).all()
+            new_primary = {}
+            mappings = []
+            for record in records:
+                if record.dup_of not in new_primary:
+                    new_primary[record.dup_of] = record.id
+                    mappings.append({'id': record.id, 'status': MIGRATE_TASK_INIT, 'dup_of': 0})
+                else:
+                    mappings.append({'id': record.id, 'dup_of': new_primary[record.dup_of]})
+            for i in range(0, len(mappings), DEDUP_PAGE_SIZE):
+                session.bulk_update_mappings(MigrateRecord, mappings[i:i + DEDUP_PAGE_SIZE])
+            session.commit()
+            return len(new_primary)
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    def claimable_filter(self, migrate_type, now):
+        '''可领取的迁移记录：未成功，且（本次执行前未处理过且不是不可重试的失败、不在等待重试，
+        或可重试的失败已到重试时间，或租约已过期）'''
+
+        return and_(
+            MigrateRecord.migrate_type == migrate_type,
+            MigrateRecord.status != MIGRATE_TASK_SUCCESS,
+            MigrateRecord.status != MIGRATE_TASK_DUPLICATE,
+            or_(
+                and_(MigrateRecord.status == MIGRATE_TASK_RUNNING,
+                     MigrateRecord.lease_expire < now),
+                and_(MigrateRecord.status == MIGRATE_TASK_FAIL,
+                     MigrateRecord.error_class == MIGRATE_ERROR_RETRYABLE,
+                     MigrateRecord.next_attempt_at > 0,
+                     MigrateRecord.next_attempt_at <= now),
+                and_(MigrateRecord.status != MIGRATE_TASK_RUNNING,
+                     MigrateRecord.claim_time < self.execute_begin_time,
+                     or_(MigrateRecord.error_class == None,
+                         MigrateRecord.error_class != MIGRATE_ERROR_PERMANENT),
+                     # 等待重试的失败记录只按重试时间领取，保证退避及尝试次数上限对所有工作进程生效
+                     or_(MigrateRecord.status != MIGRATE_TASK_FAIL,
+                         MigrateRecord.error_class == None,
+                         MigrateRecord.error_class != MIGRATE_ERROR_RETRYABLE,
+                         MigrateRecord.next_attempt_at == 0))))
+
+    def claim_migrate_records(self, migrate_type, owner, limit, lease_seconds, order_by=None):
+        '''以租约方式领取迁移记录，多个进程共享同一个db时，同一条记录同一时刻只会被一个进程领取；
+        order_by指定领取顺序（如按文件大小），为空时按db默认顺序'''
+
+        session = Session()
+        try:
+            now = int(time.time())
+            query = session.query(MigrateRecord.id).filter(
+                self.claimable_filter(migrate_type, now))
+            if order_by is not None:
+                query = query.order_by(order_by)
+            ids = [r.id for r in query.limit(limit)]
+            if len(ids) == 0:
+                return []
+
+            # 条件更新保证原子性：记录已被其他进程领取时，更新不会生效
+            lease_expire = now + lease_seconds
+            session.query(MigrateRecord).filter(
+                MigrateRecord.id.in_(ids)).filter(
+                    self.claimable_filter(migrate_type, now)).update(
+                        {
+                            MigrateRecord.owner: owner,
+                            MigrateRecord.lease_expire: lease_expire,
+                            MigrateRecord.claim_time: now,
+                            MigrateRecord.status: MIGRATE_TASK_RUNNING
+                        }, synchronize_session=False)
+            session.commit()
+
             records = session.query(MigrateRecord).filter(
-                MigrateRecord.migrate_type == self.conf.migrateType.type).limit(
-                    page_size).offset(page_index * page_size)
+                MigrateRecord.id.in_(ids)).filter(
+                    MigrateRecord.owner == owner).filter(
+                        MigrateRecord.status == MIGRATE_TASK_RUNNING).filter(
+                            MigrateRecord.lease_expire == lease_expire).all()
+            # 保持领取时的顺序
+            positions = dict((record_id, i) for i, record_id in enumerate(ids))
+            records.sort(key=lambda record: positions[record.id])
+            return records
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
 
+    def add_claimed_migrate_records(self, records, owner, lease_seconds):
+        '''保存新发现的迁移记录并直接由当前进程领取（新记录插入，已有记录按主键更新）'''
+
+        session = Session(expire_on_commit=False)
+        try:
+            now = int(time.time())
+            lease_expire = now + lease_seconds
+            new_records = []
+            for record in records:
+                record.status = MIGRATE_TASK_RUNNING
+                record.owner = owner
+                record.lease_expire = lease_expire
+                record.claim_time = now
+                record.file_id = ""
+                record.vod_url = ""
+                record.err_msg = ""
+                record.content_hash = ""
+                record.dup_of = 0
+                record.attempts = 0
+                record.error_class = ""
+                record.next_attempt_at = 0
+                if record.id is None:
+                    session.add(record)
+                    new_records.append(record)
+                    continue
+                mapping = dict(
+                    (getattr(MigrateRecord, field), getattr(record, field))
+                    for field in RECORD_UPDATE_FIELDS + ["owner", "lease_expire", "claim_time"])
+                session.query(MigrateRecord).filter(
+                    MigrateRecord.id == record.id).update(
+                        mapping, synchronize_session=False)
+            session.commit()
+            for record in new_records:
+                session.expunge(record)
+
+            with self.lock:
+                self.total_num += len(records)
             return records
         except Exception as e:
+            session.rollback()
             logger.error(e)
             raise e
+        finally:
+            session.close()
+
+    def renew_migrate_leases(self, owner, ids, lease_seconds):
+        '''续约当前进程持有的迁移记录'''
+
+        session = Session()
+        try:
+            lease_expire = int(time.time()) + lease_seconds
+            for i in range(0, len(ids), MAX_LEASE_RENEW_NUM):
+                session.query(MigrateRecord).filter(
+                    MigrateRecord.id.in_(ids[i:i + MAX_LEASE_RENEW_NUM])).filter(
+                        MigrateRecord.owner == owner).filter(
+                            MigrateRecord.status == MIGRATE_TASK_RUNNING).update(
+                                {MigrateRecord.lease_expire: lease_expire},
+                                synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+        finally:
+            session.close()
+
+    def count_leased_migrate_records(self, migrate_type):
+        '''统计租约仍然有效（其他进程正在迁移）的记录数'''
+
+        session = Session()
+        try:
+            return session.query(MigrateRecord).filter(
+                MigrateRecord.migrate_type == migrate_type).filter(
+                    MigrateRecord.status == MIGRATE_TASK_RUNNING).filter(
+                        MigrateRecord.lease_expire >= int(time.time())).count()
+        finally:
+            session.close()
+
+    def get_next_retry_time(self, migrate_type):
+        '''等待重试的失败记录中最早的重试时间，没有时返回None'''
+
+        session = Session()
+        try:
+            return session.query(func.min(MigrateRecord.next_attempt_at)).filter(
+                MigrateRecord.migrate_type == migrate_type).filter(
+                    MigrateRecord.status == MIGRATE_TASK_FAIL).filter(
+                        MigrateRecord.error_class == MIGRATE_ERROR_RETRYABLE).filter(
+                            MigrateRecord.next_attempt_at > 0).scalar()
+        finally:
+            session.close()
+
+    def reset_library_media(self):
+        '''清空vod媒体索引，重新拉取'''
+
+        session = Session()
+        try:
+            session.query(LibraryMedia).delete()
+            session.commit()
+        finally:
+            session.close()
+
+    def add_library_media(self, mappings):
+        session = Session()
+        try:
+            session.bulk_insert_mappings(LibraryMedia, mappings)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    def get_unmigrated_records(self, migrate_type, last_id, limit):
+        '''按id分页查询尚未迁移成功的记录'''
+
+        session = Session()
+        try:
+            return session.query(
+                MigrateRecord.id, MigrateRecord.filename, MigrateRecord.filesize).filter(
+                    MigrateRecord.migrate_type == migrate_type,
+                    MigrateRecord.id > last_id,
+                    MigrateRecord.status.notin_([MIGRATE_TASK_SUCCESS, MIGRATE_TASK_DUPLICATE])).order_by(
+                        MigrateRecord.id).limit(limit).all()
+        finally:
+            session.close()
+
+    def find_library_media_by_storage_paths(self, storage_paths):
+        '''返回 {storage_path: media}'''
+
+        session = Session()
+        try:
+            media_set = session.query(
+                LibraryMedia.storage_path, LibraryMedia.file_id, LibraryMedia.media_url).filter(
+                    LibraryMedia.storage_path.in_(storage_paths)).all()
+            return dict((m.storage_path, m) for m in media_set)
+        finally:
+            session.close()
+
+    def find_library_media_by_names(self, names):
+        '''返回 {(name, size): media}'''
+
+        session = Session()
+        try:
+            media_set = session.query(
+                LibraryMedia.name, LibraryMedia.size, LibraryMedia.file_id,
+                LibraryMedia.media_url).filter(LibraryMedia.name.in_(names)).all()
+            return dict(((m.name, m.size), m) for m in media_set)
+        finally:
+            session.close()
+
+    def mark_records_existing(self, mappings):
+        '''将vod中已存在的文件标记为迁移成功，mappings为 [{id, file_id, vod_url}]'''
+
+        session = Session()
+        try:
+            for mapping in mappings:
+                mapping['status'] = MIGRATE_TASK_SUCCESS
+                mapping['err_msg'] = 'already exists in vod'
+            session.bulk_update_mappings(MigrateRecord, mappings)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+        self.append_journal([mapping['id'] for mapping in mappings])
+
+    def append_journal(self, ids):
+        '''不经过写入线程批量更新的记录，更新后将结果追加到结果日志'''
+
+        now = time.time()
+        for i in range(0, len(ids), MAX_FETCH_NUM):
+            session = Session()
+            try:
+                records = session.query(MigrateRecord).filter(
+                    MigrateRecord.id.in_(ids[i:i + MAX_FETCH_NUM])).all()
+                self.record_writer.append_journal(
+                    [(now, build_result(record, format_time(now))) for record in records])
+            finally:
+                session.close()
+
+    def get_migrate_results(self, last_id, page_size):
+        '''按id分页查询迁移记录'''
 
-    def save_migrate_record(self, record):
         session = Session()
-        r = session.query(MigrateRecord).filter(
-            MigrateRecord.migrate_type == record.migrate_type).filter(
-                MigrateRecord.filename == record.filename).first()
-        if r is not None:
-            r.mtime = record.mtime
-            r.filesize = record.filesize
-            r.etag = record.etag
-            r.file_id = record.file_id
-            r.vod_url = record.vod_url
-            r.status = record.status
-            r.err_msg = record.err_msg
+        try:
+            return session.query(MigrateRecord).filter(
+                MigrateRecord.migrate_type == self.conf.migrateType.type).filter(
+                    MigrateRecord.id > last_id).order_by(MigrateRecord.id).limit(page_size).all()
+        except Exception as e:
+            logger.error(e)
+            raise e
+        finally:
+            session.close()
+
+    @timed(SPAN_SAVE_RECORD)
+    def save_migrate_record(self, record):
+        '''保存迁移记录：新记录插入，已有记录按主键更新；由写入线程异步批量提交'''
+
+        if record.id is None:
+            self.record_writer.insert(record)
         else:
-            session.add(record)
+            self.record_writer.update(record)
 
-        session.commit()
+    def flush_migrate_records(self):
+        '''等待已保存的迁移记录全部写入db'''
+
+        self.record_writer.flush()
+
+    def check_migrate_records(self):
+        '''迁移记录写入失败（重试后仍失败，记录状态已丢失）时抛出错误'''
+
+        self.record_writer.check()
+
+    def save_listing_cursor(self, cursor):
+        '''保存首次扫描的列举位置，在此之前保存的迁移记录写入db时一起提交'''
+
+        self.record_writer.save_cursor(json.dumps(cursor))
+
+    def get_listing_cursor(self):
+        '''首次扫描被中断时，返回最后保存的列举位置，否则返回None'''
+
+        session = Session()
+        try:
+            s = session.query(MigrateStatus).order_by(
+                MigrateStatus.id.desc()).first()
+            if s is None or s.status != MIGRATE_INIT or not s.list_cursor:
+                return None
+            return json.loads(s.list_cursor)
+        finally:
+            session.close()
 
     def init_migrate_status(self, config_path):
         session = Session()
@@ -200,56 +951,48 @@ class MigrateManager(object):
 
         Base.metadata.drop_all(self.engine)
         Base.metadata.create_all(self.engine, checkfirst=True)
+        self.journal.clear()
+
+    def get_result_file(self):
+        name = MIGRATE_RESULT_FILE
+        if self.conf.common.resultFormat == RESULT_FORMAT_CSV:
+            name = os.path.splitext(name)[0] + ".csv"
+        if self.conf.common.resultCompress:
+            name += ".gz"
+        return os.path.join(self.conf.common.migrateResultOutputPath, name)
 
     def output_migrate_results(self):
-        '''输出迁移结果'''
+        '''输出迁移结果：优先合并结果日志；日志不完整（如旧版本db、存在未完成的记录）时从db全量导出'''
 
         if self.total_num == 0:
             return
 
-        page_count = int(self.total_num / MAX_FETCH_NUM)
-        page_index = 0
+        self.flush_migrate_records()
+        result_file = self.get_result_file()
+        result_format = self.conf.common.resultFormat
+        compress = self.conf.common.resultCompress
+        try:
+            session = Session()
+            try:
+                record_num = session.query(MigrateRecord).filter(
+                    MigrateRecord.migrate_type == self.conf.migrateType.type).count()
+            finally:
+                session.close()
 
-        result_file = os.path.join(self.conf.common.migrateResultOutputPath,
-                                   MIGRATE_RESULT_FILE)
+            if not self.journal.compact(result_file, result_format, compress, record_num):
+                output = ResultOutput(result_file, result_format, compress)
+                last_id = 0
+                while True:
+                    records = self.get_migrate_results(last_id, MAX_FETCH_NUM)
+                    if len(records) == 0:
+                        break
+                    last_id = records[-1].id
+                    for record in records:
+                        output.write_result(build_result(
+                            record, record.update_time.replace(tzinfo=utctimezone).astimezone(
+                                localtimezone).strftime("%Y-%m-%d %H:%M:%S")))
+                output.close()
 
-        try:
-            if PY3:
-                f = open(file=result_file, mode='w', encoding='utf-8')
-            else:
-                f = open(name=result_file, mode='w')
-
-            while page_index <= page_count:
-                results = self.get_migrate_results(page_index, MAX_FETCH_NUM)
-                page_index += 1
-
-                lines = []
-                for record in results:
-                    result = {}
-                    result['id'] = record.id
-                    result['migrateType'] = record.migrate_type
-                    result['filename'] = record.filename
-                    result['lastModified'] = record.mtime
-                    result['filesize'] = record.filesize
-                    result['etag'] = record.etag
-                    result['fileId'] = record.file_id
-                    result['mediaUrl'] = record.vod_url
-                    result['status'] = record.status
-                    result['errMsg'] = record.err_msg
-                    result['updateTime'] = record.update_time.replace(
-                        tzinfo=utctimezone).astimezone(localtimezone).strftime(
-                            "%Y-%m-%d %H:%M:%S")
-                    line = json.dumps(result, ensure_ascii=False) + '\n'
-                    if PY2:
-                        if not isinstance(line, text_type):
-                            line = line.decode(fs_coding)
-                        line = line.encode('utf-8')
-                    lines.append(line)
-
-                f.writelines(lines)
-                f.flush()
-
-            f.close()
             logger.info("migrate result: {file}".format(file=result_file))
         except Exception as e:
             logger.error(e)
@@ -257,28 +1000,96 @@ class MigrateManager(object):
 
     def init_counter(self):
         session = Session()
-        self.total_num = session.query(MigrateRecord).filter(
-            MigrateRecord.migrate_type == self.conf.migrateType.type).count()
-        self.success_num = session.query(MigrateRecord).filter(
-            MigrateRecord.migrate_type == self.conf.migrateType.type).filter(
-                MigrateRecord.status == MIGRATE_TASK_SUCCESS).count()
+        migrate_type_filter = MigrateRecord.migrate_type == self.conf.migrateType.type
+        # 重复文件在复用主记录的FileId之后才计入成功
+        success_filter = MigrateRecord.status == MIGRATE_TASK_SUCCESS
+        # 不可重试的失败不再迁移，直接计入失败
+        fail_filter = and_(MigrateRecord.status == MIGRATE_TASK_FAIL,
+                           MigrateRecord.error_class == MIGRATE_ERROR_PERMANENT)
+        try:
+            self.total_num = session.query(MigrateRecord).filter(migrate_type_filter).count()
+            self.success_num = session.query(MigrateRecord).filter(
+                migrate_type_filter).filter(success_filter).count()
+            self.fail_num = session.query(MigrateRecord).filter(
+                migrate_type_filter).filter(fail_filter).count()
+            # Url列表迁移前不知道文件大小，按已知大小的文件的平均值估算
+            sized_num, sized_bytes = session.query(
+                func.count(MigrateRecord.filesize), func.sum(MigrateRecord.filesize)).filter(
+                    migrate_type_filter).one()
+            self.finished_bytes = session.query(func.sum(MigrateRecord.filesize)).filter(
+                migrate_type_filter).filter(or_(success_filter, fail_filter)).scalar() or 0
+        finally:
+            session.close()
 
-    def increse_counter(self, isSuccess):
+        self.total_bytes = int(sized_bytes or 0)
+        self.finished_bytes = int(self.finished_bytes)
+        self.size_estimated = sized_num < self.total_num
+        if self.size_estimated and sized_num > 0:
+            self.total_bytes += (self.total_num - sized_num) * self.total_bytes // sized_num
+        self.byte_rate = EwmaRate(self.progress_meter.transferred)
+        self.file_rate = EwmaRate(self.success_num + self.fail_num)
+        self.last_progress_time = 0
+        self.last_progress = None
+
+    def increse_counter(self, isSuccess, size=0):
         self.lock.acquire()
         if isSuccess:
             self.success_num += 1
         else:
             self.fail_num += 1
+        self.finished_bytes += size or 0
         self.lock.release()
 
-    def output_migrate_progress(self):
-        if self.total_num > 0:
-            percent = '{:.2%}'.format(
-                (self.success_num + self.fail_num) / float(self.total_num))
-            logger.info(
-                u"当前迁移进度：{per}, 总量：{total_num}, 成功数：{success_num}, 失败数：{fail_num}"
-                .format(
-                    per=percent,
-                    total_num=self.total_num,
-                    success_num=self.success_num,
-                    fail_num=self.fail_num))
+    def output_migrate_progress(self, force=False):
+        '''输出迁移进度：按字节计算完成比例，按指数加权平均的吞吐量估算剩余时间；
+        每progressInterval秒最多输出一次，force为True时不受间隔限制；进度没有变化时不输出'''
+
+        now = time.time()
+        if self.total_num <= 0:
+            return
+        with self.lock:
+            if not force and now - self.last_progress_time < float(self.conf.common.progressInterval):
+                return
+            finished_num = self.success_num + self.fail_num
+            state = (finished_num, self.progress_meter.transferred)
+            if state == self.last_progress:
+                return
+            self.last_progress_time = now
+            self.last_progress = state
+            byte_rate = self.byte_rate.update(self.progress_meter.transferred, now)
+            file_rate = self.file_rate.update(finished_num, now)
+            finished_bytes = self.finished_bytes
+
+        file_percent = finished_num / float(self.total_num)
+        if self.total_bytes > 0:
+            percent = min(finished_bytes / float(self.total_bytes), 1.0)
+            if finished_num >= self.total_num:
+                percent = 1.0
+            progress = u"当前迁移进度：{per:.2%}（按{estimated}字节，文件数 {file_per:.2%}）".format(
+                per=percent, file_per=file_percent,
+                estimated=u"估算" if self.size_estimated else u"")
+            total = u"{num}（{size}）".format(num=self.total_num, size=format_size(self.total_bytes))
+        else:
+            progress = u"当前迁移进度：{per:.2%}".format(per=file_percent)
+            total = self.total_num
+        progress += u", 总量：{total}, 成功数：{success_num}, 失败数：{fail_num}".format(
+            total=total,
+            success_num=self.success_num,
+            fail_num=self.fail_num)
+
+        if byte_rate is not None:
+            progress += u", 速度：{speed:.1f}MB/s".format(speed=byte_rate / float(BYTES_PER_MB))
+            # 有文件大小时按剩余字节数估算，否则按剩余文件数估算
+            eta = None
+            if self.total_bytes > 0 and byte_rate > 0:
+                eta = max(self.total_bytes - finished_bytes, 0) / byte_rate
+            elif self.total_bytes == 0 and file_rate:
+                eta = (self.total_num - finished_num) / file_rate
+            if eta is not None and finished_num < self.total_num:
+                progress += u", 预计剩余时间：{eta}".format(eta=format_duration(eta))
+        if self.memory_budget is not None:
+            progress += u", 缓冲内存：{used:.1f}/{limit:.0f}MB（峰值 {peak:.1f}MB）".format(
+                used=self.memory_budget.used / float(BYTES_PER_MB),
+                limit=self.memory_budget.limit / float(BYTES_PER_MB),
+                peak=self.memory_budget.peak / float(BYTES_PER_MB))
+        logger.info(progress)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from six.moves import BaseHTTPServer
+
+logger = logging.getLogger("cmd")
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 各阶段耗时直方图的分桶（秒），传输大文件可能需要数十分钟
+STAGE_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+STAGE_APPLY_UPLOAD = "apply_upload"
+STAGE_SOURCE_OPEN = "source_open"
+STAGE_PUT = "put"
+STAGE_VERIFY = "verify"
+STAGE_COMMIT_UPLOAD = "commit_upload"
+STAGE_DB_WRITE = "db_write"
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(
+        name=name, value=escape_label_value(u'{0}'.format(value))) for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    '''指标基类：按标签值分别记录，标签值顺序与labelnames一致'''
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames, lock):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = lock
+        self.values = {}
+
+    def render(self, const_labels):
+        lines = ['# HELP {name} {doc}'.format(name=self.name, doc=self.documentation),
+                 '# TYPE {name} {type}'.format(name=self.name, type=self.metric_type)]
+        names = tuple(const_labels.keys()) + self.labelnames
+        for labels, value in sorted(self.values.items()):
+            lines.extend(self.render_samples(names, tuple(const_labels.values()) + labels, value))
+        return lines
+
+    def render_samples(self, names, labels, value):
+        return ['{name}{labels} {value}'.format(
+            name=self.name, labels=format_labels(names, labels), value=format_value(value))]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, lock, buckets):
+        super(Histogram, self).__init__(name, documentation, labelnames, lock)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            # [各分桶的计数, 总和]，输出时再累加为Prometheus的累计分桶
+            state = self.values.setdefault(labels, [[0] * len(self.buckets), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+
+    def render_samples(self, names, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('{name}_bucket{labels} {value}'.format(
+                name=self.name, labels=format_labels(names + ('le',), labels + (format_value(float(bound)),)),
+                value=cumulative))
+        lines.append('{name}_sum{labels} {value}'.format(
+            name=self.name, labels=format_labels(names, labels), value=format_value(total)))
+        lines.append('{name}_count{labels} {value}'.format(
+            name=self.name, labels=format_labels(names, labels), value=cumulative))
+        return lines
+
+
+class Metrics(object):
+    '''迁移进程的运行指标，以Prometheus文本格式输出
+
+    计数类指标在迁移过程中直接累加；在途任务数、队列长度等瞬时值由注册的collector在输出前刷新'''
+
+    def __init__(self, const_labels=None):
+        self.lock = threading.Lock()
+        self.const_labels = dict(const_labels or {})
+        self.metrics = []
+        self.collectors = []
+        self.files = self.add(Counter(
+            'vod_migrate_files_total', 'Files finished, by source and status.',
+            ('source', 'status'), self.lock))
+        self.bytes = self.add(Counter(
+            'vod_migrate_bytes_total', 'Bytes of successfully migrated files, by source.',
+            ('source',), self.lock))
+        self.retries = self.add(Counter(
+            'vod_migrate_retries_total', 'Failed attempts scheduled for retry, by source.',
+            ('source',), self.lock))
+        self.errors = self.add(Counter(
+            'vod_migrate_errors_total', 'Failed attempts, by source, error class and error code.',
+            ('source', 'error_class', 'code'), self.lock))
+        self.stage_seconds = self.add(Histogram(
+            'vod_migrate_stage_duration_seconds',
+            'Latency of each step: apply_upload, source_open (until the source responds), '
+            'put (reading the source and uploading to cos), verify, commit_upload and db_write (one batch).',
+            ('stage',), self.lock, STAGE_SECONDS_BUCKETS))
+        self.in_flight = self.add(Gauge(
+            'vod_migrate_in_flight_tasks', 'Tasks submitted to the pipeline and not finished yet.',
+            (), self.lock))
+        self.queue_depth = self.add(Gauge(
+            'vod_migrate_queue_depth', 'Tasks waiting in front of each pipeline stage.',
+            ('stage',), self.lock))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        '''注册输出前调用的函数，用于刷新瞬时值'''
+
+        self.collectors.append(collector)
+
+    def observe_stage(self, stage, start_time):
+        self.stage_seconds.observe(time.time() - start_time, (stage,))
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error("collect metrics failed: {error}".format(error=e))
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.extend(metric.render(self.const_labels))
+        return u'\n'.join(lines) + u'\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in (METRICS_PATH, '/'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter(object):
+    '''在本地http端口（/metrics）提供指标，和/或定期重写指标文件（可供node_exporter textfile采集）'''
+
+    def __init__(self, metrics, address='', port=0, path='', interval=15):
+        self.metrics = metrics
+        self.address = address
+        self.port = int(port)
+        self.path = path
+        self.interval = float(interval)
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.port > 0:
+            try:
+                self.server = BaseHTTPServer.HTTPServer((self.address, self.port), MetricsHandler)
+            except Exception as e:
+                # 端口被占用时不影响迁移
+                logger.error("metrics endpoint {address}:{port} failed: {error}".format(
+                    address=self.address, port=self.port, error=e))
+            else:
+                self.server.metrics = self.metrics
+                self.start_thread(self.server.serve_forever)
+                logger.info("metrics endpoint: http://{address}:{port}{path}".format(
+                    address=self.address or '0.0.0.0', port=self.port, path=METRICS_PATH))
+        if self.path:
+            self.start_thread(self.write_periodically)
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write_file()
+
+    def write_file(self):
+        '''先写临时文件再改名，采集方不会读到写了一半的文件'''
+
+        tmp_path = '{path}.{pid}.tmp'.format(path=self.path, pid=os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self.metrics.render().encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            logger.error("write metrics file {path} failed: {error}".format(path=self.path, error=e))
+
+    def stop(self):
+        '''停止输出，指标文件写入最终结果'''
+
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path:
+            self.write_file()
+
+
+def get_worker_metrics_file(path, index):
+    '''同一台机器上的多个工作进程分别写入各自的指标文件：metrics.prom -> metrics.1.prom'''
+
+    if not path or index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{root}.{index}{ext}'.format(root=root, index=index, ext=ext)
+
+
+def start_metrics_exporter(metrics, conf, index=0):
+    '''按配置启动指标输出，未配置metricsPort和metricsFile时返回None；
+    第index个工作进程使用metricsPort + index端口，指标带有worker标签'''
+
+    port = int(conf.common.metricsPort)
+    path = conf.common.metricsFile
+    if port <= 0 and not path:
+        return None
+    metrics.const_labels['worker'] = str(index)
+    exporter = MetricsExporter(
+        metrics, conf.common.metricsAddress, port + index if port > 0 else 0,
+        get_worker_metrics_file(path, index), conf.common.metricsInterval)
+    exporter.start()
+    return exporter
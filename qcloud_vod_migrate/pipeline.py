@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from concurrent.futures import Future
+from six.moves import queue
+
+logger = logging.getLogger("cmd")
+
+
+class PipelineJob(object):
+    '''流水线中的一个任务：failed为True时跳过中间阶段，直接进入最后一个阶段'''
+
+    __slots__ = ('item', 'future', 'failed')
+
+    def __init__(self, item):
+        self.item = item
+        self.future = Future()
+        self.failed = False
+
+
+class Stage(object):
+    '''流水线的一个阶段：concurrency个工作线程从队列中取出任务执行'''
+
+    def __init__(self, name, func, concurrency, maxsize=0):
+        self.name = name
+        self.func = func
+        self.concurrency = max(1, int(concurrency))
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.threads = []
+
+
+class Pipeline(object):
+    '''分阶段执行任务，每个阶段有独立的线程数，阶段之间通过有界队列连接
+
+    stages为 [(name, func, concurrency)]，任务依次经过各阶段的func(item)；
+    某个阶段抛出异常时调用on_error(item, error)，任务跳过其余阶段直接进入最后一个阶段，
+    因此最后一个阶段（保存结果）对每个任务都会执行。
+    下游阶段的队列已满时上游线程阻塞在入队上，不会提前占用下游的资源（如提前申请上传）；
+    第一个阶段的队列不限长度，由调用方通过capacity控制在途任务数'''
+
+    def __init__(self, stages, on_error):
+        self.on_error = on_error
+        self.stages = []
+        for i, (name, func, concurrency) in enumerate(stages):
+            maxsize = 0 if i == 0 else max(1, int(concurrency))
+            self.stages.append(Stage(name, func, concurrency, maxsize))
+        # 每个阶段最多有concurrency个任务在执行、concurrency个任务在排队
+        self.capacity = sum(stage.concurrency * 2 for stage in self.stages)
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.concurrency):
+                thread = threading.Thread(target=self.worker, args=(i,))
+                thread.daemon = True
+                thread.start()
+                stage.threads.append(thread)
+
+    def submit(self, item):
+        '''提交任务，返回Future，最后一个阶段执行完后完成'''
+
+        job = PipelineJob(item)
+        self.stages[0].jobs.put(job)
+        return job.future
+
+    def worker(self, index):
+        stage = self.stages[index]
+        last = len(self.stages) - 1
+        while True:
+            job = stage.jobs.get()
+            if job is None:
+                return
+
+            if index == last:
+                try:
+                    job.future.set_result(stage.func(job.item))
+                except Exception as e:
+                    logger.error(e)
+                    job.future.set_exception(e)
+                continue
+
+            try:
+                stage.func(job.item)
+            except Exception as e:
+                job.failed = True
+                try:
+                    self.on_error(job.item, e)
+                except Exception as error:
+                    logger.error(error)
+            next_stage = self.stages[last if job.failed else index + 1]
+            next_stage.jobs.put(job)
+
+    def queue_depths(self):
+        '''各阶段排队中的任务数'''
+
+        return [(stage.name, stage.jobs.qsize()) for stage in self.stages]
+
+    def shutdown(self, cancel=False):
+        '''等待已提交的任务执行完，停止所有线程；cancel为True时丢弃尚未开始执行的任务'''
+
+        for stage in self.stages:
+            if cancel:
+                self.drain(stage)
+            for _ in stage.threads:
+                stage.jobs.put(None)
+            for thread in stage.threads:
+                thread.join()
+
+    @staticmethod
+    def drain(stage):
+        while True:
+            try:
+                job = stage.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                job.future.cancel()
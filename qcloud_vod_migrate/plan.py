@@ -0,0 +1,279 @@
+# -*- coding:utf-8 -*-
+'''迁移规划：扫描存储源并按配置过滤，不写入迁移db、不上传，统计需要迁移的文件数和字节数；
+可选抽样读取部分源文件测量读取速度，估算整体迁移耗时'''
+
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL, MIGRATE_FROM_URLLIST
+from qcloud_vod_migrate.execute import close_body
+from qcloud_vod_migrate.filter import MediaFilter, get_file_type, media_classification_config
+from qcloud_vod_migrate.limiter import TransferStream, BYTES_PER_MBIT
+from qcloud_vod_migrate.progress import format_size, format_duration
+from qcloud_vod_migrate.source import get_source
+from qcloud_vod_migrate.util import to_printable_str
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+logger = logging.getLogger("cmd")
+
+# 按扩展名、前缀统计时输出字节数最多的前若干项，其余合并为一项
+PLAN_TOP_NUM = 20
+OTHERS = "(others)"
+NO_PREFIX = "(root)"
+NO_EXTENSION = "(none)"
+OTHER_CLASS = "other"
+
+
+class PlanGroup(object):
+    '''一个统计分组的文件数和字节数，大小未知的文件（Url列表）只计入文件数'''
+
+    __slots__ = ("files", "bytes", "unknown_size_files")
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.unknown_size_files = 0
+
+    def add(self, size, files=1):
+        self.files += files
+        if size is None:
+            self.unknown_size_files += files
+        else:
+            self.bytes += size
+
+    def to_dict(self):
+        return OrderedDict([
+            ("files", self.files), ("bytes", self.bytes), ("unknown_size_files", self.unknown_size_files)])
+
+
+def top_groups(groups, num=PLAN_TOP_NUM):
+    '''按字节数（相同时按文件数）排序，超过num项时合并其余项'''
+
+    items = sorted(groups.items(), key=lambda item: (item[1].bytes, item[1].files), reverse=True)
+    if len(items) <= num:
+        return items
+    others = PlanGroup()
+    for _, group in items[num:]:
+        others.bytes += group.bytes
+        others.files += group.files
+        others.unknown_size_files += group.unknown_size_files
+    return items[:num] + [(OTHERS, others)]
+
+
+class MigratePlanner(object):
+    '''扫描存储源生成迁移规划；sample_num大于0时在扫描中随机抽取文件（蓄水池抽样），
+    按迁移并发数读取这些文件（不上传）测量单个数据流的读取速度及打开文件的耗时'''
+
+    def __init__(self, conf, sample_num=0):
+        self.conf = conf
+        self.migrate_type = conf.migrateType.type
+        self.source = get_source(conf)
+        self.media_filter = MediaFilter(conf)
+        self.sample_num = sample_num
+        self.samples = []
+        self.random = random.Random()
+
+        self.media_classes = {}
+        for classification in media_classification_config:
+            for media_type in classification["mediaTypeList"]:
+                self.media_classes[media_type] = classification["class"]
+
+        # 按前缀统计时，去掉配置的源路径，取其下的第一级目录
+        self.sep = "/"
+        self.root = ""
+        if self.migrate_type == MIGRATE_FROM_LOCAL:
+            self.sep = os.sep
+            self.root = conf.migrateLocal.localPath
+        elif self.migrate_type != MIGRATE_FROM_URLLIST:
+            self.root = getattr(conf, self.migrate_type).prefix or ""
+
+        self.total = PlanGroup()
+        self.by_class = {}
+        self.by_extension = {}
+        self.by_prefix = {}
+        self.scan_seconds = 0
+        self.sample_result = None
+
+    def get_prefix(self, obj):
+        '''Url列表按域名统计，其他迁移类型按源路径下的第一级目录统计'''
+
+        if self.migrate_type == MIGRATE_FROM_URLLIST:
+            return urlparse(obj.key).netloc
+        name = obj.key
+        if name.startswith(self.root):
+            name = name[len(self.root):]
+        name = name.lstrip(self.sep)
+        sep_index = name.find(self.sep)
+        if sep_index < 0:
+            return NO_PREFIX
+        return name[:sep_index]
+
+    def add(self, obj):
+        file_type = get_file_type(obj.filter_name)
+        self.total.add(obj.size)
+        for groups, name in ((self.by_class, self.media_classes.get(file_type, OTHER_CLASS)),
+                             (self.by_extension, file_type or NO_EXTENSION),
+                             (self.by_prefix, self.get_prefix(obj))):
+            group = groups.get(name)
+            if group is None:
+                group = groups[name] = PlanGroup()
+            group.add(obj.size)
+
+        if self.sample_num <= 0:
+            return
+        if len(self.samples) < self.sample_num:
+            self.samples.append(obj)
+        else:
+            index = self.random.randint(0, self.total.files - 1)
+            if index < self.sample_num:
+                self.samples[index] = obj
+
+    def scan(self):
+        '''与迁移时相同的扫描和过滤，只统计不入库'''
+
+        start_time = time.time()
+        for page in self.source.list_pages():
+            for obj in page:
+                try:
+                    if self.media_filter.check(obj.filter_name, obj.size, obj.mtime, check_excludes=False):
+                        self.add(obj)
+                except UnicodeEncodeError as e:
+                    logger.error("{file} scan failed: {error}".format(file=repr(obj.key)[1:-1], error=e))
+        self.scan_seconds = time.time() - start_time
+
+    def read_sample(self, obj):
+        '''读取一个源文件并丢弃数据，返回 (打开耗时, 读取耗时, 字节数)'''
+
+        start_time = time.time()
+        body, _ = self.source.open_stream(obj.key)
+        open_seconds = time.time() - start_time
+        size = 0
+        try:
+            start_time = time.time()
+            for chunk in TransferStream(body):
+                size += len(chunk)
+            return open_seconds, time.time() - start_time, size
+        finally:
+            close_body(body)
+
+    def sample_transfer(self):
+        if len(self.samples) == 0:
+            return
+        concurrency = min(int(self.conf.common.concurrency), len(self.samples))
+        logger.info("sampled transfer: reading {num} files with concurrency {concurrency}".format(
+            num=len(self.samples), concurrency=concurrency))
+
+        results = []
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [(obj, executor.submit(self.read_sample, obj)) for obj in self.samples]
+            for obj, future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logger.error("{file} sampled transfer failed: {error}".format(
+                        file=to_printable_str(obj.key), error=e))
+        seconds = time.time() - start_time
+        if len(results) == 0:
+            return
+
+        read_seconds = sum(r[1] for r in results)
+        sample_bytes = sum(r[2] for r in results)
+        self.sample_result = OrderedDict([
+            ("files", len(results)),
+            ("failed_files", len(self.samples) - len(results)),
+            ("bytes", sample_bytes),
+            ("seconds", seconds),
+            ("concurrency", concurrency),
+            ("open_seconds_avg", sum(r[0] for r in results) / len(results)),
+            ("stream_bytes_per_second", sample_bytes / read_seconds if read_seconds > 0 else 0),
+        ])
+
+    def estimate(self):
+        '''按抽样结果估算耗时：每个文件的打开耗时加上按单流速度读取的耗时，由迁移并发数分摊；
+        配置了带宽限制时不低于按限速传输的耗时。大小未知的文件按抽样文件的平均大小估算'''
+
+        if self.sample_result is None:
+            return None
+        total_bytes = self.total.bytes
+        if self.total.unknown_size_files > 0:
+            total_bytes += self.total.unknown_size_files * self.sample_result["bytes"] // self.sample_result["files"]
+        concurrency = int(self.conf.common.concurrency)
+        stream_rate = self.sample_result["stream_bytes_per_second"]
+        seconds = self.total.files * self.sample_result["open_seconds_avg"]
+        if stream_rate > 0:
+            seconds += total_bytes / stream_rate
+        seconds /= concurrency
+        bandwidth_limit = float(self.conf.common.bandwidthLimit) * BYTES_PER_MBIT
+        if bandwidth_limit > 0:
+            seconds = max(seconds, total_bytes / bandwidth_limit)
+        return OrderedDict([
+            ("bytes", total_bytes), ("concurrency", concurrency), ("seconds", seconds),
+            ("bytes_per_second", total_bytes / seconds if seconds > 0 else 0)])
+
+    def log_groups(self, title, groups):
+        logger.info("by {title}:".format(title=title))
+        for name, group in top_groups(groups):
+            line = "  {name}: {files} files, {size}".format(
+                name=to_printable_str(name), files=group.files, size=format_size(group.bytes))
+            if self.total.bytes > 0:
+                line += " ({percent:.1f}%)".format(percent=group.bytes * 100.0 / self.total.bytes)
+            if group.unknown_size_files > 0:
+                line += ", size unknown: {num} files".format(num=group.unknown_size_files)
+            logger.info(line)
+
+    def report(self):
+        line = "plan: {files} files, {size} to migrate, scanned in {seconds}".format(
+            files=self.total.files, size=format_size(self.total.bytes), seconds=format_duration(self.scan_seconds))
+        if self.total.unknown_size_files > 0:
+            line += ", size unknown: {num} files".format(num=self.total.unknown_size_files)
+        logger.info(line)
+        self.media_filter.log_skipped()
+        self.log_groups("media class", self.by_class)
+        self.log_groups("extension", self.by_extension)
+        self.log_groups("prefix", self.by_prefix)
+
+        estimate = self.estimate()
+        if self.sample_result is not None:
+            logger.info("sampled transfer: {files} files, {size} in {seconds:.1f}s, "
+                        "{rate}/s per stream, {open:.3f}s to open a file".format(
+                            files=self.sample_result["files"], size=format_size(self.sample_result["bytes"]),
+                            seconds=self.sample_result["seconds"],
+                            rate=format_size(self.sample_result["stream_bytes_per_second"]),
+                            open=self.sample_result["open_seconds_avg"]))
+        if estimate is not None:
+            logger.info("estimated duration: {duration} for {size} at concurrency {concurrency} ({rate}/s), "
+                        "based on source read speed, upload to vod is not measured".format(
+                            duration=format_duration(estimate["seconds"]), size=format_size(estimate["bytes"]),
+                            concurrency=estimate["concurrency"], rate=format_size(estimate["bytes_per_second"])))
+        return estimate
+
+    def to_dict(self, estimate):
+        return OrderedDict([
+            ("migrate_type", self.migrate_type),
+            ("total", self.total.to_dict()),
+            ("scan_seconds", self.scan_seconds),
+            ("skipped", self.media_filter.skipped),
+            ("by_class", OrderedDict((name, g.to_dict()) for name, g in top_groups(self.by_class))),
+            ("by_extension", OrderedDict((name, g.to_dict()) for name, g in top_groups(self.by_extension))),
+            ("by_prefix", OrderedDict((name, g.to_dict()) for name, g in top_groups(self.by_prefix))),
+            ("sampled_transfer", self.sample_result),
+            ("estimate", estimate),
+        ])
+
+    def run(self, output=None):
+        logger.info("plan: scanning {type}, nothing will be uploaded".format(type=self.migrate_type))
+        self.scan()
+        self.sample_transfer()
+        estimate = self.report()
+        if output:
+            with open(output, "w") as f:
+                json.dump(self.to_dict(estimate), f, indent=2)
+            logger.info("plan saved to {path}".format(path=output))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger("cmd")
+
+PROFILE_SAMPLE = "sample"
+PROFILE_CPROFILE = "cprofile"
+PROFILE_MODES = (PROFILE_SAMPLE, PROFILE_CPROFILE)
+
+DEFAULT_PROFILE_OUTPUT = "vodmigrate_profile.txt"
+# 采样间隔（秒）：每次采样需要遍历所有线程的调用栈，间隔过小会影响迁移本身
+SAMPLE_INTERVAL = 0.01
+# 报告中列出的函数数
+REPORT_TOP_FUNCTIONS = 40
+
+SPAN_SCAN_PAGE = "scan_page"
+SPAN_SAVE_RECORD = "save_migrate_record"
+SPAN_DB_WRITE = "db_write"
+SPAN_APPLY_UPLOAD = "upload.apply"
+SPAN_SOURCE_OPEN = "upload.source_open"
+SPAN_PUT = "upload.put"
+SPAN_VERIFY = "upload.verify"
+SPAN_COMMIT_UPLOAD = "upload.commit"
+
+_profiler = None
+
+
+class SpanStats(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Span(object):
+    '''统计一段代码的耗时，按名称汇总到当前的Profiler'''
+
+    __slots__ = ('profiler', 'name', 'start_time')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_span(self.name, time.time() - self.start_time)
+        return False
+
+
+class NullSpan(object):
+    '''未开启性能分析时使用，不做任何统计'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name):
+    '''with span(name): ... 统计代码段耗时，未开启--profile时开销只有一次函数调用'''
+
+    if _profiler is None:
+        return NULL_SPAN
+    return Span(_profiler, name)
+
+
+def timed(name):
+    '''装饰器：函数的每次调用记为一次span'''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with Span(_profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_function_name(code):
+    return '{func} ({file}:{line})'.format(
+        func=code.co_name, file=os.path.basename(code.co_filename), line=code.co_firstlineno)
+
+
+class Profiler(object):
+    '''进程级的性能分析：汇总各代码段（span）的耗时，并按mode收集函数级的数据，退出时写入报告
+
+    - sample：后台线程定期采样所有线程的调用栈，开销低，可用于生产环境，
+      报告按函数出现的样本数排序，同时输出可用于生成火焰图的折叠栈文件（.folded）
+    - cprofile：每个线程各自运行cProfile，退出时合并，数据精确但开销较大，
+      同时输出可用pstats/snakeviz查看的.prof文件'''
+
+    def __init__(self, mode=PROFILE_SAMPLE, path=DEFAULT_PROFILE_OUTPUT, interval=SAMPLE_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ValueError("profile mode must be one of {modes}".format(modes=', '.join(PROFILE_MODES)))
+        self.mode = mode
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.spans = defaultdict(SpanStats)
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        # sample
+        self.sampler = None
+        self.sample_num = 0
+        self.own_samples = defaultdict(int)
+        self.total_samples = defaultdict(int)
+        self.stacks = defaultdict(int)
+        # cprofile
+        self.profiles = []
+
+    def add_span(self, name, seconds):
+        with self.lock:
+            stats = self.spans[name]
+            stats.count += 1
+            stats.total += seconds
+            if seconds > stats.max:
+                stats.max = seconds
+
+    def start(self):
+        if self.mode == PROFILE_SAMPLE:
+            self.sampler = threading.Thread(target=self.sample_periodically)
+            self.sampler.daemon = True
+            self.sampler.start()
+        else:
+            # 之后启动的线程在开始执行前调用enable_thread_profile，当前线程直接开启
+            threading.setprofile(self.enable_thread_profile)
+            self.enable_thread_profile()
+
+    def enable_thread_profile(self, *args):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python 3.12起cProfile基于sys.monitoring，第一个实例已经覆盖所有线程
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def sample_periodically(self):
+        sampler_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            self.sample(sampler_id)
+
+    def sample(self, sampler_id):
+        frames = sys._current_frames()
+        with self.lock:
+            for thread_id, frame in frames.items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(get_function_name(frame.f_code))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self.sample_num += 1
+                self.own_samples[stack[0]] += 1
+                # 递归调用的函数只计一次
+                for name in set(stack):
+                    self.total_samples[name] += 1
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        '''停止收集并写入报告'''
+
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.mode == PROFILE_CPROFILE:
+            threading.setprofile(None)
+            sys.setprofile(None)
+        try:
+            self.write_report()
+            logger.info("profile report: {path}".format(path=self.path))
+        except Exception as e:
+            logger.error("write profile report failed: {error}".format(error=e))
+
+    def write_report(self):
+        lines = ["vodmigrate profile, mode: {mode}, pid: {pid}, duration: {duration:.1f}s".format(
+            mode=self.mode, pid=os.getpid(), duration=time.time() - self.start_time), ""]
+        lines.extend(self.format_spans())
+        lines.append("")
+        if self.mode == PROFILE_SAMPLE:
+            lines.extend(self.format_samples())
+            with io.open(self.path + '.folded', 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(u'{stack} {count}\n'.format(stack=stack, count=count))
+        else:
+            lines.extend(self.format_profiles())
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(lines) + u'\n')
+
+    def format_spans(self):
+        lines = ["{name:<24}{count:>10}{total:>12}{avg:>10}{max:>10}".format(
+            name="span", count="count", total="total(s)", avg="avg(ms)", max="max(ms)")]
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda item: -item[1].total)
+        for name, stats in spans:
+            lines.append("{name:<24}{count:>10}{total:>12.2f}{avg:>10.1f}{max:>10.1f}".format(
+                name=name, count=stats.count, total=stats.total,
+                avg=stats.total / stats.count * 1000, max=stats.max * 1000))
+        return lines
+
+    def format_samples(self):
+        lines = ["top functions by samples ({num} thread samples, interval {interval}ms)".format(
+            num=self.sample_num, interval=self.interval * 1000),
+            "{own:>8}{total:>8}  function".format(own="own%", total="total%")]
+        if self.sample_num == 0:
+            return lines
+        top = sorted(self.total_samples.items(), key=lambda item: -item[1])[:REPORT_TOP_FUNCTIONS]
+        for name, count in top:
+            lines.append("{own:>8.1f}{total:>8.1f}  {name}".format(
+                own=self.own_samples.get(name, 0) * 100.0 / self.sample_num,
+                total=count * 100.0 / self.sample_num, name=name))
+        return lines
+
+    def format_profiles(self):
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return ["no cProfile data"]
+        for profile in profiles:
+            profile.disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.path + '.prof')
+        stream = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(REPORT_TOP_FUNCTIONS)
+        output = stream.getvalue()
+        if not isinstance(output, type(u'')):
+            output = output.decode('utf-8')
+        return ["{num} thread profiles merged, sorted by cumulative time".format(num=len(profiles)), output]
+
+
+def timed_iter(iterable, name):
+    '''逐个取出iterable中的元素，每次取出的耗时记为一次span，用于统计分页列举等生成器'''
+
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def get_worker_profile_path(path, index):
+    '''同一台机器上的多个工作进程分别写入各自的报告：profile.txt -> profile.1.txt'''
+
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{root}.{index}{ext}'.format(root=root, index=index, ext=ext)
+
+
+def start_profiler(mode, path=DEFAULT_PROFILE_OUTPUT, index=0):
+    '''按--profile参数开启性能分析，mode为空时不开启并返回None；
+    fork出的工作进程会继承父进程的状态，这里先清除再按本进程的参数开启'''
+
+    global _profiler
+    _profiler = None
+    threading.setprofile(None)
+    sys.setprofile(None)
+    if not mode:
+        return None
+    profiler = Profiler(mode, get_worker_profile_path(path, index))
+    _profiler = profiler
+    profiler.start()
+    logger.info("profiling enabled, mode: {mode}, report: {path}".format(mode=mode, path=profiler.path))
+    return profiler
+
+
+def stop_profiler(profiler):
+    global _profiler
+    if profiler is None:
+        return
+    _profiler = None
+    profiler.stop()
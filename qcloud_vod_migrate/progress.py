@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+# 吞吐量指数加权平均的半衰期（秒）：越大越平滑，越小越能反映当前速度
+THROUGHPUT_HALF_LIFE = 30.0
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+
+class EwmaRate(object):
+    '''按时间加权的指数移动平均速率：每次采样计算与上次采样之间的平均速率，
+    权重为 1 - 0.5 ** (间隔 / 半衰期)，采样间隔不均匀时也能正确衰减；
+    平均值从0开始累积并按累计权重修正，开始时的突发速率不会长时间影响结果'''
+
+    def __init__(self, value=0, half_life=THROUGHPUT_HALF_LIFE):
+        self.half_life = half_life
+        self.average = 0.0
+        self.weight = 0.0
+        self.last_time = time.time()
+        self.last_value = value
+
+    @property
+    def rate(self):
+        if self.weight <= 0:
+            return None
+        return self.average / self.weight
+
+    def update(self, value, now=None):
+        '''value为累计值，返回当前的平均速率，第一次采样前为None'''
+
+        if now is None:
+            now = time.time()
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return self.rate
+        decay = 0.5 ** (elapsed / self.half_life)
+        self.average = decay * self.average + (1 - decay) * (value - self.last_value) / float(elapsed)
+        self.weight = decay * self.weight + (1 - decay)
+        self.last_time = now
+        self.last_value = value
+        return self.rate
+
+
+class ProgressMeter(object):
+    '''统计本进程实际传输的字节数（包括尚未传输完的文件），用于计算当前吞吐量'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transferred = 0
+
+    def add(self, size):
+        with self.lock:
+            self.transferred += size
+
+
+def format_size(size):
+    size = float(size)
+    for unit in SIZE_UNITS[:-1]:
+        if abs(size) < 1024:
+            return '{size:.1f}{unit}'.format(size=size, unit=unit)
+        size /= 1024
+    return '{size:.1f}{unit}'.format(size=size, unit=SIZE_UNITS[-1])
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{h}:{m:02d}:{s:02d}'.format(h=seconds // 3600, m=seconds // 60 % 60, s=seconds % 60)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import errno
+import random
+from qcloud_vod.exception import VodClientException
+from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
+from qcloud_vod_migrate.manager import MIGRATE_ERROR_RETRYABLE, MIGRATE_ERROR_PERMANENT
+
+# 云API错误码前缀：参数、鉴权、资源不存在等错误重试也不会成功
+PERMANENT_API_ERROR_PREFIXES = (
+    "InvalidParameter", "MissingParameter", "UnknownParameter", "AuthFailure",
+    "UnauthorizedOperation", "UnsupportedOperation", "ResourceNotFound",
+)
+
+# 上传sdk的参数检查错误（缺少媒体类型、文件不存在等）均不可重试，以下除外
+RETRYABLE_CLIENT_ERRORS = ("incomplete upload",)
+
+# 本地文件不存在、无权限等错误
+PERMANENT_ERRNOS = (errno.ENOENT, errno.EACCES, errno.EPERM, errno.EISDIR, errno.ENOTDIR)
+
+# 4xx中可重试的状态码：请求超时、冲突、限频
+RETRYABLE_STATUS_CODES = (408, 409, 425, 429)
+
+
+class HttpStatusError(Exception):
+    '''源站返回非200状态码'''
+
+    def __init__(self, message, status_code):
+        super(HttpStatusError, self).__init__(message)
+        self.status_code = status_code
+
+
+def get_status_code(error):
+    '''取得各存储源sdk异常中的http状态码，没有时返回None'''
+
+    for attr in ("status_code", "status"):
+        code = getattr(error, attr, None)
+        if isinstance(code, int):
+            return code
+    # cos: CosServiceError.get_status_code()
+    get_code = getattr(error, "get_status_code", None)
+    if callable(get_code):
+        try:
+            return int(get_code())
+        except (TypeError, ValueError):
+            return None
+    response = getattr(error, "response", None)
+    # boto3: ClientError.response["ResponseMetadata"]["HTTPStatusCode"]
+    if isinstance(response, dict):
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    # requests: HTTPError.response.status_code
+    code = getattr(response, "status_code", None)
+    if isinstance(code, int):
+        return code
+    return None
+
+
+def classify_error(error):
+    '''将迁移失败的异常分为可重试（网络错误、限频、服务端错误等）和不可重试（文件不存在、参数错误、无权限等）'''
+
+    if isinstance(error, VodClientException):
+        if error.message in RETRYABLE_CLIENT_ERRORS:
+            return MIGRATE_ERROR_RETRYABLE
+        return MIGRATE_ERROR_PERMANENT
+    if isinstance(error, TencentCloudSDKException):
+        if (error.get_code() or "").startswith(PERMANENT_API_ERROR_PREFIXES):
+            return MIGRATE_ERROR_PERMANENT
+        return MIGRATE_ERROR_RETRYABLE
+    if isinstance(error, (IOError, OSError)) and error.errno in PERMANENT_ERRNOS:
+        return MIGRATE_ERROR_PERMANENT
+
+    status_code = get_status_code(error)
+    if status_code is not None and 400 <= status_code < 500 and \
+            status_code not in RETRYABLE_STATUS_CODES:
+        return MIGRATE_ERROR_PERMANENT
+    return MIGRATE_ERROR_RETRYABLE
+
+
+def get_error_code(error):
+    '''取得用于统计的错误码：云API错误码、errno名称或http状态码，都没有时为异常类名'''
+
+    if isinstance(error, TencentCloudSDKException) and error.get_code():
+        return error.get_code()
+    if isinstance(error, (IOError, OSError)) and error.errno in errno.errorcode:
+        return errno.errorcode[error.errno]
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return str(status_code)
+    return type(error).__name__
+
+
+def get_retry_delay(attempts, base_seconds, max_seconds):
+    '''第attempts次失败后的重试等待时间：指数退避，并在后一半区间内随机抖动，避免大量任务同时重试'''
+
+    delay = min(max_seconds, base_seconds * (2 ** min(attempts - 1, 30)))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import logging
+import stat
+import threading
+from qcloud_vod_migrate.config import DEFAULT_SCAN_CONCURRENCY
+from qcloud_vod_migrate.util import to_printable_str
+from six.moves import queue
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+logger = logging.getLogger("cmd")
+
+# 每个目录的扫描结果中最多包含的文件数，超大目录分多批返回
+SCAN_BATCH_SIZE = 1000
+
+QUEUE_WAIT_SECONDS = 0.5
+
+
+class LocalScanner(object):
+    '''本地目录并行扫描：使用scandir遍历目录，被排除的目录整棵子树直接跳过，
+    多个线程同时扫描不同目录（NFS/CephFS等网络文件系统上每次元数据操作都是一次网络往返）
+
+    scan() 按目录返回 (dirpath, [(path, stat_result)])，目录之间的顺序不固定；
+    get_frontier() 返回尚未完成的目录：(需要完整扫描的目录, 子目录已加入但文件结果尚未被调用方取走的目录)，
+    作为frontier、files_only传入时从这些目录继续扫描，后者只重新列举文件，不再进入子目录；
+    待扫描目录按后进先出的顺序处理（深度优先），使未完成的目录数保持在目录深度乘以子目录数的量级'''
+
+    def __init__(self, root, excludes=None, concurrency=DEFAULT_SCAN_CONCURRENCY, frontier=None, files_only=None):
+        self.root = root
+        self.excludes = list(excludes or [])
+        self.concurrency = max(1, concurrency)
+        self.dirs = queue.LifoQueue()
+        self.files_only = set(files_only or [])
+        if frontier is None and files_only is None:
+            frontier = [root]
+        # 目录 -> 尚未完成的单元数（目录本身的扫描及每一批尚未被取走的结果）
+        self.frontier = dict((path, 1) for path in list(frontier or []) + list(self.files_only))
+        # frontier中已经完成扫描、只剩结果尚未被取走的目录
+        self.scanned = set()
+        self.results = queue.Queue(maxsize=self.concurrency * 4)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.dir_num = 0
+        self.file_num = 0
+
+    def is_excluded(self, path):
+        for exclude_path in self.excludes:
+            if path.startswith(exclude_path):
+                return True
+        return False
+
+    def get_frontier(self):
+        with self.lock:
+            return (sorted(p for p in self.frontier if p not in self.scanned),
+                    sorted(p for p in self.frontier if p in self.scanned))
+
+    def release(self, path, scanned=False):
+        '''完成目录的一个单元，调用时需持有锁'''
+
+        if scanned:
+            self.scanned.add(path)
+        self.frontier[path] -= 1
+        if self.frontier[path] == 0:
+            del self.frontier[path]
+            self.scanned.discard(path)
+
+    def put_result(self, result):
+        if result is not None:
+            with self.lock:
+                self.frontier[result[0]] += 1
+        while not self.stopped.is_set():
+            try:
+                self.results.put(result, timeout=QUEUE_WAIT_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def scan_dir(self, path):
+        '''扫描单个目录，返回子目录列表；文件按批放入结果队列'''
+
+        subdirs = []
+        files = []
+        try:
+            entries = scandir(path)
+        except OSError as e:
+            logger.error("scan {path} failed: {error}".format(
+                path=to_printable_str(path), error=e))
+            return subdirs
+
+        for entry in entries:
+            try:
+                # 与os.walk一致：不进入指向目录的符号链接
+                if entry.is_dir():
+                    if not entry.is_symlink() and not self.is_excluded(entry.path) and \
+                            path not in self.files_only:
+                        subdirs.append(entry.path)
+                    continue
+                file_info = entry.stat()
+            except OSError as e:
+                logger.error("stat {path} failed: {error}".format(
+                    path=to_printable_str(entry.path), error=e))
+                continue
+            if not stat.S_ISREG(file_info.st_mode):
+                continue
+            files.append((entry.path, file_info))
+            if len(files) >= SCAN_BATCH_SIZE:
+                self.put_result((path, files))
+                files = []
+
+        if len(files) > 0:
+            self.put_result((path, files))
+        return subdirs
+
+    def worker(self):
+        while not self.stopped.is_set():
+            try:
+                path = self.dirs.get(timeout=QUEUE_WAIT_SECONDS)
+            except queue.Empty:
+                continue
+            if path is None:
+                return
+
+            try:
+                subdirs = self.scan_dir(path)
+            except Exception as e:
+                # 保证计数正确，避免异常导致扫描无法结束
+                logger.error(e)
+                subdirs = []
+            with self.lock:
+                self.dir_num += 1
+                self.pending += len(subdirs) - 1
+                finished = self.pending == 0
+                for subdir in subdirs:
+                    self.frontier[subdir] = 1
+                self.release(path, scanned=True)
+            for subdir in subdirs:
+                self.dirs.put(subdir)
+            if finished:
+                self.put_result(None)
+
+    def scan(self):
+        if self.is_excluded(self.root):
+            return
+
+        self.pending = len(self.frontier)
+        if self.pending == 0:
+            return
+        for path in sorted(self.frontier, reverse=True):
+            self.dirs.put(path)
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while True:
+                result = self.results.get()
+                if result is None:
+                    break
+                self.file_num += len(result[1])
+                # 调用方处理完这批结果后才会再次取结果或查询frontier
+                with self.lock:
+                    self.release(result[0])
+                yield result
+        finally:
+            # 正常结束时通知线程退出；调用方中途退出时直接停止所有线程
+            if self.pending == 0:
+                for _ in threads:
+                    self.dirs.put(None)
+            else:
+                self.stopped.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import importlib
+from qcloud_vod_migrate.config import MIGRATE_FROM_LOCAL, MIGRATE_FROM_URLLIST, MIGRATE_FROM_COS, MIGRATE_FROM_AWS, MIGRATE_FROM_ALI, MIGRATE_FROM_QINIU
+
+# 迁移类型 -> (模块, 适配器类)；模块在选中时才导入，未使用的存储源sdk不会被加载
+SOURCES = {
+    MIGRATE_FROM_LOCAL: ("qcloud_vod_migrate.source.local", "LocalSource"),
+    MIGRATE_FROM_URLLIST: ("qcloud_vod_migrate.source.url", "UrlSource"),
+    MIGRATE_FROM_COS: ("qcloud_vod_migrate.source.cos", "CosSource"),
+    MIGRATE_FROM_AWS: ("qcloud_vod_migrate.source.aws", "AwsSource"),
+    MIGRATE_FROM_ALI: ("qcloud_vod_migrate.source.ali", "AliSource"),
+    MIGRATE_FROM_QINIU: ("qcloud_vod_migrate.source.qiniu", "QiniuSource"),
+}
+
+
+def register_source(migrate_type, module_name, class_name):
+    SOURCES[migrate_type] = (module_name, class_name)
+
+
+def get_source(conf):
+    '''创建迁移类型对应的存储源适配器'''
+
+    migrate_type = conf.migrateType.type
+    if migrate_type not in SOURCES:
+        raise Exception("unsupported migrate type: {type}".format(type=migrate_type))
+    module_name, class_name = SOURCES[migrate_type]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(conf)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import oss2
+from qcloud_vod_migrate.source.base import Source, SourceObject, retry_call, LIST_PAGE_SIZE, PRESIGN_EXPIRES
+from six import text_type
+
+
+class AliSource(Source):
+    '''阿里云oss'''
+
+    def __init__(self, conf):
+        super(AliSource, self).__init__(conf)
+        auth = oss2.Auth(conf.migrateAli.accessKeyId, conf.migrateAli.accessKeySecret)
+        self.bucket = oss2.Bucket(auth, conf.migrateAli.endPoint, conf.migrateAli.bucket)
+
+    def list_pages(self, cursor=None):
+        marker = cursor or ''
+        is_truncated = True
+        while is_truncated:
+            res = retry_call(
+                self.bucket.list_objects, prefix=self.conf.migrateAli.prefix,
+                marker=marker, max_keys=LIST_PAGE_SIZE)
+            page = []
+            for obj in res.object_list:
+                key = obj.key
+                if not isinstance(key, text_type):
+                    key = key.decode('utf-8')
+                page.append(SourceObject(key, obj.size, obj.last_modified, obj.etag))
+            marker = res.next_marker
+            is_truncated = res.is_truncated
+            self.cursor = marker if is_truncated else None
+            yield page
+
+    def stat(self, key):
+        r = self.bucket.get_object_meta(key)
+        return SourceObject(key, r.content_length, r.last_modified, r.etag)
+
+    def open_stream(self, key):
+        r = self.bucket.get_object(key)
+        return r, r.content_length
+
+    def open_range(self, key, start, end):
+        return self.bucket.get_object(key, byte_range=(start, end))
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        return self.bucket.sign_url('GET', key, expires)
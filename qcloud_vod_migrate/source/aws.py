@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import boto3.session
+from qcloud_vod_migrate.filter import parse_time
+from qcloud_vod_migrate.source.base import Source, SourceObject, retry_call, LIST_PAGE_SIZE, PRESIGN_EXPIRES
+from six import text_type
+
+
+class AwsSource(Source):
+    '''aws s3：使用线程安全的client，按前缀分页列举'''
+
+    def __init__(self, conf):
+        super(AwsSource, self).__init__(conf)
+        self.bucket = conf.migrateAws.bucket
+        session = boto3.session.Session(
+            region_name=conf.migrateAws.region,
+            aws_access_key_id=conf.migrateAws.accessKeyId,
+            aws_secret_access_key=conf.migrateAws.accessKeySecret)
+        self.client = session.client('s3')
+
+    def list_pages(self, cursor=None):
+        # 不使用paginator，以便保存和传入ContinuationToken
+        token = cursor
+        while True:
+            kwargs = {}
+            if token:
+                kwargs['ContinuationToken'] = token
+            res = retry_call(
+                self.client.list_objects_v2, Bucket=self.bucket, Prefix=self.conf.migrateAws.prefix,
+                MaxKeys=LIST_PAGE_SIZE, **kwargs)
+            page = []
+            for obj in res.get('Contents', []):
+                key = obj['Key']
+                if not isinstance(key, text_type):
+                    key = key.decode('utf-8')
+                page.append(SourceObject(
+                    key, obj['Size'], parse_time(obj['LastModified']), obj['ETag']))
+            token = res.get('NextContinuationToken') if res.get('IsTruncated') else None
+            self.cursor = token
+            yield page
+            if not token:
+                return
+
+    def stat(self, key):
+        r = self.client.head_object(Bucket=self.bucket, Key=key)
+        return SourceObject(key, r['ContentLength'], parse_time(r['LastModified']), r['ETag'])
+
+    def open_stream(self, key):
+        r = self.client.get_object(Bucket=self.bucket, Key=key)
+        return r['Body'], r['ContentLength']
+
+    def open_range(self, key, start, end):
+        r = self.client.get_object(
+            Bucket=self.bucket, Key=key, Range='bytes={start}-{end}'.format(start=start, end=end))
+        return r['Body']
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=expires)
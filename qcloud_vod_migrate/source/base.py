@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from qcloud_vod_migrate.manager import MIGRATE_INIT, MigrateRecord
+
+logger = logging.getLogger("cmd")
+
+max_retry_times = 3
+
+# 列举存储源时每页的文件数
+LIST_PAGE_SIZE = 1000
+
+# 预签名下载地址的默认有效期（秒）
+PRESIGN_EXPIRES = 3600
+
+
+class SourceObject(object):
+    '''存储源中的一个文件：size/mtime未知时为None；filter_name为按规则过滤时使用的路径，默认即key'''
+
+    __slots__ = ("key", "size", "mtime", "etag", "filter_name")
+
+    def __init__(self, key, size=None, mtime=None, etag="", filter_name=None):
+        self.key = key
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.filter_name = filter_name if filter_name is not None else key
+
+
+def retry_call(func, *args, **kwargs):
+    '''调用存储源接口，失败时按指数退避重试'''
+
+    for i in range(max_retry_times):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            logger.error(e)
+            if i + 1 == max_retry_times:
+                raise e
+            time.sleep(1 << i)
+
+
+class Source(object):
+    '''存储源适配器：每种迁移类型一个实现，在source包中按迁移类型注册，选中时才导入对应的sdk
+
+    - list_pages: 按页列举需要扫描的文件，返回 [SourceObject]；cursor为之前保存的列举位置，从该位置继续列举
+    - get_cursor: 已返回的页之后的列举位置（可序列化为json），中断后可传给list_pages继续，无法继续时为None
+    - stat: 查询单个文件的大小、修改时间、etag
+    - open_stream: 打开文件数据流，返回 (数据流, 文件大小)，大小未知时为0
+    - open_range: 打开文件 [start, end] 区间（含end）的数据流
+    - presign: 生成带签名的下载地址'''
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.migrate_type = conf.migrateType.type
+        self.cursor = None
+
+    def list_pages(self, cursor=None):
+        raise NotImplementedError()
+
+    def get_cursor(self):
+        return self.cursor
+
+    def stat(self, key):
+        raise NotImplementedError()
+
+    def open_stream(self, key):
+        raise NotImplementedError()
+
+    def open_range(self, key, start, end):
+        raise NotImplementedError()
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        raise NotImplementedError()
+
+    def media_file_path(self, key):
+        '''上传请求中的MediaFilePath，用于确定媒体类型和默认媒体名称'''
+
+        return key
+
+    def to_record(self, obj):
+        '''为列举到的文件构建迁移记录'''
+
+        return MigrateRecord(
+            migrate_type=self.migrate_type,
+            filename=obj.key,
+            etag=obj.etag,
+            filesize=obj.size,
+            status=MIGRATE_INIT)
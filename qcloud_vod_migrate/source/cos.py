@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from qcloud_cos import CosConfig, CosS3Client
+from qcloud_vod_migrate.filter import parse_iso_time
+from qcloud_vod_migrate.source.base import Source, SourceObject, retry_call, LIST_PAGE_SIZE, PRESIGN_EXPIRES
+from six import text_type
+
+
+class CosSource(Source):
+    '''腾讯云cos'''
+
+    def __init__(self, conf):
+        super(CosSource, self).__init__(conf)
+        self.bucket = conf.migrateCos.bucket
+        self.client = CosS3Client(CosConfig(
+            Region=conf.migrateCos.region,
+            SecretId=conf.migrateCos.secretId,
+            SecretKey=conf.migrateCos.secretKey))
+
+    def list_pages(self, cursor=None):
+        marker = cursor or ""
+        is_truncated = 'true'
+        while is_truncated == 'true':
+            res = retry_call(
+                self.client.list_objects,
+                Bucket=self.bucket,
+                Prefix=self.conf.migrateCos.prefix,
+                Delimiter='',
+                MaxKeys=LIST_PAGE_SIZE,
+                Marker=marker)
+            page = []
+            for file in res.get('Contents', []):
+                key = file['Key']
+                if not isinstance(key, text_type):
+                    key = key.decode('utf-8')
+                page.append(SourceObject(
+                    key, int(file['Size']), parse_iso_time(file['LastModified']), file['ETag']))
+            if 'NextMarker' in res:
+                marker = res['NextMarker']
+            if 'IsTruncated' in res:
+                is_truncated = res['IsTruncated']
+            self.cursor = marker if is_truncated == 'true' else None
+            yield page
+
+    def stat(self, key):
+        r = self.client.head_object(Bucket=self.bucket, Key=key)
+        return SourceObject(key, int(r['Content-Length']), etag=r.get('ETag', ''))
+
+    def open_stream(self, key):
+        r = self.client.get_object(self.bucket, key)
+        return r['Body'], int(r['Content-Length'])
+
+    def open_range(self, key, start, end):
+        r = self.client.get_object(
+            self.bucket, key, Range='bytes={start}-{end}'.format(start=start, end=end))
+        return r['Body']
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        return self.client.get_presigned_download_url(Bucket=self.bucket, Key=key, Expired=expires)
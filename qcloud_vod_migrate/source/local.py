@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+import os
+from qcloud_vod_migrate.manager import MIGRATE_INIT, MigrateRecord
+from qcloud_vod_migrate.scanner import LocalScanner
+from qcloud_vod_migrate.source.base import Source, SourceObject
+from qcloud_vod_migrate.util import fs_coding
+from six import text_type
+
+logger = logging.getLogger("cmd")
+
+
+class LocalSource(Source):
+    '''本地目录：并行扫描，被排除的目录在扫描时整体跳过'''
+
+    def __init__(self, conf):
+        super(LocalSource, self).__init__(conf)
+        self.scanner = None
+
+    def list_pages(self, cursor=None):
+        '''cursor为尚未扫描完的目录：{"dirs": 需要完整扫描的目录, "files": 只需重新列举文件的目录}'''
+
+        cursor = cursor or {}
+        self.scanner = LocalScanner(
+            self.conf.migrateLocal.localPath,
+            excludes=self.conf.migrateLocal.excludes,
+            concurrency=int(self.conf.migrateLocal.scanConcurrency),
+            frontier=cursor.get("dirs"),
+            files_only=cursor.get("files"))
+        for _, files in self.scanner.scan():
+            yield [self.build_object(path, file_info) for path, file_info in files]
+        logger.info("scanned {dir_num} directories, {file_num} files".format(
+            dir_num=self.scanner.dir_num, file_num=self.scanner.file_num))
+
+    def get_cursor(self):
+        if self.scanner is None:
+            return None
+        dirs, files_only = self.scanner.get_frontier()
+        if len(dirs) == 0 and len(files_only) == 0:
+            return None
+        return {"dirs": dirs, "files": files_only}
+
+    @staticmethod
+    def build_object(path, file_info):
+        if not isinstance(path, text_type):
+            path = path.decode(fs_coding)
+        return SourceObject(path, file_info.st_size, file_info.st_mtime)
+
+    def stat(self, key):
+        return self.build_object(key, os.stat(key))
+
+    def open_stream(self, key):
+        f = io.open(key, 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+    def open_range(self, key, start, end):
+        f = io.open(key, 'rb')
+        f.seek(start)
+        return RangeReader(f, end - start + 1)
+
+    def to_record(self, obj):
+        return MigrateRecord(
+            migrate_type=self.migrate_type,
+            filename=obj.key,
+            mtime=int(obj.mtime),
+            filesize=obj.size,
+            etag="",
+            status=MIGRATE_INIT)
+
+
+class RangeReader(object):
+    '''只读取文件中从当前位置开始的size字节'''
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
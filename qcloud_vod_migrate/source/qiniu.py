@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import qiniu
+from qcloud_vod_migrate.source.base import Source, SourceObject, retry_call, LIST_PAGE_SIZE, PRESIGN_EXPIRES
+from qcloud_vod_migrate.source.url import open_url, get_content_length
+from qcloud_vod_migrate.util import to_printable_str
+from six import text_type
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# 七牛文件上传时间（putTime）的单位为100纳秒
+qiniu_put_time_unit = 10000000.0
+
+
+class QiniuSource(Source):
+    '''七牛云kodo：通过带签名的下载地址读取文件'''
+
+    def __init__(self, conf):
+        super(QiniuSource, self).__init__(conf)
+        self.auth = qiniu.Auth(conf.migrateQiniu.accessKeyId, conf.migrateQiniu.accessKeySecret)
+        self.bucket_manager = qiniu.BucketManager(self.auth)
+
+    def list_pages(self, cursor=None):
+        marker = cursor
+        prefix = self.conf.migrateQiniu.prefix or None
+        eof = False
+        while not eof:
+            res, eof, _ = retry_call(
+                self.bucket_manager.list, bucket=self.conf.migrateQiniu.bucket,
+                prefix=prefix, limit=LIST_PAGE_SIZE, marker=marker)
+            page = []
+            for file in res.get('items', []):
+                key = file['key']
+                if not isinstance(key, text_type):
+                    key = key.decode('utf-8')
+                page.append(SourceObject(
+                    key, int(file['fsize']), file['putTime'] / qiniu_put_time_unit, file['md5']))
+            if 'marker' in res:
+                marker = res['marker']
+            self.cursor = marker if not eof else None
+            yield page
+
+    def stat(self, key):
+        res, _ = self.bucket_manager.stat(self.conf.migrateQiniu.bucket, key)
+        return SourceObject(key, int(res['fsize']), res['putTime'] / qiniu_put_time_unit,
+                            res.get('md5', ''))
+
+    def open_stream(self, key):
+        r = open_url(self.presign(key))
+        return r, get_content_length(r)
+
+    def open_range(self, key, start, end):
+        return open_url(self.presign(key), {'Range': 'bytes={start}-{end}'.format(start=start, end=end)})
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        base_url = 'http://{end_point}/{key}'.format(
+            end_point=self.conf.migrateQiniu.endPoint, key=quote(to_printable_str(key)))
+        return self.auth.private_download_url(base_url, expires)
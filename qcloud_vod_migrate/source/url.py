@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import requests
+from qcloud_vod_migrate.retry import HttpStatusError
+from qcloud_vod_migrate.source.base import Source, SourceObject, LIST_PAGE_SIZE, PRESIGN_EXPIRES
+from qcloud_vod_migrate.util import fs_coding
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+def get_content_length(r):
+    if 'Content-Length' in r.headers:
+        return int(r.headers['Content-Length'])
+    return 0
+
+
+def open_url(url, headers=None):
+    '''以流式方式下载，边下载边上传，不在内存中缓存整个文件'''
+
+    r = requests.get(url, headers=headers, stream=True)
+    if r.status_code not in (200, 206):
+        r.close()
+        raise HttpStatusError('download: {key} failed, httpCode: {code}'.format(
+            key=url, code=r.status_code), r.status_code)
+    return r
+
+
+class UrlSource(Source):
+    '''Url列表：文件大小在下载时才能确定'''
+
+    def list_pages(self, cursor=None):
+        '''cursor为列表文件中已扫描到的字节偏移；从中间继续时，之前出现过的重复url由调用方对比已有记录跳过'''
+
+        urls = set()
+        page = []
+        # 按字节读取以便记录偏移（文本模式逐行迭代时不能tell）
+        with io.open(self.conf.migrateUrl.urllistPath, 'rb') as f:
+            if cursor:
+                f.seek(cursor)
+            for line in iter(f.readline, b''):
+                url = line.decode(fs_coding).rstrip('\r\n')
+                if url in urls:
+                    continue
+                urls.add(url)
+                page.append(SourceObject(url, filter_name=urlparse(url).path))
+                if len(page) >= LIST_PAGE_SIZE:
+                    self.cursor = f.tell()
+                    yield page
+                    page = []
+        self.cursor = None
+        if len(page) > 0:
+            yield page
+
+    def stat(self, key):
+        r = requests.head(key, allow_redirects=True)
+        if r.status_code != 200:
+            raise HttpStatusError('head: {key} failed, httpCode: {code}'.format(
+                key=key, code=r.status_code), r.status_code)
+        return SourceObject(key, get_content_length(r), etag=r.headers.get('ETag', ''),
+                            filter_name=urlparse(key).path)
+
+    def open_stream(self, key):
+        r = open_url(key)
+        return r, get_content_length(r)
+
+    def open_range(self, key, start, end):
+        return open_url(key, {'Range': 'bytes={start}-{end}'.format(start=start, end=end)})
+
+    def presign(self, key, expires=PRESIGN_EXPIRES):
+        return key
+
+    def media_file_path(self, key):
+        return os.path.basename(urlparse(key).path)
@@ -1,41 +1,114 @@
 # -*- coding:utf-8 -*-
 import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tencentcloud.common import credential
 from tencentcloud.vod.v20180717 import vod_client, models
 from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
 from qcloud_cos import CosConfig, CosS3Client
 from qcloud_vod.common import FileUtil, StringUtil
 from qcloud_vod.model import VodUploadResponse
+from qcloud_vod.vod_upload_client import VodUploadClient
 from qcloud_vod.exception import VodClientException
+from qcloud_vod_migrate.limiter import TransferStream
+from qcloud_vod_migrate.profiler import timed, SPAN_APPLY_UPLOAD, SPAN_PUT, SPAN_VERIFY, SPAN_COMMIT_UPLOAD
 
 logger = logging.getLogger("cmd")
 
+# 简单上传的文件大小上限，超过时使用分块上传
+MAX_SINGLE_UPLOAD_SIZE = 5 * 1024 * 1024 * 1024
+
+# 分块上传的最小分块大小及分块数上限
+MULTIPART_PART_SIZE = 10 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_MAX_THREAD = 5
+
+# 需要同时上传分片文件的索引文件类型
+MANIFEST_MEDIA_TYPES = ("m3u8", "mpd")
+
+
+class UploadSession(object):
+    '''一次上传的会话：ApplyUpload的结果及对应的cos client，
+    在申请、传输、确认等步骤之间传递'''
+
+    def __init__(self, request, api_client, apply_upload_response, cos_client, segment_file_paths=None):
+        self.request = request
+        self.api_client = api_client
+        self.apply_upload_response = apply_upload_response
+        self.cos_client = cos_client
+        self.segment_file_paths = segment_file_paths or []
+
+
+class LocalUploadProgress(object):
+    '''将cos sdk分块上传的累计进度转换为增量计入progress_meter；
+    简单上传没有进度回调，上传完成后补齐'''
+
+    def __init__(self, meter):
+        self.meter = meter
+        self.reported = 0
+
+    def callback(self, consumed_bytes, total_bytes):
+        self.meter.add(consumed_bytes - self.reported)
+        self.reported = consumed_bytes
+
+    def finish(self, size):
+        if self.meter is not None and size > self.reported:
+            self.meter.add(size - self.reported)
+            self.reported = size
+
 
 class VodUploader(object):
-    '''流式上传文件'''
+    '''流式上传文件，指定bandwidth_limiter时限制数据流的读取速度，
+    指定memory_budget时数据块和分块在读取前先从内存预算中预约，指定progress_meter时统计传输的字节数
+
+    上传分为apply、upload_stream/upload_local、verify、commit几步，
+    可以分别在不同的线程池中执行'''
 
-    def __init__(self, secret_id, secret_key):
+    def __init__(self, secret_id, secret_key, bandwidth_limiter=None, memory_budget=None, progress_meter=None):
         self.secret_id = secret_id
         self.secret_key = secret_key
+        self.bandwidth_limiter = bandwidth_limiter
+        self.memory_budget = memory_budget
+        self.progress_meter = progress_meter
         self.ignore_check = False
         self.retry_time = 3
+        self.manifest_parser = VodUploadClient(secret_id, secret_key)
 
     def upload_from_buffer(self, region, request, body, size=0):
+        session = self.apply(region, request)
+        self.upload_stream(session, body, size)
+        self.verify(session, size)
+        return self.commit(session)
+
+    @timed(SPAN_APPLY_UPLOAD)
+    def apply(self, region, request, local=False):
+        '''申请上传，返回上传会话；local为True时MediaFilePath为本地文件，
+        m3u8/mpd文件同时解析出需要一起上传的分片文件'''
+
         if not self.ignore_check:
             self._prefix_check_and_set_default_val(region, request)
+            if local and not FileUtil.is_file_exist(request.MediaFilePath):
+                raise VodClientException("media path is invalid")
 
         request_str = request.to_json_string()
-        logger.info("vod upload req = {}, region = {}".format(
-            request_str, region))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("vod upload req = {}, region = {}".format(request_str, region))
         cred = credential.Credential(self.secret_id, self.secret_key)
         api_client = vod_client.VodClient(cred, region)
 
+        segment_file_paths = []
+        if local and request.MediaType in MANIFEST_MEDIA_TYPES:
+            self.manifest_parser.parse_manifest(
+                api_client, request.MediaFilePath, request.MediaType, [], segment_file_paths)
+
         apply_upload_request = models.ApplyUploadRequest()
         apply_upload_request.from_json_string(request_str)
         apply_upload_response = self.apply_upload(api_client,
                                                   apply_upload_request)
-        logger.info("vod upload ApplyUpload rsp = {}".format(
-            apply_upload_response.to_json_string()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("vod upload ApplyUpload rsp = {}".format(
+                apply_upload_response.to_json_string()))
 
         if apply_upload_response.TempCertificate is None:
             cos_config = CosConfig(
@@ -51,42 +124,98 @@ class VodUploader(object):
                 Token=temp_certificate.Token)
         cos_client = CosS3Client(cos_config)
 
+        return UploadSession(request, api_client, apply_upload_response, cos_client, segment_file_paths)
+
+    @timed(SPAN_PUT)
+    def upload_stream(self, session, body, size=0):
+        '''将数据流上传到ApplyUpload分配的存储路径'''
+
+        request = session.request
+        apply_upload_response = session.apply_upload_response
+        # 超过简单上传上限且数据流支持read时使用分块上传
+        part_size = None
+        if size > MAX_SINGLE_UPLOAD_SIZE and hasattr(body, 'read'):
+            part_size = max(MULTIPART_PART_SIZE, int(math.ceil(
+                size / float(MULTIPART_MAX_PARTS))))
+        if self.bandwidth_limiter is not None or self.memory_budget is not None or \
+                self.progress_meter is not None:
+            body = TransferStream(body, self.bandwidth_limiter, self.memory_budget, self.progress_meter)
+
         if StringUtil.is_not_empty(request.MediaType) \
                 and StringUtil.is_not_empty(apply_upload_response.MediaStoragePath):
-            self.upload_file_from_buffer(
-                cos_client, body, apply_upload_response.StorageBucket,
-                apply_upload_response.MediaStoragePath[1:],
-                request.ConcurrentUploadNumber)
+            try:
+                self.upload_file_from_buffer(
+                    session.cos_client, body, apply_upload_response.StorageBucket,
+                    apply_upload_response.MediaStoragePath[1:],
+                    request.ConcurrentUploadNumber, part_size)
+            finally:
+                if isinstance(body, TransferStream):
+                    body.release_memory()
         if StringUtil.is_not_empty(request.CoverType) \
                 and StringUtil.is_not_empty(apply_upload_response.CoverStoragePath):
             self.upload_file_from_buffer(
-                cos_client, request.CoverFilePath,
+                session.cos_client, request.CoverFilePath,
                 apply_upload_response.StorageBucket,
                 apply_upload_response.CoverStoragePath[1:],
                 request.ConcurrentUploadNumber)
 
+    @timed(SPAN_PUT)
+    def upload_local(self, session):
+        '''由cos sdk多线程分块上传本地文件，以及封面和m3u8/mpd的分片文件'''
+
+        request = session.request
+        apply_upload_response = session.apply_upload_response
+        local_paths = []
+        if StringUtil.is_not_empty(request.MediaType) \
+                and StringUtil.is_not_empty(apply_upload_response.MediaStoragePath):
+            local_paths.append((request.MediaFilePath, apply_upload_response.MediaStoragePath))
+        if StringUtil.is_not_empty(request.CoverType) \
+                and StringUtil.is_not_empty(apply_upload_response.CoverStoragePath):
+            local_paths.append((request.CoverFilePath, apply_upload_response.CoverStoragePath))
+        storage_dir = os.path.dirname(apply_upload_response.MediaStoragePath)
+        media_file_dir = os.path.dirname(request.MediaFilePath)
+        for segment_file_path in session.segment_file_paths:
+            segment_relative_file_path = segment_file_path[len(media_file_dir):].replace("\\", "/")
+            local_paths.append((segment_file_path, FileUtil.join_path(storage_dir, segment_relative_file_path)))
+
+        for local_path, storage_path in local_paths:
+            progress = LocalUploadProgress(self.progress_meter)
+            VodUploadClient.upload_cos(
+                session.cos_client, local_path, apply_upload_response.StorageBucket,
+                storage_path[1:], request.ConcurrentUploadNumber,
+                progress.callback if self.progress_meter is not None else None)
+            progress.finish(os.path.getsize(local_path))
+
+    @timed(SPAN_VERIFY)
+    def verify(self, session, size):
+        '''检查上传后的文件大小与源文件一致，size为0（大小未知）时不检查'''
+
+        if size == 0:
+            return
         object_size = self.get_object_size(
-            cos_client,
-            apply_upload_response.StorageBucket,
-            apply_upload_response.MediaStoragePath[1:]
+            session.cos_client,
+            session.apply_upload_response.StorageBucket,
+            session.apply_upload_response.MediaStoragePath[1:]
         )
+        if size != object_size:
+            logger.error("incomplete upload, src file size: {src_size}, object size: {object_size}".format(
+                src_size=size, object_size=object_size
+            ))
+            raise VodClientException("incomplete upload")
 
-        if size != 0:
-            if size != object_size:
-                logger.error("incomplete upload, src file size: {src_size}, object size: {object_size}".format(
-                    src_size=size, object_size=object_size
-                ))
-                raise VodClientException("incomplete upload")
+    @timed(SPAN_COMMIT_UPLOAD)
+    def commit(self, session):
+        '''确认上传，返回上传结果'''
 
         commit_upload_request = models.CommitUploadRequest()
-        commit_upload_request.VodSessionKey = apply_upload_response.VodSessionKey
-        commit_upload_request.SubAppId = request.SubAppId
+        commit_upload_request.VodSessionKey = session.apply_upload_response.VodSessionKey
+        commit_upload_request.SubAppId = session.request.SubAppId
 
-        commit_upload_response = self.commit_upload(api_client,
+        commit_upload_response = self.commit_upload(session.api_client,
                                                     commit_upload_request)
         commit_upload_response_str = commit_upload_response.to_json_string()
-        logger.info("vod upload CommitUpload rsp = {}".format(
-            commit_upload_response_str))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("vod upload CommitUpload rsp = {}".format(commit_upload_response_str))
 
         response = VodUploadResponse()
         response.from_json_string(commit_upload_response_str)
@@ -95,11 +224,74 @@ class VodUploader(object):
 
     @staticmethod
     def get_object_size(cos_client, bucket, cos_path):
-        r = cos_client.get_object(Bucket=bucket, Key=cos_path)
+        r = cos_client.head_object(Bucket=bucket, Key=cos_path)
         return int(r["Content-Length"])
 
-    @staticmethod
-    def upload_file_from_buffer(cos_client, body, bucket, cos_path, max_thread):
+    def upload_multipart(self, cos_client, body, bucket, cos_path, max_thread, part_size):
+        '''从数据流分块上传：每个分块读取前从内存预算中预约，上传完成后释放；
+        在途分块数不超过并发数加一，未设置内存预算时同样限制了缓冲的分块数'''
+
+        max_thread = max_thread or MULTIPART_MAX_THREAD
+        upload_id = cos_client.create_multipart_upload(Bucket=bucket, Key=cos_path)['UploadId']
+        executor = ThreadPoolExecutor(max_workers=max_thread)
+        parts = []
+        pending = set()
+        try:
+            part_number = 1
+            while True:
+                if len(pending) > max_thread:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    parts.extend(f.result() for f in done)
+                reserved = 0
+                if self.memory_budget is not None:
+                    reserved = self.memory_budget.acquire(part_size)
+                try:
+                    # 分块的内存已在上面预约，不再由数据流按read预约
+                    if isinstance(body, TransferStream):
+                        data = body.read_part(part_size)
+                    else:
+                        data = body.read(part_size)
+                except Exception:
+                    if reserved:
+                        self.memory_budget.release(reserved)
+                    raise
+                if not data:
+                    if reserved:
+                        self.memory_budget.release(reserved)
+                    break
+                pending.add(executor.submit(
+                    self.upload_part, cos_client, bucket, cos_path, upload_id,
+                    part_number, data, reserved))
+                part_number += 1
+            parts.extend(f.result() for f in wait(pending).done)
+
+            parts.sort(key=lambda part: part['PartNumber'])
+            cos_client.complete_multipart_upload(
+                Bucket=bucket, Key=cos_path, UploadId=upload_id,
+                MultipartUpload={'Part': parts})
+        except Exception as e:
+            executor.shutdown(wait=True)
+            try:
+                cos_client.abort_multipart_upload(Bucket=bucket, Key=cos_path, UploadId=upload_id)
+            except Exception as abort_error:
+                logger.error(abort_error)
+            raise e
+        finally:
+            executor.shutdown(wait=True)
+
+    def upload_part(self, cos_client, bucket, cos_path, upload_id, part_number, data, reserved):
+        try:
+            rt = cos_client.upload_part(
+                Bucket=bucket, Key=cos_path, Body=data, PartNumber=part_number, UploadId=upload_id)
+            return {'PartNumber': part_number, 'ETag': rt['ETag']}
+        finally:
+            if reserved:
+                self.memory_budget.release(reserved)
+
+    def upload_file_from_buffer(self, cos_client, body, bucket, cos_path, max_thread, part_size=None):
+        if part_size is not None:
+            self.upload_multipart(cos_client, body, bucket, cos_path, max_thread, part_size)
+            return
         if max_thread is None:
             cos_client.put_object(
                 Bucket=bucket, Body=body, Key=cos_path)
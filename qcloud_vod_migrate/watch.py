@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from qcloud_vod_migrate.scanner import LocalScanner
+from qcloud_vod_migrate.util import fs_coding, to_printable_str
+from six import text_type
+from six.moves import queue
+
+logger = logging.getLogger("cmd")
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+# 增量对比时，每批查询的文件数
+RECONCILE_PAGE_SIZE = 500
+
+
+class Inotify(object):
+    '''Linux inotify 的ctypes封装，非Linux系统初始化时抛出OSError'''
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+
+    def add_watch(self, path):
+        if isinstance(path, text_type):
+            path = path.encode(fs_coding)
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths[wd] = path.decode(fs_coding)
+
+    def read_events(self, timeout):
+        '''读取事件，返回 [(mask, path)]；timeout秒内没有事件时返回空列表'''
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(fs_coding)
+                offset += length
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                directory = self.paths.get(wd)
+                if directory is None and not mask & IN_Q_OVERFLOW:
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                events.append((mask, path))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LocalWatcher(object):
+    '''本地目录监听：通过inotify发现新文件，文件停止增长一段时间后视为写入完成，
+    并定期遍历目录对账，兜底处理inotify遗漏（或不支持inotify）的情况'''
+
+    def __init__(self, task_producer, settle_seconds, reconcile_interval):
+        self.task_producer = task_producer
+        self.migrate_manager = task_producer.migrate_manager
+        self.migrate_type = task_producer.migrate_type
+        self.local_path = task_producer.conf.migrateLocal.localPath
+        self.settle_seconds = settle_seconds
+        self.reconcile_interval = reconcile_interval
+        self.candidates = {}
+        # 被过滤规则跳过的文件 -> (size, mtime)，文件未变化时不再重复检查
+        self.skipped = {}
+        self.records = queue.Queue()
+        self.inotify = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def get_records(self):
+        '''取出已写入完成、需要迁移的文件记录'''
+
+        records = []
+        while True:
+            try:
+                records.append(self.records.get_nowait())
+            except queue.Empty:
+                return records
+
+    def is_excluded_dir(self, path):
+        for exclude_path in self.task_producer.conf.migrateLocal.excludes:
+            if path.startswith(exclude_path):
+                return True
+        return False
+
+    def watch_tree(self, root, touch_files=True):
+        '''监听目录及其子目录；新建的目录需要将其中已有的文件加入候选（目录创建后到添加监听前写入的文件）'''
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            if self.is_excluded_dir(dirpath):
+                dirnames[:] = []
+                continue
+            try:
+                self.inotify.add_watch(dirpath)
+            except OSError as e:
+                # 超过 fs.inotify.max_user_watches 等情况，由定期对账兜底
+                logger.error("watch {path} failed: {error}".format(
+                    path=to_printable_str(dirpath), error=e))
+            if touch_files:
+                for name in filenames:
+                    self.touch(os.path.join(dirpath, name))
+
+    def touch(self, path):
+        '''文件有变化，重新开始计算稳定时间'''
+
+        self.candidates[path] = (None, time.time())
+
+    def check_candidates(self):
+        '''文件大小和修改时间在settle_seconds内不再变化时，认为写入完成'''
+
+        now = time.time()
+        settled = []
+        for path, (last_stat, last_change) in list(self.candidates.items()):
+            try:
+                file_info = os.stat(path)
+            except OSError:
+                del self.candidates[path]
+                continue
+            stat = (file_info.st_size, file_info.st_mtime)
+            if stat != last_stat:
+                self.candidates[path] = (stat, now)
+            elif now - last_change >= self.settle_seconds:
+                del self.candidates[path]
+                settled.append((path, stat))
+
+        for i in range(0, len(settled), RECONCILE_PAGE_SIZE):
+            self.add_changed_files(settled[i:i + RECONCILE_PAGE_SIZE])
+
+    def add_changed_files(self, files):
+        '''只有新文件或 mtime/size 发生变化的文件才需要迁移'''
+
+        records = []
+        for path, stat in files:
+            try:
+                record = self.task_producer.build_local_record(path)
+            except (OSError, UnicodeEncodeError) as e:
+                logger.error("{file} build failed: {error}".format(
+                    file=to_printable_str(path), error=e))
+                continue
+            if record is None:
+                self.skipped[path] = stat
+                continue
+            self.skipped.pop(path, None)
+            records.append(record)
+        if len(records) == 0:
+            return
+
+        existing_records = self.migrate_manager.get_migrate_records_by_filenames(
+            self.migrate_type, [record.filename for record in records])
+        for record in records:
+            existing = existing_records.get(record.filename)
+            if existing is not None:
+                if existing.mtime == record.mtime and existing.filesize == record.filesize:
+                    continue
+                record.id = existing.id
+            self.records.put(record)
+
+    def reconcile(self):
+        '''遍历目录，找出db中没有记录（或已变化）的文件加入候选'''
+
+        scanner = LocalScanner(
+            self.local_path,
+            excludes=self.task_producer.conf.migrateLocal.excludes,
+            concurrency=int(self.task_producer.conf.migrateLocal.scanConcurrency))
+        files = []
+        for _, dir_files in scanner.scan():
+            files.extend(dir_files)
+            while len(files) >= RECONCILE_PAGE_SIZE:
+                self.reconcile_files(files[:RECONCILE_PAGE_SIZE])
+                files = files[RECONCILE_PAGE_SIZE:]
+        self.reconcile_files(files)
+
+    def reconcile_files(self, files):
+        files = [(path, file_info) for path, file_info in files
+                 if path not in self.candidates and
+                 self.skipped.get(path) != (file_info.st_size, file_info.st_mtime)]
+        if len(files) == 0:
+            return
+        filenames = []
+        for path, _ in files:
+            filenames.append(path.decode(fs_coding) if not isinstance(path, text_type) else path)
+        existing_records = self.migrate_manager.get_migrate_records_by_filenames(
+            self.migrate_type, filenames)
+        for (path, file_info), filename in zip(files, filenames):
+            existing = existing_records.get(filename)
+            if existing is not None and existing.mtime == int(file_info.st_mtime) and \
+                    existing.filesize == file_info.st_size:
+                continue
+            self.touch(path)
+
+    def handle_events(self, events):
+        for mask, path in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.error("inotify event queue overflow, reconcile")
+                self.reconcile()
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+            elif not mask & IN_DELETE_SELF:
+                if not self.is_excluded_dir(os.path.dirname(path)):
+                    self.touch(path)
+
+    def run(self):
+        try:
+            self.inotify = Inotify()
+            self.watch_tree(self.local_path, touch_files=False)
+            logger.info("watching {path}".format(path=to_printable_str(self.local_path)))
+        except OSError as e:
+            self.inotify = None
+            logger.error("inotify unavailable ({error}), reconcile every {interval}s".format(
+                error=e, interval=self.reconcile_interval))
+
+        next_reconcile = time.time() + self.reconcile_interval
+        try:
+            while not self.stopped.is_set():
+                # 单次处理出错（如db暂时不可用）只记录日志，下一轮继续监听
+                try:
+                    if self.inotify is not None:
+                        self.handle_events(self.inotify.read_events(1))
+                    else:
+                        self.stopped.wait(1)
+
+                    if time.time() >= next_reconcile:
+                        next_reconcile = time.time() + self.reconcile_interval
+                        self.reconcile()
+
+                    self.check_candidates()
+                except Exception as e:
+                    logger.error("watch {path} failed: {error}".format(
+                        path=to_printable_str(self.local_path), error=e))
+                    self.stopped.wait(1)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
@@ -11,6 +11,7 @@ def requirements():
 
         if version[0] == '2':
             requirements.append("futures")
+            requirements.append("scandir")
 
         return requirements
 
@@ -33,7 +34,7 @@ setup(
     description='vod migrate tool',
     long_description=long_description(),
     long_description_content_type='text/markdown',
-    packages=find_packages(exclude=["test*"]),
+    packages=find_packages(exclude=["test*", "benchmark*"]),
     install_requires=requirements(),
     entry_points={
         'console_scripts': [
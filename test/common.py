@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+'''单元测试公用：在临时目录中生成配置文件并创建迁移db'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from qcloud_vod_migrate.config import ConfigParser
+
+CONFIG_TEMPLATE = u'''[migrateType]
+type = '{migrate_type}'
+
+[common]
+secretId = 'secretId'
+secretKey = 'secretKey'
+region = 'ap-guangzhou'
+concurrency = 4
+supportMediaClassification = [ 'video', 'audio', 'image' ]
+excludeMediaType = []
+migrateDbStoragePath = '{work_dir}'
+migrateResultOutputPath = '{work_dir}'
+
+[common.storagePath]
+useOriginal = false
+prefix = ''
+
+[migrateLocal]
+localPath = '{work_dir}'
+excludes = []
+
+[migrateUrl]
+urllistPath = '{work_dir}/url.txt'
+
+[migrateCos]
+region = 'ap-guangzhou'
+bucket = 'bucket-1250000000'
+secretId = 'secretId'
+secretKey = 'secretKey'
+prefix = ''
+'''
+
+
+def write_config(work_dir, migrate_type='migrateLocal'):
+    conf_path = os.path.join(work_dir, 'config.toml')
+    with io.open(conf_path, 'w', encoding='utf-8') as f:
+        f.write(CONFIG_TEMPLATE.format(migrate_type=migrate_type, work_dir=work_dir))
+    return conf_path
+
+
+def create_manager(work_dir, migrate_type='migrateLocal'):
+    '''创建新的迁移db，与首次执行迁移时一样初始化迁移状态'''
+
+    from qcloud_vod_migrate.manager import MigrateManager
+
+    conf_path = write_config(work_dir, migrate_type)
+    migrate_manager = MigrateManager(conf=ConfigParser.parse(conf_path))
+    migrate_manager.init_migrate_db()
+    migrate_manager.init_migrate_status(conf_path)
+    return migrate_manager
+
+
+class TempDirTestCase(unittest.TestCase):
+    '''每个测试使用独立的临时目录'''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='vodmigrate_test_')
+        self.managers = []
+
+    def tearDown(self):
+        for migrate_manager in self.managers:
+            migrate_manager.record_writer.close()
+            migrate_manager.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def create_manager(self, migrate_type='migrateLocal'):
+        migrate_manager = create_manager(self.work_dir, migrate_type)
+        self.managers.append(migrate_manager)
+        return migrate_manager
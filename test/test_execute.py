@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import unittest
+from qcloud_vod_migrate.config import SCHEDULE_POLICY_LARGEST_FIRST, SCHEDULE_POLICY_MIXED
+from qcloud_vod_migrate.execute import TaskConsumer, TaskProducer, is_record_changed
+from qcloud_vod_migrate.manager import MigrateRecord, MIGRATE_RUNNING, MIGRATE_TASK_SUCCESS, MIGRATE_TASK_INIT
+from test.common import TempDirTestCase
+
+
+def make_record(filesize=None, mtime=None, etag=""):
+    return MigrateRecord(migrate_type="test", filename="a.mp4", filesize=filesize, mtime=mtime, etag=etag)
+
+
+class IsRecordChangedTest(unittest.TestCase):
+
+    def test_local(self):
+        # 本地文件：对比大小和修改时间，没有etag
+        existing = make_record(10, 100)
+        self.assertFalse(is_record_changed(existing, make_record(10, 100)))
+        self.assertTrue(is_record_changed(existing, make_record(11, 100)))
+        self.assertTrue(is_record_changed(existing, make_record(10, 101)))
+
+    def test_object_storage(self):
+        # 对象存储：对比大小和etag，迁移记录中没有mtime
+        existing = make_record(10, etag='"e1"')
+        self.assertFalse(is_record_changed(existing, make_record(10, etag='"e1"')))
+        self.assertTrue(is_record_changed(existing, make_record(10, etag='"e2"')))
+        self.assertTrue(is_record_changed(existing, make_record(11, etag='"e1"')))
+
+    def test_url(self):
+        # Url列表：扫描时大小未知，已有记录的大小在下载时写入，不应视为变化
+        existing = make_record(10)
+        self.assertFalse(is_record_changed(existing, make_record()))
+
+
+class IncrementalScanTest(TempDirTestCase):
+
+    def write_urls(self, urls):
+        with io.open(os.path.join(self.work_dir, 'url.txt'), 'w', encoding='utf-8') as f:
+            f.write(u''.join(url + u'\n' for url in urls))
+
+    def test_migrated_urls_are_unchanged(self):
+        urls = [u'http://example.com/a.mp4', u'http://example.com/b.mp4']
+        self.write_urls(urls)
+        migrate_manager = self.create_manager('migrateUrl')
+        TaskProducer(migrate_manager).run()
+
+        # 迁移完成后，下载时取得的文件大小写入记录
+        records = migrate_manager.get_migrate_results(0, 10)
+        self.assertEqual(len(records), 2)
+        for record in records:
+            record.status = MIGRATE_TASK_SUCCESS
+            record.filesize = 1024
+            migrate_manager.save_migrate_record(record)
+        migrate_manager.flush_migrate_records()
+
+        self.write_urls(urls + [u'http://example.com/c.mp4'])
+        producer = TaskProducer(migrate_manager, incremental=True)
+        producer.run()
+        self.assertEqual((producer.new_num, producer.changed_num, producer.unchanged_num), (1, 0, 2))
+        statuses = dict((r.filename, r.status) for r in migrate_manager.get_migrate_results(0, 10))
+        self.assertEqual(statuses[urls[0]], MIGRATE_TASK_SUCCESS)
+        self.assertEqual(statuses[u'http://example.com/c.mp4'], MIGRATE_TASK_INIT)
+
+    def test_changed_local_file(self):
+        path = os.path.join(self.work_dir, 'a.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'1')
+        migrate_manager = self.create_manager('migrateLocal')
+        TaskProducer(migrate_manager).run()
+        self.assertEqual(migrate_manager.get_migrate_status(), MIGRATE_RUNNING)
+
+        with open(path, 'wb') as f:
+            f.write(b'12')
+        producer = TaskProducer(migrate_manager, incremental=True)
+        producer.run()
+        self.assertEqual((producer.new_num, producer.changed_num, producer.unchanged_num), (0, 1, 0))
+
+
+class SchedulePolicyTest(TempDirTestCase):
+
+    def setUp(self):
+        super(SchedulePolicyTest, self).setUp()
+        for name, size in [('a.mp4', 3), ('b.mp4', 1), ('c.mp4', 4), ('d.mp4', 2)]:
+            with open(os.path.join(self.work_dir, name), 'wb') as f:
+                f.write(b'1' * size)
+        self.migrate_manager = self.create_manager('migrateLocal')
+        TaskProducer(self.migrate_manager).run()
+        self.migrate_manager.update_execute_begin_time()
+
+    def claim_sizes(self, schedule_policy):
+        self.migrate_manager.conf.common.schedulePolicy = schedule_policy
+        consumer = TaskConsumer(self.migrate_manager)
+        try:
+            consumer.claim_tasks()
+            sizes = []
+            while True:
+                record = consumer.next_record()
+                if record is None:
+                    return sizes
+                sizes.append(record.filesize)
+        finally:
+            consumer.pipeline.shutdown(cancel=True)
+
+    def test_largest_first(self):
+        self.assertEqual(self.claim_sizes(SCHEDULE_POLICY_LARGEST_FIRST), [4, 3, 2, 1])
+
+    def test_mixed(self):
+        # 大文件通道领取最大的文件，其余并发从小到大执行
+        self.assertEqual(self.claim_sizes(SCHEDULE_POLICY_MIXED), [4, 1, 2, 3])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import json
+import os
+from qcloud_vod_migrate import journal as journal_module
+from qcloud_vod_migrate.journal import ResultJournal, build_result, format_time, RESULT_FORMAT_CSV, RESULT_FORMAT_JSONL
+from qcloud_vod_migrate.manager import MigrateRecord, MIGRATE_TASK_INIT
+from test.common import TempDirTestCase
+
+
+def make_result(record_id, status):
+    record = MigrateRecord(id=record_id, migrate_type='migrateLocal',
+                           filename=u'/{id}.mp4'.format(id=record_id), status=status)
+    return build_result(record, format_time(0))
+
+
+class ResultJournalTest(TempDirTestCase):
+
+    def setUp(self):
+        super(ResultJournalTest, self).setUp()
+        self.output = os.path.join(self.work_dir, 'result.txt')
+        self.run_lines = journal_module.COMPACT_RUN_LINES
+
+    def tearDown(self):
+        journal_module.COMPACT_RUN_LINES = self.run_lines
+        super(ResultJournalTest, self).tearDown()
+
+    def read_output(self):
+        with io.open(self.output, 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def test_latest_result_wins(self):
+        first = ResultJournal(self.work_dir, 'a')
+        second = ResultJournal(self.work_dir, 'b', compress=True)
+        first.append([(1.0, make_result(1, 'fail')), (1.0, make_result(2, 'success'))])
+        # 其他进程稍后重试成功，写在另一个日志文件中
+        second.append([(2.0, make_result(1, 'success'))])
+        first.append([(0.5, make_result(2, 'fail'))])
+        second.close()
+
+        self.assertTrue(first.compact(self.output, RESULT_FORMAT_JSONL, False, 2))
+        results = self.read_output()
+        self.assertEqual([(r['id'], r['status']) for r in results], [(1, 'success'), (2, 'success')])
+        self.assertNotIn('ts', results[0])
+
+    def test_merge_runs(self):
+        # 日志分多段排序后归并，同一记录的多次结果分布在不同分段中
+        journal_module.COMPACT_RUN_LINES = 3
+        journal = ResultJournal(self.work_dir, 'a')
+        for i in range(4):
+            journal.append([(float(i), make_result(record_id, 'fail' if i < 3 else 'success'))
+                            for record_id in (5, 3, 1000000)])
+        journal.append([(1.0, make_result(3, 'fail'))])
+        self.assertTrue(journal.compact(self.output, RESULT_FORMAT_JSONL, False, 3))
+        results = self.read_output()
+        self.assertEqual([(r['id'], r['status']) for r in results],
+                         [(3, 'success'), (5, 'success'), (1000000, 'success')])
+
+    def test_truncated_last_line(self):
+        journal = ResultJournal(self.work_dir, 'a')
+        journal.append([(1.0, make_result(1, 'success')), (2.0, make_result(2, 'success'))])
+        journal.close()
+        # 进程写入最后一行时异常退出
+        with io.open(journal.path, 'ab') as f:
+            f.write(b'{"ts": 3.0, "id": 1, "filename": "/1.')
+
+        self.assertTrue(journal.compact(self.output, RESULT_FORMAT_CSV, True, 2))
+        with gzip.open(self.output, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('id,'))
+
+    def test_missing_entries(self):
+        journal = ResultJournal(self.work_dir, 'a')
+        journal.append([(1.0, make_result(1, 'success'))])
+        self.assertFalse(journal.compact(self.output, RESULT_FORMAT_JSONL, False, 2))
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_fallback_to_db(self):
+        migrate_manager = self.create_manager('migrateLocal')
+        for i in range(2):
+            migrate_manager.save_migrate_record(MigrateRecord(
+                migrate_type='migrateLocal', filename=u'/{i}.mp4'.format(i=i),
+                filesize=1, status=MIGRATE_TASK_INIT))
+        migrate_manager.flush_migrate_records()
+        migrate_manager.init_counter()
+
+        # 未完成的记录没有写入日志，从db全量导出
+        migrate_manager.output_migrate_results()
+        with io.open(migrate_manager.get_result_file(), 'rb') as f:
+            results = [json.loads(line.decode('utf-8')) for line in f]
+        self.assertEqual([r['filename'] for r in results], [u'/0.mp4', u'/1.mp4'])
+        self.assertEqual(results[0]['status'], MIGRATE_TASK_INIT)
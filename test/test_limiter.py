@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import io
+import time
+import unittest
+from qcloud_vod_migrate.limiter import HostRateLimiter, HostScheduler, MemoryBudget, TransferStream
+
+
+class TransferStreamTest(unittest.TestCase):
+
+    def test_read_reserves_memory(self):
+        budget = MemoryBudget(100)
+        stream = TransferStream(io.BytesIO(b'x' * 30), memory_budget=budget)
+        # 每次read预约本块内存，读取下一块时释放上一块
+        self.assertEqual(stream.read(20), b'x' * 20)
+        self.assertEqual(budget.used, 20)
+        self.assertEqual(stream.read(20), b'x' * 10)
+        self.assertEqual(budget.used, 20)
+        self.assertEqual(stream.read(20), b'')
+        self.assertEqual(budget.used, 0)
+        self.assertEqual(budget.peak, 20)
+
+    def test_release_unfinished_read(self):
+        budget = MemoryBudget(100)
+        stream = TransferStream(io.BytesIO(b'x' * 30), memory_budget=budget)
+        stream.read(25)
+        self.assertEqual(budget.used, 25)
+        stream.release_memory()
+        self.assertEqual(budget.used, 0)
+
+    def test_read_part_not_reserved(self):
+        # 分块上传的分块由调用方预约
+        budget = MemoryBudget(100)
+        stream = TransferStream(io.BytesIO(b'x' * 30), memory_budget=budget)
+        self.assertEqual(stream.read_part(20), b'x' * 20)
+        self.assertEqual(budget.used, 0)
+
+    def test_iter_chunks(self):
+        budget = MemoryBudget(1 << 30)
+        stream = TransferStream([b'a', b'bc'], memory_budget=budget)
+        self.assertEqual(list(stream), [b'a', b'bc'])
+        self.assertEqual(budget.used, 0)
+
+
+def get_host(item):
+    return item[0]
+
+
+class HostSchedulerTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        scheduler = HostScheduler(get_host)
+        for item in [('a', 1), ('a', 2), ('a', 3), ('b', 1), ('c', 1)]:
+            scheduler.add(item)
+        self.assertEqual(len(scheduler), 5)
+        # 各源站轮流取出，任务集中的源站不会阻塞其他源站
+        items = [scheduler.next() for _ in range(5)]
+        self.assertEqual(items, [('a', 1), ('b', 1), ('c', 1), ('a', 2), ('a', 3)])
+        self.assertIsNone(scheduler.next())
+
+    def test_max_in_flight(self):
+        scheduler = HostScheduler(get_host, max_in_flight_per_host=1)
+        for item in [('a', 1), ('a', 2), ('b', 1)]:
+            scheduler.add(item)
+        self.assertEqual(scheduler.next(), ('a', 1))
+        self.assertEqual(scheduler.next(), ('b', 1))
+        # 源站a已达到在途上限
+        self.assertIsNone(scheduler.next())
+        scheduler.done(('a', 1))
+        self.assertEqual(scheduler.next(), ('a', 2))
+        self.assertEqual(len(scheduler), 0)
+
+
+class HostRateLimiterTest(unittest.TestCase):
+
+    def test_interval_per_host(self):
+        limiter = HostRateLimiter(requests_per_second=20)
+        start = time.time()
+        for _ in range(3):
+            limiter.acquire('a')
+        # 同一源站相邻请求间隔1/20秒，不同源站互不影响
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        start = time.time()
+        limiter.acquire('b')
+        self.assertLess(time.time() - start, 0.05)
+
+    def test_unlimited(self):
+        limiter = HostRateLimiter()
+        start = time.time()
+        for _ in range(100):
+            limiter.acquire('a')
+        self.assertLess(time.time() - start, 0.05)
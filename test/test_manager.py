@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import time
+from sqlalchemy import text
+from qcloud_vod_migrate import manager
+from qcloud_vod_migrate.config import ConfigParser
+from qcloud_vod_migrate.manager import MigrateManager, MigrateRecord, MigrateStatus, Session, MIGRATE_DB, MIGRATE_RUNNING
+from qcloud_vod_migrate.manager import MIGRATE_TASK_DUPLICATE, MIGRATE_TASK_FAIL, MIGRATE_TASK_INIT
+from qcloud_vod_migrate.manager import MIGRATE_TASK_RUNNING, MIGRATE_TASK_SUCCESS
+from qcloud_vod_migrate.manager import MIGRATE_ERROR_PERMANENT, MIGRATE_ERROR_RETRYABLE
+from test.common import TempDirTestCase, write_config
+
+# 初始版本创建的db
+BASELINE_SCHEMA = '''
+CREATE TABLE session (
+    id INTEGER NOT NULL,
+    status VARCHAR(16),
+    config_md5 VARCHAR(64),
+    create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+);
+CREATE TABLE records (
+    id INTEGER NOT NULL,
+    migrate_type VARCHAR(32),
+    filename TEXT DEFAULT '',
+    mtime INTEGER,
+    filesize INTEGER,
+    etag VARCHAR(128) DEFAULT '',
+    file_id VARCHAR(128) DEFAULT '',
+    vod_url VARCHAR(256) DEFAULT '',
+    status VARCHAR(16),
+    err_msg VARCHAR(256) DEFAULT '',
+    create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+);
+INSERT INTO session (status, config_md5) VALUES ('running', 'md5');
+INSERT INTO records (migrate_type, filename, mtime, filesize, status) VALUES ('migrateLocal', '/a.mp4', 1, 10, 'init');
+'''
+
+
+class UpgradeMigrateDbTest(TempDirTestCase):
+
+    def test_upgrade_baseline_db(self):
+        conn = sqlite3.connect(os.path.join(self.work_dir, MIGRATE_DB))
+        conn.executescript(BASELINE_SCHEMA)
+        conn.close()
+
+        migrate_manager = MigrateManager(conf=ConfigParser.parse(write_config(self.work_dir)))
+        self.managers.append(migrate_manager)
+
+        conn = sqlite3.connect(os.path.join(self.work_dir, MIGRATE_DB))
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(records)')]
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(records)')]
+        session_columns = [row[1] for row in conn.execute('PRAGMA table_info(session)')]
+        conn.close()
+        self.assertIn('execute_begin_time', session_columns)
+        for column in ('owner', 'lease_expire', 'claim_time', 'content_hash', 'attempts', 'next_attempt_at'):
+            self.assertIn(column, columns)
+        self.assertIn('idx_records_type_size_hash', indexes)
+
+        self.assertEqual(migrate_manager.get_migrate_status(), MIGRATE_RUNNING)
+        session = Session()
+        record = session.query(MigrateRecord).one()
+        session.close()
+        self.assertEqual(record.filename, '/a.mp4')
+        self.assertEqual(record.content_hash, '')
+        self.assertEqual(record.attempts, 0)
+
+
+class LeaseTest(TempDirTestCase):
+
+    def setUp(self):
+        super(LeaseTest, self).setUp()
+        self.migrate_manager = self.create_manager('migrateLocal')
+        for i in range(3):
+            self.migrate_manager.save_migrate_record(MigrateRecord(
+                migrate_type='migrateLocal', filename='/{i}.mp4'.format(i=i),
+                filesize=i, status=MIGRATE_TASK_INIT))
+        self.migrate_manager.flush_migrate_records()
+        self.migrate_manager.update_execute_begin_time()
+
+    def claim(self, owner, limit=10, lease_seconds=60):
+        records = self.migrate_manager.claim_migrate_records('migrateLocal', owner, limit, lease_seconds)
+        return [record.filename for record in records]
+
+    def update_record(self, filename, **fields):
+        session = Session()
+        session.query(MigrateRecord).filter(MigrateRecord.filename == filename).update(fields)
+        session.commit()
+        session.close()
+
+    def test_claim_once(self):
+        self.assertEqual(self.claim('a', limit=2), ['/0.mp4', '/1.mp4'])
+        # 租约有效期内其他进程不能领取
+        self.assertEqual(self.claim('b'), ['/2.mp4'])
+        self.assertEqual(self.claim('b'), [])
+        self.assertEqual(self.migrate_manager.count_leased_migrate_records('migrateLocal'), 3)
+
+    def test_expired_lease(self):
+        self.assertEqual(self.claim('a', limit=1), ['/0.mp4'])
+        # 进程异常退出，租约过期后由其他进程接管
+        self.update_record('/0.mp4', lease_expire=int(time.time()) - 1)
+        self.assertEqual(self.claim('b', limit=1), ['/0.mp4'])
+        session = Session()
+        record = session.query(MigrateRecord).filter(MigrateRecord.filename == '/0.mp4').one()
+        session.close()
+        self.assertEqual((record.owner, record.status), ('b', MIGRATE_TASK_RUNNING))
+
+    def test_failed_in_this_run(self):
+        self.assertEqual(len(self.claim('a')), 3)
+        # 本次执行中失败且不再重试的记录不再领取，等待重试的记录到重试时间后领取
+        self.update_record('/0.mp4', status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_RETRYABLE)
+        self.update_record('/1.mp4', status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_RETRYABLE,
+                           next_attempt_at=int(time.time()) - 1)
+        self.assertEqual(self.claim('a'), ['/1.mp4'])
+
+    def test_failed_in_previous_run(self):
+        self.update_record('/0.mp4', status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_RETRYABLE,
+                           claim_time=self.migrate_manager.execute_begin_time - 1)
+        self.update_record('/1.mp4', status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_PERMANENT,
+                           claim_time=self.migrate_manager.execute_begin_time - 1)
+        self.assertEqual(self.claim('a'), ['/0.mp4', '/2.mp4'])
+
+    def test_workers_share_begin_time(self):
+        # 发起迁移的进程100秒前开始执行，50秒前领取的记录失败且不再重试
+        begin_time = self.migrate_manager.execute_begin_time - 100
+        session = Session()
+        session.query(MigrateStatus).update({MigrateStatus.execute_begin_time: begin_time})
+        session.commit()
+        session.close()
+        self.update_record('/0.mp4', status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_RETRYABLE,
+                           claim_time=begin_time + 50)
+
+        # 稍后启动的工作进程使用同一个开始时间，不再领取本次执行中已经处理过的记录
+        worker = MigrateManager(conf=ConfigParser.parse(write_config(self.work_dir)))
+        self.managers.append(worker)
+        worker.load_execute_begin_time()
+        self.assertEqual(worker.execute_begin_time, begin_time)
+        records = worker.claim_migrate_records('migrateLocal', 'b', 10, 60)
+        self.assertEqual([record.filename for record in records], ['/1.mp4', '/2.mp4'])
+
+
+class DuplicateRecordTest(TempDirTestCase):
+
+    def setUp(self):
+        super(DuplicateRecordTest, self).setUp()
+        self.migrate_manager = self.create_manager('migrateLocal')
+        for i in range(3):
+            self.migrate_manager.save_migrate_record(MigrateRecord(
+                migrate_type='migrateLocal', filename='/{i}.mp4'.format(i=i),
+                filesize=10, status=MIGRATE_TASK_INIT))
+        self.migrate_manager.flush_migrate_records()
+        session = Session()
+        session.query(MigrateRecord).update({MigrateRecord.content_hash: 'md5'})
+        session.commit()
+        session.close()
+        self.assertEqual(self.migrate_manager.mark_duplicate_records('migrateLocal'), 2)
+        self.migrate_manager.update_execute_begin_time()
+
+    def get_records(self):
+        session = Session()
+        records = session.query(MigrateRecord).order_by(MigrateRecord.id).all()
+        session.close()
+        return [(record.status, record.dup_of) for record in records]
+
+    def update_record(self, record_id, **fields):
+        session = Session()
+        session.query(MigrateRecord).filter(MigrateRecord.id == record_id).update(fields)
+        session.commit()
+        session.close()
+
+    def test_pending_until_resolved(self):
+        # 未复用FileId的重复记录不计入成功
+        self.migrate_manager.init_counter()
+        self.assertEqual((self.migrate_manager.success_num, self.migrate_manager.finished_bytes), (0, 0))
+
+        self.update_record(1, status=MIGRATE_TASK_SUCCESS, file_id='f1')
+        self.migrate_manager.init_counter()
+        self.assertEqual(self.migrate_manager.resolve_duplicate_records('migrateLocal'), 2)
+        self.assertEqual((self.migrate_manager.success_num, self.migrate_manager.finished_bytes), (3, 30))
+        self.assertEqual(self.get_records(), [(MIGRATE_TASK_SUCCESS, 0), (MIGRATE_TASK_SUCCESS, 1),
+                                              (MIGRATE_TASK_SUCCESS, 1)])
+
+    def test_promote_when_primary_failed(self):
+        self.assertEqual(self.migrate_manager.promote_duplicate_records('migrateLocal'), 0)
+        # 主记录等待重试时不改变
+        self.update_record(1, status=MIGRATE_TASK_FAIL, error_class=MIGRATE_ERROR_RETRYABLE,
+                           next_attempt_at=int(time.time()) + 60)
+        self.assertEqual(self.migrate_manager.promote_duplicate_records('migrateLocal'), 0)
+
+        self.update_record(1, error_class=MIGRATE_ERROR_PERMANENT, next_attempt_at=0)
+        self.assertEqual(self.migrate_manager.promote_duplicate_records('migrateLocal'), 1)
+        self.assertEqual(self.get_records(), [(MIGRATE_TASK_FAIL, 0), (MIGRATE_TASK_INIT, 0),
+                                              (MIGRATE_TASK_DUPLICATE, 2)])
+        records = self.migrate_manager.claim_migrate_records('migrateLocal', 'a', 10, 60)
+        self.assertEqual([record.id for record in records], [2])
+
+        # 再次执行时，失败的记录不再作为主记录
+        self.update_record(2, status=MIGRATE_TASK_INIT)
+        self.migrate_manager.mark_duplicate_records('migrateLocal')
+        self.assertEqual(self.get_records(), [(MIGRATE_TASK_DUPLICATE, 2), (MIGRATE_TASK_INIT, 0),
+                                              (MIGRATE_TASK_DUPLICATE, 2)])
+
+
+class RecordWriterTest(TempDirTestCase):
+
+    def setUp(self):
+        super(RecordWriterTest, self).setUp()
+        self.retry_times = manager.WRITE_RETRY_TIMES
+        manager.WRITE_RETRY_TIMES = 1
+
+    def tearDown(self):
+        manager.WRITE_RETRY_TIMES = self.retry_times
+        super(RecordWriterTest, self).tearDown()
+
+    def make_record(self, filename):
+        return MigrateRecord(migrate_type='migrateLocal', filename=filename, filesize=1, status=MIGRATE_TASK_INIT)
+
+    def test_stop_after_failed_commit(self):
+        migrate_manager = self.create_manager('migrateLocal')
+        # 写入线程提交时表已不存在
+        with migrate_manager.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE records RENAME TO records_old'))
+        migrate_manager.save_migrate_record(self.make_record('/a.mp4'))
+        self.assertRaises(Exception, migrate_manager.flush_migrate_records)
+
+        # 失败后不再接受新的记录，也不再提交之后的批次
+        self.assertRaises(Exception, migrate_manager.check_migrate_records)
+        self.assertRaises(Exception, migrate_manager.save_migrate_record, self.make_record('/b.mp4'))
+        with migrate_manager.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE records_old RENAME TO records'))
+        self.assertRaises(Exception, migrate_manager.flush_migrate_records)
+        self.assertEqual(migrate_manager.get_migrate_results(0, 10), [])
+
+        self.managers.remove(migrate_manager)
+        self.assertRaises(Exception, migrate_manager.record_writer.close)
+        self.assertFalse(migrate_manager.record_writer.thread.is_alive())
+        migrate_manager.engine.dispose()
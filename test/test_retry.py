@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import errno
+import socket
+import time
+import unittest
+from qcloud_vod.exception import VodClientException
+from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
+from qcloud_vod_migrate.manager import MigrateRecord, Session
+from qcloud_vod_migrate.manager import MIGRATE_ERROR_PERMANENT, MIGRATE_ERROR_RETRYABLE, MIGRATE_TASK_FAIL
+from qcloud_vod_migrate.retry import HttpStatusError, classify_error, get_error_code, get_retry_delay
+from test.common import TempDirTestCase
+
+
+class ClassifyErrorTest(unittest.TestCase):
+
+    def test_permanent(self):
+        for error in [
+                VodClientException("lack media type"),
+                TencentCloudSDKException("InvalidParameterValue.MediaType", "bad media type"),
+                TencentCloudSDKException("AuthFailure.SignatureFailure", "signature failure"),
+                IOError(errno.ENOENT, "No such file or directory"),
+                HttpStatusError("not found", 404),
+                HttpStatusError("forbidden", 403)]:
+            self.assertEqual(classify_error(error), MIGRATE_ERROR_PERMANENT, repr(error))
+
+    def test_retryable(self):
+        for error in [
+                VodClientException("incomplete upload"),
+                TencentCloudSDKException("RequestLimitExceeded", "too many requests"),
+                TencentCloudSDKException("InternalError", "internal error"),
+                IOError(errno.ECONNRESET, "Connection reset by peer"),
+                socket.timeout("timed out"),
+                HttpStatusError("too many requests", 429),
+                HttpStatusError("bad gateway", 502),
+                Exception("unknown")]:
+            self.assertEqual(classify_error(error), MIGRATE_ERROR_RETRYABLE, repr(error))
+
+    def test_error_code(self):
+        self.assertEqual(get_error_code(TencentCloudSDKException("InternalError", "")), "InternalError")
+        self.assertEqual(get_error_code(IOError(errno.ENOENT, "")), "ENOENT")
+        self.assertEqual(get_error_code(HttpStatusError("", 404)), "404")
+        self.assertEqual(get_error_code(ValueError("")), "ValueError")
+
+
+class RetryDelayTest(unittest.TestCase):
+
+    def test_backoff(self):
+        # 第n次失败后等待 base * 2^(n-1) 的后一半区间，不超过最大值
+        for attempts, delay in [(1, 2), (2, 4), (3, 8), (10, 60), (100, 60)]:
+            for _ in range(20):
+                wait = get_retry_delay(attempts, 2, 60)
+                self.assertGreaterEqual(wait, delay / 2.0)
+                self.assertLessEqual(wait, delay)
+
+
+class RetryClaimTest(TempDirTestCase):
+
+    def test_wait_for_next_attempt(self):
+        migrate_manager = self.create_manager('migrateLocal')
+        migrate_manager.update_execute_begin_time()
+        # 其他工作进程（或上次执行）中失败、等待重试的记录
+        migrate_manager.save_migrate_record(MigrateRecord(
+            migrate_type='migrateLocal', filename='/a.mp4', filesize=1, status=MIGRATE_TASK_FAIL,
+            error_class=MIGRATE_ERROR_RETRYABLE, attempts=1, next_attempt_at=int(time.time()) + 60))
+        migrate_manager.flush_migrate_records()
+        self.assertEqual(migrate_manager.claim_migrate_records('migrateLocal', 'a', 10, 60), [])
+
+        session = Session()
+        session.query(MigrateRecord).update({MigrateRecord.next_attempt_at: int(time.time()) - 1})
+        session.commit()
+        session.close()
+        records = migrate_manager.claim_migrate_records('migrateLocal', 'a', 10, 60)
+        self.assertEqual([(r.filename, r.attempts) for r in records], [('/a.mp4', 1)])
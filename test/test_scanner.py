@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from qcloud_vod_migrate import scanner
+from qcloud_vod_migrate.scanner import LocalScanner
+
+
+class LocalScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='vodmigrate_test_')
+        self.batch_size = scanner.SCAN_BATCH_SIZE
+        self.files = []
+        for dirpath in ['', 'a', 'a/b', 'a/b/c', 'd', 'skip', 'skip/e']:
+            if dirpath:
+                os.makedirs(os.path.join(self.root, dirpath))
+            for i in range(3):
+                path = os.path.join(self.root, dirpath, '{i}.mp4'.format(i=i))
+                with open(path, 'wb') as f:
+                    f.write(b'1')
+                if not dirpath.startswith('skip'):
+                    self.files.append(path)
+        self.excludes = [os.path.join(self.root, 'skip')]
+
+    def tearDown(self):
+        scanner.SCAN_BATCH_SIZE = self.batch_size
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def scan_files(self, local_scanner):
+        return [path for _, files in local_scanner.scan() for path, _ in files]
+
+    def test_scan(self):
+        local_scanner = LocalScanner(self.root, excludes=self.excludes, concurrency=4)
+        self.assertEqual(sorted(self.scan_files(local_scanner)), sorted(self.files))
+        self.assertEqual(local_scanner.file_num, len(self.files))
+        self.assertEqual(local_scanner.get_frontier(), ([], []))
+
+    def test_resume_from_frontier(self):
+        # 每批一个文件，中断时目录可能只返回了部分文件
+        scanner.SCAN_BATCH_SIZE = 1
+        for stop_after in range(1, len(self.files)):
+            local_scanner = LocalScanner(self.root, excludes=self.excludes, concurrency=2)
+            results = local_scanner.scan()
+            files = []
+            for _ in range(stop_after):
+                files.extend(path for path, _ in next(results)[1])
+            frontier, files_only = local_scanner.get_frontier()
+            results.close()
+
+            resumed = LocalScanner(self.root, excludes=self.excludes, concurrency=2,
+                                   frontier=frontier, files_only=files_only)
+            files.extend(self.scan_files(resumed))
+            # 续扫只会重复中断时尚未取走结果的目录中的文件，不会遗漏
+            self.assertEqual(sorted(set(files)), sorted(self.files))
+
+    def test_resume_finished(self):
+        local_scanner = LocalScanner(self.root, frontier=[], files_only=[])
+        self.assertEqual(self.scan_files(local_scanner), [])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from qcloud_vod_migrate.config import ConfigParser
+from qcloud_vod_migrate.filter import MediaFilter
+from qcloud_vod_migrate.source import base, url
+from qcloud_vod_migrate.source.url import UrlSource
+from test.common import write_config
+
+
+class UrlSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='vodmigrate_test_')
+        self.conf = ConfigParser.parse(write_config(self.work_dir, 'migrateUrl'))
+        self.page_size = url.LIST_PAGE_SIZE
+
+    def tearDown(self):
+        url.LIST_PAGE_SIZE = self.page_size
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_urls(self, content):
+        with open(os.path.join(self.work_dir, 'url.txt'), 'wb') as f:
+            f.write(content)
+
+    def list_keys(self, source, cursor=None):
+        return [obj.key for page in source.list_pages(cursor) for obj in page]
+
+    def test_crlf(self):
+        self.write_urls(b'http://example.com/a.mp4\r\nhttp://example.com/b.mp4\r\n')
+        source = UrlSource(self.conf)
+        objects = [obj for page in source.list_pages() for obj in page]
+        self.assertEqual([obj.key for obj in objects], ['http://example.com/a.mp4', 'http://example.com/b.mp4'])
+        self.assertEqual(objects[0].filter_name, '/a.mp4')
+        media_filter = MediaFilter(self.conf)
+        self.assertTrue(all(media_filter.check(obj.filter_name) for obj in objects))
+
+    def test_resume_from_cursor(self):
+        urls = ['http://example.com/{i}.mp4'.format(i=i) for i in range(10)]
+        self.write_urls(''.join(u + '\n' for u in urls).encode('utf-8'))
+        url.LIST_PAGE_SIZE = 4
+
+        source = UrlSource(self.conf)
+        pages = source.list_pages()
+        first = next(pages)
+        # 列举位置保存为json后再传入
+        cursor = json.loads(json.dumps(source.get_cursor()))
+        self.assertEqual([obj.key for obj in first], urls[:4])
+        self.assertEqual(self.list_keys(UrlSource(self.conf), cursor), urls[4:])
+
+        # 最后一页之后没有可继续的位置
+        list(pages)
+        self.assertIsNone(source.get_cursor())
+
+
+class SourceObjectTest(unittest.TestCase):
+
+    def test_filter_name_defaults_to_key(self):
+        obj = base.SourceObject('a/b.mp4', 1)
+        self.assertEqual(obj.filter_name, 'a/b.mp4')
+        self.assertIsNone(obj.mtime)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import threading
+from qcloud_vod_migrate.execute import TaskProducer
+from qcloud_vod_migrate.watch import LocalWatcher
+from test.common import TempDirTestCase
+
+
+class LocalWatcherTest(TempDirTestCase):
+
+    def test_continue_after_error(self):
+        migrate_manager = self.create_manager('migrateLocal')
+        watcher = LocalWatcher(TaskProducer(migrate_manager), settle_seconds=1, reconcile_interval=3600)
+        checked = threading.Event()
+        calls = []
+
+        def check_candidates():
+            calls.append(1)
+            if len(calls) == 1:
+                raise IOError("database is locked")
+            checked.set()
+
+        watcher.check_candidates = check_candidates
+        watcher.start()
+        try:
+            self.assertTrue(checked.wait(10))
+            self.assertTrue(watcher.is_alive())
+        finally:
+            watcher.stop()
+        self.assertFalse(watcher.is_alive())